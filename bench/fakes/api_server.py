@@ -0,0 +1,76 @@
+import http.server
+import re
+import sys
+import threading
+import time
+import urllib.parse
+
+# Stand-in for the API of a container tested by CATS: every path of the specification answers 200 to a GET,
+# except that the paths of every fifth group answer 500 when the fuzz parameter is sent. The requests are
+# counted by specification path, so a check can tell if every path was tested exactly once
+
+def path_pattern(path):
+	# /pet/{petId} matches /pet/1
+	return re.compile("^" + re.sub(r"\\\{[^/]*?\\\}", "[^/]+", re.escape(path)) + "$")
+
+
+def failing(path):
+	# Paths of the groups whose index is a multiple of 5 (Eg. /group0, /group5/{id})
+	match = re.match(r"^/group(\d+)", path)
+	return bool(match) and int(match.group(1)) % 5 == 0
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+	def log_message(self, *args):
+		pass
+
+	def do_GET(self):
+		time.sleep(self.server.latency)
+		url = urllib.parse.urlparse(self.path)
+		for path, pattern in self.server.patterns:
+			if pattern.match(url.path):
+				break
+		else:
+			return self.reply(404)
+		fuzzed = "fuzz" in urllib.parse.parse_qs(url.query)
+		with self.server.lock:
+			counts = self.server.fuzzed if fuzzed else self.server.requests
+			counts[path] = counts.get(path, 0) + 1
+		self.reply(500 if fuzzed and failing(path) else 200)
+
+	def reply(self, status):
+		body = b"{}"
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+
+class Server(http.server.ThreadingHTTPServer):
+	daemon_threads = True
+
+	def __init__(self, paths, latency=0, port=0):
+		self.patterns = [(path, path_pattern(path)) for path in paths]
+		self.latency = latency
+		self.lock = threading.Lock()
+		self.requests = {}
+		self.fuzzed = {}
+		super().__init__(("127.0.0.1", port), Handler)
+
+	@property
+	def url(self):
+		return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+def start(paths, latency=0):
+	# Serves in a background thread, stop it with shutdown()
+	server = Server(paths, latency)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+
+if __name__ == "__main__":
+	if len(sys.argv) != 3:
+		sys.exit("Usage: api_server.py <port> <path1,path2,...>")
+	Server(sys.argv[2].split(","), port=int(sys.argv[1])).serve_forever()
@@ -0,0 +1,93 @@
+import http.server
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+
+# Stand-in for the Docker Engine API on a unix socket, for the requests of common/docker_api.py on images:
+# inspect, pull, save (the synthetic image.tar of the data folder, sent in chunks) and remove.
+# Every request waits latency seconds before the response
+
+CHUNK_SIZE = 64 * 1024
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+
+	def log_message(self, *args):
+		pass
+
+	def address_string(self):
+		return "unix"
+
+	def send_json(self, content, status=200):
+		body = json.dumps(content).encode()
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def start_chunked(self, content_type):
+		self.send_response(200)
+		self.send_header("Content-Type", content_type)
+		self.send_header("Transfer-Encoding", "chunked")
+		self.end_headers()
+
+	def write_chunk(self, data):
+		self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+
+	def do_GET(self):
+		time.sleep(self.server.latency)
+		path = urllib.parse.urlparse(self.path).path
+		if path == "/info":
+			return self.send_json({"Name": "bench", "ServerVersion": "bench", "Driver": "overlay2", "SecurityOptions": [], "Swarm": {"LocalNodeState": "inactive"}})
+		if path.startswith("/images/") and path.endswith("/json"):
+			with open(os.path.join(self.server.data, "inspect.json"), "r") as json_file:
+				return self.send_json(json.load(json_file))
+		if path.startswith("/images/") and path.endswith("/get"):
+			self.start_chunked("application/x-tar")
+			with open(os.path.join(self.server.data, "image.tar"), "rb") as image_file:
+				while chunk := image_file.read(CHUNK_SIZE):
+					self.write_chunk(chunk)
+			self.write_chunk(b"")
+			return
+		self.send_json({"message": f"page not found: {path}"}, 404)
+
+	def do_POST(self):
+		time.sleep(self.server.latency)
+		self.start_chunked("application/json")
+		for status in ("Pulling from library/bench", "Pull complete", "Status: Image is up to date for bench:latest"):
+			self.write_chunk((json.dumps({"status": status}) + "\r\n").encode())
+		self.write_chunk(b"")
+
+	def do_DELETE(self):
+		time.sleep(self.server.latency)
+		self.send_json([{"Untagged": urllib.parse.unquote(self.path.split("/")[-1])}])
+
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+	def __init__(self, socket_path, data, latency=0):
+		if os.path.exists(socket_path):
+			os.remove(socket_path)
+		self.data = data
+		self.latency = latency
+		super().__init__(socket_path, Handler)
+
+
+def start(socket_path, data, latency=0):
+	# Serves in a background thread, stop it with shutdown()
+	server = Server(socket_path, data, latency)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+
+if __name__ == "__main__":
+	if len(sys.argv) != 3:
+		sys.exit("Usage: dockerd.py <socket path> <data folder>")
+	Server(sys.argv[1], sys.argv[2], float(os.environ.get("BENCH_LATENCY", "0"))).serve_forever()
@@ -0,0 +1,350 @@
+import argparse
+import asyncio
+import contextlib
+import datetime
+import hashlib
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+# Benchmarks of the analysis stages on synthetic inputs, with the external tools replaced by the stand-ins
+# in bench/fakes (their latency is set with --latency). Each stage is run --repeat times for each size and
+# the timings are written as JSON, so the results of two branches can be compared with --compare
+
+BENCH_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCH_DIR.parent
+FAKES_DIR = BENCH_DIR / "fakes"
+
+sys.path.insert(0, str(REPO_DIR))
+sys.path.insert(0, str(REPO_DIR / "static"))
+sys.path.insert(0, str(REPO_DIR / "monitoring"))
+sys.path.insert(0, str(REPO_DIR / "dynamic"))
+sys.path.insert(0, str(FAKES_DIR))
+from common import docker_api
+
+import synthetic
+import dockerd
+import api_server
+import cats_shards
+import image_layers
+import observer
+from scan_queue import ScanQueue
+from scan_cache import ScanCache
+from nmap_batch import NmapBatcher
+from findings_store import FindingsStore
+
+# files and packages: Python files in the image and packages in its dpkg database. vulnerabilities: records
+# of the Trivy report. issues: Bandit issues. bugs: Spotbugs bug instances (about 650 bytes each, so large
+# is a report of more than 300 MB). events: Falco lines sent to the observer, for containers running images.
+# api_paths: paths of the OpenAPI specification tested by cats_shards CATS processes
+SIZES = {
+	"small": {"files": 500, "packages": 20, "layers": 3, "vulnerabilities": 2000, "issues": 500, "bugs": 5000, "events": 1000, "containers": 50, "images": 10,
+		"api_paths": 60, "cats_shards": 4},
+	"medium": {"files": 5000, "packages": 100, "layers": 5, "vulnerabilities": 20000, "issues": 5000, "bugs": 50000, "events": 10000, "containers": 200, "images": 40,
+		"api_paths": 400, "cats_shards": 4},
+	"large": {"files": 50000, "packages": 500, "layers": 8, "vulnerabilities": 200000, "issues": 50000, "bugs": 500000, "events": 100000, "containers": 1000, "images": 200,
+		"api_paths": 2000, "cats_shards": 8}
+}
+
+STAGES = ("extract", "installed_files", "trivy", "parse_bandit", "parse_spotbugs", "observer", "cats", "pipeline")
+
+IMAGE = "bench:latest"
+WORKDIR = "/app"
+
+
+def load_static_analysis():
+	# static-analysis.py can't be imported by name because of the dash
+	spec = importlib.util.spec_from_file_location("static_analysis", REPO_DIR / "static" / "static-analysis.py")
+	module = importlib.util.module_from_spec(spec)
+	spec.loader.exec_module(module)
+	return module
+
+
+def prepare_data(folder, params):
+	# The inputs are generated again only if the parameters changed, so large inputs can be kept with --data_dir
+	folder = Path(folder)
+	params_path = folder / "params.json"
+	if params_path.exists() and json.loads(params_path.read_text()) == params:
+		return folder
+	folder.mkdir(parents=True, exist_ok=True)
+
+	synthetic.make_image(folder / "image.tar", params["files"], params["packages"], params["layers"], WORKDIR.strip("/"))
+	digest = "sha256:" + hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()
+	(folder / "inspect.json").write_text(json.dumps({"Id": digest, "RepoDigests": [f"bench@{digest}"], "Config": {"WorkingDir": WORKDIR}}))
+
+	# Files listed by rpm run inside a container (get_installed_files, for the BerkeleyDB rpm databases)
+	package_files = max(1, params["files"] // 4) // max(params["packages"], 1) + 1
+	(folder / "installed.txt").write_text("".join(f"/usr/lib/python3/dist-packages/pkg{package}/mod{i}.py\n"
+		for package in range(params["packages"]) for i in range(package_files)))
+
+	synthetic.make_trivy_report(folder / "trivyReport.json", params["vulnerabilities"])
+	synthetic.make_bandit_report(folder / "bandit.txt", params["issues"])
+	synthetic.make_spotbugs_report(folder / "spotbugs.xml", params["bugs"])
+	synthetic.make_openapi_spec(folder / "openapi.yaml", params["api_paths"])
+	(folder / "falco.jsonl").write_text("\n".join(synthetic.falco_events(params["events"], params["containers"])) + "\n")
+	params_path.write_text(json.dumps(params))
+	return folder
+
+
+class BenchContainers:
+	# Stand-in for the ContainerCache of the observer: the containers are spread over a number of images
+	def __init__(self, images):
+		self.images = images
+
+	def get(self, container_id):
+		number = int(container_id, 16)
+		return {"image_id": f"sha256:{number % self.images:064x}", "ip": f"10.{number // 65536 % 256}.{number // 256 % 256}.{number % 256}"}
+
+
+def bench_extract(context):
+	sa = context["static_analysis"]
+	scratch = tempfile.mkdtemp(dir=context["work"])
+	try:
+		client = docker_api.DockerClient()
+		layers = sa.stage_filesystem(IMAGE, "python", WORKDIR, None, False, scratch, client)
+		index = sa.get_exclusion_index(IMAGE, False, "python", layers, scratch, argparse.Namespace(cache=False))
+		image_layers.compose(layers, scratch, index)
+		files = sa.python_files(Path(scratch + WORKDIR).resolve(), scratch, None)
+		client.close()
+		return {"layers": len(layers), "files": len(files), "image_bytes": os.path.getsize(context["data"] / "image.tar")}
+	finally:
+		shutil.rmtree(scratch, ignore_errors=True)
+
+
+def bench_installed_files(context):
+	scratch = tempfile.mkdtemp(dir=context["work"])
+	try:
+		return_code, installed = context["static_analysis"].get_installed_files(IMAGE, "python", scratch)
+		return {"return_code": return_code, "installed_files": len(installed)}
+	finally:
+		shutil.rmtree(scratch, ignore_errors=True)
+
+
+def bench_trivy(context):
+	outfolder = tempfile.mkdtemp(dir=context["work"])
+	try:
+		trivy_out = context["static_analysis"].trivy_analysis(IMAGE, outfolder, "precise", trivy_cache_dir=str(context["work"] / "trivy-cache"))
+		return {"vulnerabilities": sum(trivy_out[:6]), "report_bytes": os.path.getsize(context["data"] / "trivyReport.json")}
+	finally:
+		shutil.rmtree(outfolder, ignore_errors=True)
+
+
+def bench_parse_bandit(context):
+	results = context["static_analysis"].parse_bandit(context["data"] / "bandit.txt")
+	return {"issues": sum(results[:3]), "report_bytes": os.path.getsize(context["data"] / "bandit.txt")}
+
+
+def bench_parse_spotbugs(context):
+	results = context["static_analysis"].parse_spotbugs(context["data"] / "spotbugs.xml")
+	return {"security_bugs": sum(results[:3]), "classes": results[3], "report_bytes": os.path.getsize(context["data"] / "spotbugs.xml")}
+
+
+async def run_observer(lines, params, db_path):
+	# Same wiring as observer.main, with the container metadata of BenchContainers and the nmap stand-in.
+	# Returns when every event has been handled
+	scan_cache = ScanCache(300)
+	batcher = NmapBatcher(0.05, 64, 4)
+	store = FindingsStore(db_path)
+	containers = BenchContainers(params["images"])
+	queue = ScanQueue(lambda event: observer.callback(event, scan_cache, containers, batcher, store), 64, len(lines))
+	queue.start()
+	falco = observer.Observer(queue, queue.stats)
+
+	for line in lines:
+		falco.submit_line(line)
+	while queue.pending or queue.active:
+		await asyncio.sleep(0.01)
+
+	for task in queue.tasks:
+		task.cancel()
+	await batcher.close()
+	store.close()
+	return {**queue.stats(), "nmap": batcher.stats(), "cache": scan_cache.stats()}
+
+
+def bench_observer(context):
+	lines = (context["data"] / "falco.jsonl").read_text().splitlines()
+	db_folder = tempfile.mkdtemp(dir=context["work"])
+	try:
+		stats = asyncio.run(run_observer(lines, context["params"], os.path.join(db_folder, "findings.db")))
+		return {"events": len(lines), "coalesced": stats["coalesced"], "processed": stats["processed"], "failed": stats["failed"],
+			"scans": stats["cache"]["misses"], "nmap_runs": stats["nmap"]["nmap_runs"]}
+	finally:
+		shutil.rmtree(db_folder, ignore_errors=True)
+
+
+def bench_cats(context):
+	# The paths of the specification split between CATS shards (the java stand-in) testing the stand-in API server.
+	# Every path must be tested exactly once and the summary must hold the test cases of all the shards
+	spec = str(context["data"] / "openapi.yaml")
+	output = tempfile.mkdtemp(dir=context["work"])
+	paths = cats_shards.api_paths(spec)
+	server = api_server.start(paths)
+	try:
+		shards = cats_shards.make_shards(cats_shards.path_groups(paths), context["params"]["cats_shards"])
+		returncodes = cats_shards.run_shards(str(FAKES_DIR), spec, server.url, output, shards, f"{output}/cats")
+		summary = cats_shards.merge_reports(output)
+	finally:
+		server.shutdown()
+		server.server_close()
+		shutil.rmtree(output, ignore_errors=True)
+
+	failing = {path for path in paths if api_server.failing(path)}
+	errors = []
+	if len(paths) != context["params"]["api_paths"]:
+		errors.append(f"{len(paths)} paths read from the specification instead of {context['params']['api_paths']}")
+	if any(returncodes):
+		errors.append(f"CATS exit codes {returncodes}")
+	if sorted(path for shard in shards for path in shard) != sorted(paths):
+		errors.append("the shards don't hold every path exactly once")
+	if server.requests != dict.fromkeys(paths, 1) or server.fuzzed != dict.fromkeys(paths, 1):
+		errors.append("the server didn't get one request of each test case for every path")
+	if summary["tests"] != 2 * len(paths) or summary["results"].get("error", 0) != len(failing):
+		errors.append(f"wrong summary results {summary['tests']} tests, {summary['results']}")
+	if summary["failuresByPath"] != {path: {"error": 1} for path in failing}:
+		errors.append("wrong summary failures by path")
+	if errors:
+		raise RuntimeError("CATS shards: " + ", ".join(errors))
+	return {"paths": len(paths), "shards": len(shards), "tests": summary["tests"], "failures": len(summary["failuresByPath"])}
+
+
+def bench_pipeline(context):
+	# The whole static analysis of the synthetic image, as a separate process
+	outfolder = tempfile.mkdtemp(dir=context["work"])
+	try:
+		command = [sys.executable, str(REPO_DIR / "static" / "static-analysis.py"), "--image", IMAGE, "--lang", "python", "--local",
+			"--outfolder", outfolder, "--docker_bench_path", str(FAKES_DIR / "docker-bench"), "--trivy_cache_dir", str(context["work"] / "trivy-cache")]
+		result = subprocess.run(command, cwd=outfolder, capture_output=True, text=True)
+		if result.returncode != 0:
+			raise RuntimeError(f"static-analysis.py exited with {result.returncode}: {result.stdout[-2000:]}{result.stderr[-2000:]}")
+		with open(os.path.join(outfolder, "generalReport.json"), "r") as json_file:
+			return {"timings": json.load(json_file).get("timings")}
+	finally:
+		shutil.rmtree(outfolder, ignore_errors=True)
+
+
+BENCHMARKS = {
+	"extract": bench_extract,
+	"installed_files": bench_installed_files,
+	"trivy": bench_trivy,
+	"parse_bandit": bench_parse_bandit,
+	"parse_spotbugs": bench_parse_spotbugs,
+	"observer": bench_observer,
+	"cats": bench_cats,
+	"pipeline": bench_pipeline
+}
+
+
+def measure(benchmark, context, repeat):
+	# The output of the stages is not part of the benchmark
+	runs = []
+	extra = None
+	for _ in range(repeat):
+		with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+			start = time.perf_counter()
+			extra = benchmark(context)
+			runs.append(round(time.perf_counter() - start, 4))
+	return runs, extra
+
+
+def git_commit():
+	try:
+		return subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip() or None
+	except OSError:
+		return None
+
+
+def compare(results, baseline_path):
+	# Ratio of the median times to those of the baseline, below 1 is faster
+	with open(baseline_path, "r") as json_file:
+		baseline = {(result["stage"], result["size"]): result for result in json.load(json_file)["results"]}
+	print(f"\n{'stage':<16}{'size':<8}{'baseline':>10}{'current':>10}{'ratio':>8}")
+	for result in results:
+		old = baseline.get((result["stage"], result["size"]))
+		if not old:
+			continue
+		ratio = result["median"] / old["median"] if old["median"] else float("inf")
+		color = "\033[1;32m" if ratio < 0.95 else "\033[1;91m" if ratio > 1.05 else ""
+		print(f"{result['stage']:<16}{result['size']:<8}{old['median']:>10.3f}{result['median']:>10.3f}{color}{ratio:>8.2f}\033[0m")
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Benchmark the analysis stages on synthetic images and reports, with stand-ins for "
+	"trivy, nmap, docker, pylint, bandit, docker-bench-security, CATS, the Docker API and the API tested by CATS")
+	parser.add_argument('--sizes', type=lambda sizes: sizes.split(','), metavar="size1,size2", default=["small"],
+	help=f"Comma-separated list of input sizes among {', '.join(SIZES)} (Default: small)")
+	parser.add_argument('--stages', type=lambda stages: stages.split(','), metavar="stage1,stage2", default=list(STAGES),
+	help=f"Comma-separated list of stages among {', '.join(STAGES)} (Default: all)")
+	parser.add_argument('--repeat', type=int, metavar="int", default=3, help="Runs of each stage for each size (Default: 3)")
+	parser.add_argument('--latency', type=float, metavar="seconds", default=0, help="Added to every call of the fake tools and of the fake Docker API (Default: 0)")
+	parser.add_argument('--data_dir', type=str, metavar="string", help="Keep the synthetic inputs in this folder and reuse them in the next runs "
+	"(Default: a temporary folder, deleted at the end)")
+	parser.add_argument('--output', type=str, metavar="file", default="bench_results.json", help="Results file (Default: bench_results.json)")
+	parser.add_argument('--compare', type=str, metavar="file", help="Results file of a previous run (Eg. of another branch) to compare with")
+	args = parser.parse_args()
+
+	for size in args.sizes:
+		if size not in SIZES:
+			parser.error(f"Unknown size {size}, use one of {', '.join(SIZES)}")
+	for stage in args.stages:
+		if stage not in STAGES:
+			parser.error(f"Unknown stage {stage}, use one of {', '.join(STAGES)}")
+
+	# The fake tools are found first in PATH, also by the subprocesses of the stages
+	os.environ["PATH"] = f"{FAKES_DIR}{os.pathsep}{os.environ.get('PATH', '')}"
+	os.environ["BENCH_LATENCY"] = str(args.latency)
+	static_analysis = load_static_analysis()
+
+	work = Path(tempfile.mkdtemp(prefix="bench-"))
+	data_root = Path(args.data_dir) if args.data_dir else work / "data"
+	results = []
+	try:
+		for size in args.sizes:
+			params = SIZES[size]
+			print(f"\033[1;32m\nGenerating the {size} inputs\033[0m")
+			data = prepare_data(data_root / size, params)
+			os.environ["BENCH_DATA"] = str(data)
+
+			socket_path = str(work / "docker.sock")
+			os.environ["DOCKER_HOST"] = f"unix://{socket_path}"
+			server = dockerd.start(socket_path, str(data), args.latency)
+			context = {"static_analysis": static_analysis, "data": data, "work": work, "params": params}
+			try:
+				for stage in args.stages:
+					runs, extra = measure(BENCHMARKS[stage], context, args.repeat)
+					result = {"stage": stage, "size": size, "params": params, "runs": runs, "min": min(runs), "median": statistics.median(runs), "max": max(runs), "extra": extra}
+					results.append(result)
+					print(f"{stage:<16}{size:<8} median {result['median']:.3f}s (min {result['min']:.3f}s, max {result['max']:.3f}s) {json.dumps(extra)}")
+			finally:
+				server.shutdown()
+				server.server_close()
+	finally:
+		shutil.rmtree(work, ignore_errors=True)
+
+	meta = {
+		"commit": git_commit(),
+		"python": platform.python_version(),
+		"platform": platform.platform(),
+		"cpus": os.cpu_count(),
+		"date": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+		"latency": args.latency,
+		"repeat": args.repeat
+	}
+	with open(args.output, "w") as json_file:
+		json.dump({"meta": meta, "results": results}, json_file, indent=4)
+	print(f"Results written in {Path(args.output).resolve()}")
+
+	if args.compare:
+		compare(results, args.compare)
+
+
+if __name__ == "__main__":
+	main()
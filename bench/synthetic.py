@@ -0,0 +1,170 @@
+import hashlib
+import io
+import json
+import random
+import tarfile
+
+# Synthetic inputs for the benchmarks: image archives in the 'docker save' format, tool reports and
+# Falco events. Everything is generated from a seed, so two runs (or two branches) get the same inputs
+
+PYTHON_SOURCE = "import os\n\n\ndef handler(event):\n\tassert event\n\treturn os.path.join('/tmp', str(event))\n"
+
+
+def add_file(archive, name, data, mode=0o644):
+	info = tarfile.TarInfo(name)
+	info.size = len(data)
+	info.mode = mode
+	archive.addfile(info, io.BytesIO(data))
+
+
+def layer_tar(files):
+	# files is a dict {path without leading slash: content}
+	buffer = io.BytesIO()
+	with tarfile.open(fileobj=buffer, mode="w") as archive:
+		folders = set()
+		for name in files:
+			parts = name.split("/")[:-1]
+			for i in range(1, len(parts) + 1):
+				folders.add("/".join(parts[:i]))
+		for folder in sorted(folders):
+			info = tarfile.TarInfo(folder)
+			info.type = tarfile.DIRTYPE
+			info.mode = 0o755
+			archive.addfile(info)
+		for name, data in files.items():
+			add_file(archive, name, data)
+	return buffer.getvalue()
+
+
+def make_image(path, files, packages, layers=3, workdir="app", seed=0):
+	# Image with a dpkg database listing the files of the packages (installed under /usr/lib/python3/dist-packages)
+	# in the base layer, and the project files under /workdir split between the other layers
+	rng = random.Random(seed)
+	layer_files = [{} for _ in range(layers)]
+	package_files = max(1, files // 4)
+	for package in range(packages):
+		listed = [f"/usr/lib/python3/dist-packages/pkg{package}/mod{i}.py" for i in range(package_files // max(packages, 1) + 1)]
+		layer_files[0][f"var/lib/dpkg/info/pkg{package}.list"] = ("\n".join(listed) + "\n").encode()
+		for listed_path in listed:
+			layer_files[0][listed_path.lstrip("/")] = PYTHON_SOURCE.encode()
+	for i in range(files):
+		layer = 1 + i % (layers - 1) if layers > 1 else 0
+		layer_files[layer][f"{workdir}/module{i // 100}/file{i}.py"] = (PYTHON_SOURCE + f"# {rng.random()}\n").encode()
+
+	diff_ids = []
+	with tarfile.open(path, "w") as archive:
+		names = []
+		for index, content in enumerate(layer_files):
+			data = layer_tar(content)
+			digest = hashlib.sha256(data).hexdigest()
+			diff_ids.append("sha256:" + digest)
+			names.append(f"{digest}/layer.tar")
+			add_file(archive, names[-1], data)
+		config = json.dumps({"config": {"WorkingDir": "/" + workdir}, "rootfs": {"type": "layers", "diff_ids": diff_ids}}).encode()
+		config_name = hashlib.sha256(config).hexdigest() + ".json"
+		add_file(archive, config_name, config)
+		add_file(archive, "manifest.json", json.dumps([{"Config": config_name, "RepoTags": ["bench:latest"], "Layers": names}]).encode())
+	return path
+
+
+def make_trivy_report(path, vulnerabilities, targets=10, seed=0):
+	# JSON report in the format of 'trivy image --format json', the first target holds the OS packages
+	rng = random.Random(seed)
+	severities = ("LOW", "MEDIUM", "HIGH", "CRITICAL", "UNKNOWN")
+	results = []
+	for target in range(targets):
+		os_target = target == 0
+		results.append({
+			"Target": "bench:latest (debian 12.5)" if os_target else f"app/requirements{target}.txt",
+			"Class": "os-pkgs" if os_target else "lang-pkgs",
+			"Type": "debian" if os_target else "pip",
+			"Vulnerabilities": [{
+				"VulnerabilityID": f"CVE-2024-{target}{i:06d}",
+				"PkgName": f"package{i % 500}",
+				"InstalledVersion": "1.0.0",
+				"FixedVersion": "1.0.1",
+				"Severity": rng.choice(severities),
+				"Title": "Synthetic vulnerability with a title long enough to look like a real one",
+				"Description": "x" * 200
+			} for i in range(vulnerabilities // targets)]
+		})
+	with open(path, "w") as json_file:
+		json.dump({"SchemaVersion": 2, "ArtifactName": "bench:latest", "Metadata": {"OS": {"Family": "debian", "Name": "12.5"}}, "Results": results}, json_file, indent=2)
+	return path
+
+
+def make_bandit_report(path, issues, files=100, seed=0):
+	# Text report in Bandit's txt layout, rendered by bandit_shards from synthetic JSON results
+	import bandit_shards
+	rng = random.Random(seed)
+	severities = ("LOW", "MEDIUM", "HIGH")
+	results = [{
+		"filename": f"/app/module{i % files}.py",
+		"test_id": "B101",
+		"test_name": "assert_used",
+		"issue_text": "Use of assert detected.",
+		"issue_severity": rng.choice(severities),
+		"issue_confidence": "HIGH",
+		"issue_cwe": {"id": 703, "link": "https://cwe.mitre.org/data/definitions/703.html"},
+		"more_info": "https://bandit.readthedocs.io/en/latest/plugins/b101_assert_used.html",
+		"line_number": i,
+		"col_offset": 4,
+		"code": f"{i} \tassert event\n"
+	} for i in range(issues)]
+	totals = {"loc": issues * 10, "nosec": 0}
+	for severity in severities:
+		totals[f"SEVERITY.{severity}"] = len([result for result in results if result["issue_severity"] == severity])
+	merged = {"errors": [], "metrics": {"_totals": totals}, "results": results}
+	with open(path, "w") as text_file:
+		text_file.write(bandit_shards.render_text(merged))
+	return path
+
+
+def make_spotbugs_report(path, bugs, classes=1000, seed=0):
+	# XML report in the layout of Spotbugs -xml:withMessages, written as a stream so it can be hundreds of MB
+	rng = random.Random(seed)
+	categories = ("SECURITY", "BAD_PRACTICE", "PERFORMANCE", "STYLE")
+	with open(path, "w") as xml_file:
+		xml_file.write('<?xml version="1.0" encoding="UTF-8"?>\n<BugCollection version="4.8.6" sequence="0" timestamp="0" analysisTimestamp="0" release="">\n')
+		xml_file.write('  <Project projectName=""><Jar>/app</Jar></Project>\n')
+		for i in range(bugs):
+			class_name = f"com.example.bench.Class{i % classes}"
+			xml_file.write(f'  <BugInstance type="PREDICTABLE_RANDOM" priority="{rng.randint(1, 3)}" rank="12" abbrev="PREDICTABLE" category="{rng.choice(categories)}" instanceHash="{i:032x}">\n'
+				f'    <ShortMessage>Predictable pseudorandom number generator</ShortMessage>\n'
+				f'    <Class classname="{class_name}" primary="true"><SourceLine classname="{class_name}" sourcefile="Class.java" sourcepath="com/example/bench/Class.java"/></Class>\n'
+				f'    <Method classname="{class_name}" name="run" signature="()V" isStatic="false"><SourceLine classname="{class_name}" start="{i % 500}" end="{i % 500 + 3}"/></Method>\n'
+				f'  </BugInstance>\n')
+		xml_file.write('  <Errors errors="0" missingClasses="0"></Errors>\n  <FindBugsSummary total_classes="%d"></FindBugsSummary>\n</BugCollection>\n' % classes)
+	return path
+
+
+def falco_events(count, containers=100, ports=(443, 8443, 8080), seed=0):
+	# Lines of Falco's JSON output, one in ten is not an open_port event
+	rng = random.Random(seed)
+	lines = []
+	for i in range(count):
+		container = rng.randrange(containers)
+		tags = ["open_port"] if i % 10 else ["container", "shell"]
+		lines.append(json.dumps({
+			"output": "Open port in container",
+			"priority": "Notice",
+			"rule": "Open port",
+			"time": f"2024-05-10T10:{i // 60000 % 60:02d}:{i // 1000 % 60:02d}.{i % 1000:03d}000000Z",
+			"tags": tags,
+			"output_fields": {"container.id": f"{container:012x}", "container.name": f"bench-{container}", "fd.sport": rng.choice(ports)}
+		}))
+	return lines
+
+
+def make_openapi_spec(path, paths, groups=20):
+	# OpenAPI specification in YAML, the paths are split between groups by their first segment (/group0, /group0/{id}, ...)
+	# and every path has a GET operation
+	lines = ["openapi: 3.0.0", "info:", "  title: bench", "  version: 1.0.0", "paths:"]
+	for i in range(paths):
+		group = i % groups
+		path_name = f"/group{group}" if i < groups else f"/group{group}/item{i // groups}/{{id}}"
+		lines += [f"  {path_name}:", "    get:", "      responses:", "        '200':", "          description: OK"]
+	lines += ["components:", "  schemas: {}"]
+	with open(path, "w") as spec_file:
+		spec_file.write("\n".join(lines) + "\n")
+	return path
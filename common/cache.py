@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+# On-disk cache shared by the analysis scripts. Every entry is a folder <cache_dir>/<kind>/<key>
+# containing the cached files; its mtime is updated on each access and it is used for the LRU eviction.
+# Entries are written in a temporary folder and then renamed, so concurrent scans can share the same cache
+
+DEFAULT_CACHE_DIR = os.environ.get("SCAN_CACHE_DIR", str(Path.home() / ".cache" / "container-security"))
+
+
+def cache_key(*parts):
+	# Stable key for any combination of JSON serializable values
+	serialized = json.dumps(parts, sort_keys=True, default=str)
+	return hashlib.sha256(serialized.encode()).hexdigest()
+
+
+def lookup(cache_dir, kind, key, max_age=None):
+	# Returns the folder of the entry or None. max_age (seconds) is checked against the creation time of the entry
+	entry = Path(cache_dir) / kind / key
+	try:
+		created = (entry / ".created").stat().st_mtime
+	except FileNotFoundError:
+		return None
+	if max_age is not None and time.time() - created > max_age:
+		return None
+	
+	# Mark the entry as recently used
+	try:
+		os.utime(entry)
+	except FileNotFoundError:
+		return None
+	return entry
+
+
+def store(cache_dir, kind, key, files):
+	# files is a dict {name in the entry: source path}. Missing source files are skipped
+	kind_dir = Path(cache_dir) / kind
+	kind_dir.mkdir(parents=True, exist_ok=True)
+	tmp_entry = Path(tempfile.mkdtemp(prefix=".tmp-", dir=kind_dir))
+	for name, source in files.items():
+		if Path(source).is_file():
+			shutil.copyfile(source, tmp_entry / name)
+	(tmp_entry / ".created").touch()
+	
+	entry = kind_dir / key
+	try:
+		os.rename(tmp_entry, entry)
+	except OSError:
+		# Another scan stored the same entry in the meantime
+		shutil.rmtree(tmp_entry, ignore_errors=True)
+	return entry
+
+
+def load_json(cache_dir, kind, key, max_age=None):
+	entry = lookup(cache_dir, kind, key, max_age)
+	if entry is None:
+		return None
+	try:
+		with open(entry / "data.json", "r") as json_file:
+			return json.load(json_file)
+	except (FileNotFoundError, json.JSONDecodeError):
+		return None
+
+
+def store_json(cache_dir, kind, key, data):
+	with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as json_file:
+		json.dump(data, json_file)
+	try:
+		return store(cache_dir, kind, key, {"data.json": json_file.name})
+	finally:
+		os.remove(json_file.name)
+
+
+def entry_size(entry):
+	return sum(f.stat().st_size for f in entry.rglob("*") if f.is_file())
+
+
+def evict(cache_dir, max_bytes):
+	# Delete the least recently used entries until the cache is smaller than max_bytes
+	entries = []
+	for kind_dir in Path(cache_dir).glob("*"):
+		for entry in kind_dir.glob("*"):
+			if entry.name.startswith(".tmp-"):
+				continue
+			try:
+				entries.append((entry.stat().st_mtime, entry_size(entry), entry))
+			except FileNotFoundError:
+				continue
+	
+	total = sum(size for _, size, _ in entries)
+	for _, size, entry in sorted(entries, key=lambda e: e[0]):
+		if total <= max_bytes:
+			break
+		shutil.rmtree(entry, ignore_errors=True)
+		total -= size
+	return total
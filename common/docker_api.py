@@ -0,0 +1,185 @@
+import contextlib
+import http.client
+import json
+import os
+import socket
+import threading
+import urllib.parse
+
+# Minimal client for the Docker Engine API over the unix socket of the daemon, used instead of forking
+# the docker CLI for every request. Only the standard library is needed. The socket is read from
+# $DOCKER_HOST when it is a unix:// address, otherwise the default /var/run/docker.sock is used
+
+DEFAULT_SOCKET = "/var/run/docker.sock"
+
+
+class DockerError(Exception):
+	def __init__(self, status, message):
+		super().__init__(f"Docker API error {status}: {message}")
+		self.status = status
+
+
+def socket_path():
+	host = os.environ.get("DOCKER_HOST", "")
+	if host.startswith("unix://"):
+		return host[len("unix://"):]
+	return DEFAULT_SOCKET
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+	def __init__(self, path, timeout=None):
+		super().__init__("localhost", timeout=timeout)
+		self.path = path
+
+	def connect(self):
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		if self.timeout is not None:
+			self.sock.settimeout(self.timeout)
+		self.sock.connect(self.path)
+
+
+class DockerClient:
+	# A client keeps one connection open and reuses it for the following requests, which are serialized
+	# when the client is shared between threads. Streams (Eg. events) use their own connection
+	def __init__(self, path=None, timeout=60):
+		self.path = path or socket_path()
+		self.timeout = timeout
+		self.connection = None
+		self.lock = threading.Lock()
+
+	def url(self, endpoint, params=None):
+		if params:
+			params = {name: json.dumps(value) if isinstance(value, (dict, list)) else value for name, value in params.items()}
+			endpoint += "?" + urllib.parse.urlencode(params)
+		return endpoint
+
+	def open(self, method, endpoint, params=None, body=None, connection=None):
+		# Sends the request and returns the response, raising DockerError for error statuses
+		connection = connection or self.connection
+		if connection is None:
+			connection = self.connection = UnixHTTPConnection(self.path, self.timeout)
+		headers = {"Content-Type": "application/json"} if body is not None else {}
+		data = json.dumps(body) if body is not None else None
+		try:
+			connection.request(method, self.url(endpoint, params), body=data, headers=headers)
+			response = connection.getresponse()
+		except (http.client.HTTPException, ConnectionError):
+			# The daemon closed the kept-alive connection, retry once with a new one
+			connection.close()
+			connection.request(method, self.url(endpoint, params), body=data, headers=headers)
+			response = connection.getresponse()
+		if response.status >= 400:
+			content = response.read().decode(errors="replace")
+			try:
+				message = json.loads(content).get("message", content)
+			except json.JSONDecodeError:
+				message = content
+			raise DockerError(response.status, message)
+		return response
+
+	def request(self, method, endpoint, params=None, body=None):
+		# Returns the decoded JSON body, or None if it is empty
+		with self.lock:
+			response = self.open(method, endpoint, params, body)
+			content = response.read()
+		return json.loads(content) if content else None
+
+	@contextlib.contextmanager
+	def stream(self, method, endpoint, params=None):
+		# Response of a streamed request (Eg. an image archive) on a new connection, closed at the end of the with block
+		connection = UnixHTTPConnection(self.path, timeout=None)
+		try:
+			yield self.open(method, endpoint, params, connection=connection)
+		finally:
+			connection.close()
+
+	def stream_json(self, endpoint, params=None, method="GET"):
+		# Generator of the JSON objects of a streamed response (Eg. events, pull progress), on a new connection
+		with self.stream(method, endpoint, params) as response:
+			decoder = json.JSONDecoder()
+			buffer = ""
+			while True:
+				chunk = response.read1(64 * 1024) if hasattr(response, "read1") else response.read(64 * 1024)
+				if not chunk:
+					break
+				buffer += chunk.decode(errors="replace")
+				while True:
+					buffer = buffer.lstrip()
+					if not buffer:
+						break
+					try:
+						value, end = decoder.raw_decode(buffer)
+					except json.JSONDecodeError:
+						break
+					buffer = buffer[end:]
+					yield value
+
+	def close(self):
+		if self.connection:
+			self.connection.close()
+			self.connection = None
+
+	# System
+
+	def info(self):
+		return self.request("GET", "/info")
+
+	# Containers
+
+	def list_containers(self, all_containers=False, filters=None):
+		params = {"all": "1" if all_containers else "0"}
+		if filters:
+			params["filters"] = filters
+		return self.request("GET", "/containers/json", params)
+
+	def inspect_container(self, container):
+		return self.request("GET", f"/containers/{urllib.parse.quote(container)}/json")
+
+	# Images
+
+	def inspect_image(self, image):
+		# Lookup by reference (name:tag, id or digest), raises DockerError with status 404 if the image is not local
+		return self.request("GET", f"/images/{urllib.parse.quote(image, safe='')}/json")
+
+	def pull_image(self, image):
+		# Generator of the progress messages, the errors of the pull are raised as DockerError
+		repository, tag = split_reference(image)
+		params = {"fromImage": repository, "tag": tag} if tag else {"fromImage": image}
+		for message in self.stream_json("/images/create", params, method="POST"):
+			if message.get("error"):
+				raise DockerError(500, message["error"])
+			yield message
+
+	def save_image(self, image):
+		# Context manager returning the stream of the image archive, in the 'docker save' format
+		return self.stream("GET", f"/images/{urllib.parse.quote(image, safe='')}/get")
+
+	def remove_image(self, image):
+		return self.request("DELETE", f"/images/{urllib.parse.quote(image, safe='')}")
+
+	def events(self, filters=None, since=None):
+		params = {}
+		if filters:
+			params["filters"] = filters
+		if since is not None:
+			params["since"] = str(since)
+		return self.stream_json("/events", params)
+
+
+def split_reference(image):
+	# Repository and tag of an image reference (the tag is None for a digest), the port of a registry is not a tag
+	if "@" in image:
+		return image.split("@", 1)[0], None
+	repository, _, tag = image.rpartition(":")
+	if not repository or "/" in tag:
+		return image, "latest"
+	return repository, tag
+
+
+def container_ip(container_info):
+	# First IP address of the container, from either the list or the inspect format
+	networks = (container_info.get("NetworkSettings") or {}).get("Networks") or {}
+	for network in networks.values():
+		if network.get("IPAddress"):
+			return network["IPAddress"]
+	return ""
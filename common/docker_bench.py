@@ -0,0 +1,183 @@
+import argparse
+import functools
+import hashlib
+import json
+import os
+import re
+import socket
+from pathlib import Path
+
+from common import cache, docker_api, metrics
+
+# docker-bench-security is run with its JSON log (-l <file> also writes <file>.json), which is parsed into
+# the reports. The checks are split by scope: the host checks (sections 1, 2, 3, 6 and 7) only depend on the
+# host and on the Docker daemon configuration, so with a cache folder their results are reused for every
+# image and container of the host until the daemon configuration changes. The image and container checks
+# (sections 4 and 5) are cached on the image id or on the container configuration
+
+HOST_SECTIONS = {
+	"1": "host_configuration",
+	"2": "docker_daemon_configuration",
+	"3": "docker_daemon_files",
+	"6": "docker_security_operations",
+	"7": "docker_swarm_configuration"
+}
+TARGET_SECTIONS = {
+	"4": "container_images",
+	"5": "container_runtime"
+}
+
+# Fields of the daemon info describing its configuration, the others (Eg. the number of containers) change all the time
+INFO_FIELDS = ("Name", "ServerVersion", "KernelVersion", "OperatingSystem", "Driver", "LoggingDriver", "CgroupDriver", "CgroupVersion",
+	"DefaultRuntime", "Runtimes", "SecurityOptions", "LiveRestoreEnabled", "ExperimentalBuild", "RegistryConfig", "Swarm")
+
+# Ids of the single checks, Eg. check_2_1 or check_c_5_3
+CHECK_ID = re.compile(r"^check_[0-9a-z_]+$")
+
+# Configuration files of the daemon read by the host checks
+DAEMON_FILES = ("/etc/docker/daemon.json", "/etc/default/docker", "/etc/sysconfig/docker", "/lib/systemd/system/docker.service")
+
+
+def check_section(check):
+	# Section number of a docker-bench check or section name (Eg. check_5_1 or container_runtime), None if unknown
+	if check.startswith("check_"):
+		return check.split("_")[1]
+	for number, name in {**HOST_SECTIONS, **TARGET_SECTIONS}.items():
+		if check in (name, number):
+			return number
+	return None
+
+
+def parse_checks(value):
+	# Type of the --docker_bench_checks option. docker-bench -c only takes section names and check ids,
+	# so the section numbers (Eg. 4) are replaced with the section name (container_images)
+	sections = {**HOST_SECTIONS, **TARGET_SECTIONS}
+	checks = []
+	for check in value.split(","):
+		check = check.strip()
+		if check in sections:
+			checks.append(sections[check])
+		elif check in sections.values() or CHECK_ID.match(check):
+			checks.append(check)
+		else:
+			raise argparse.ArgumentTypeError(f"unknown docker-bench section or check '{check}', use a section name or number "
+				f"({', '.join(f'{number}: {name}' for number, name in sorted(sections.items()))}) or a check id (Eg. check_4_1)")
+	return checks
+
+
+def split_checks(checks):
+	# Returns the host checks and the image or container checks
+	host_checks = [check for check in checks if check_section(check) in HOST_SECTIONS]
+	return host_checks, [check for check in checks if check not in host_checks]
+
+
+@functools.lru_cache(maxsize=None)
+def bench_version(docker_bench_path):
+	# Hash of the scripts of docker-bench: the cached results are not used after an update
+	digest = hashlib.sha256()
+	for script in sorted(Path(docker_bench_path).rglob("*.sh")):
+		digest.update(script.name.encode())
+		digest.update(script.read_bytes())
+	return digest.hexdigest()
+
+
+def daemon_inputs(client=None):
+	# What the host checks depend on: the host, the daemon configuration and its files
+	inputs = {"host": socket.gethostname(), "content_trust": os.environ.get("DOCKER_CONTENT_TRUST", "")}
+	try:
+		info = (client or docker_api.DockerClient()).info()
+		inputs["daemon"] = {field: info.get(field) for field in INFO_FIELDS}
+		if isinstance(inputs["daemon"]["Swarm"], dict):
+			inputs["daemon"]["Swarm"] = inputs["daemon"]["Swarm"].get("LocalNodeState")
+	except (OSError, docker_api.DockerError):
+		inputs["daemon"] = None
+	for filepath in DAEMON_FILES:
+		try:
+			inputs[filepath] = hashlib.sha256(Path(filepath).read_bytes()).hexdigest()
+		except OSError:
+			inputs[filepath] = None
+	return inputs
+
+
+@metrics.timed("parse_docker_bench")
+def parse_log(json_path):
+	# Sections of the JSON log, each one with its results (id, desc, result, details, items, remediation)
+	try:
+		with open(json_path, "r") as json_file:
+			return json.load(json_file).get("tests", [])
+	except (OSError, json.JSONDecodeError):
+		return []
+
+
+def run(docker_bench_path, checks, log_path, include=None):
+	# docker-bench is run from its own folder with cwd instead of os.chdir,
+	# because the working directory is shared with the other stages running in parallel
+	command = ["sh", "docker-bench-security.sh", "-b", "-p", "-c", ",".join(checks), "-l", str(log_path)]
+	if include:
+		command += ["-i", include]
+	metrics.run(command, "docker_bench", capture_output=True, cwd=docker_bench_path)
+	sections = parse_log(f"{log_path}.json")
+
+	# Remove unnecessary output files, the results are written in the report
+	for filepath in (log_path, f"{log_path}.json"):
+		if os.path.exists(filepath):
+			os.remove(filepath)
+	return sections
+
+
+def run_cached(docker_bench_path, checks, log_path, include, inputs, cache_dir=None, max_age=None):
+	# Returns the sections and True if they come from the cache. inputs is everything the checks depend on
+	if not checks:
+		return [], False
+	if not cache_dir:
+		return run(docker_bench_path, checks, log_path, include), False
+
+	key = cache.cache_key("docker_bench", sorted(checks), include, inputs, bench_version(docker_bench_path))
+	sections = cache.load_json(cache_dir, "docker_bench", key, max_age)
+	if sections is not None:
+		return sections, True
+	sections = run(docker_bench_path, checks, log_path, include)
+	if sections:
+		cache.store_json(cache_dir, "docker_bench", key, sections)
+	return sections, False
+
+
+def host_analysis(docker_bench_path, checks, outfolder, cache_dir=None, max_age=None, client=None):
+	# Runs the host checks in checks, the others are ignored. Returns the sections and True if they come from the cache
+	host_checks, _ = split_checks(checks)
+	inputs = daemon_inputs(client) if host_checks and cache_dir else None
+	return run_cached(docker_bench_path, host_checks, Path(outfolder).resolve() / "docker_bench_host", None, inputs, cache_dir, max_age)
+
+
+def target_analysis(docker_bench_path, checks, include, target_inputs, outfolder, cache_dir=None, max_age=None, client=None):
+	# Runs the image or container checks in checks on the targets matching include. target_inputs is what
+	# the checks read from the image or the container (Eg. the image id, the container configuration)
+	_, target_checks = split_checks(checks)
+	inputs = {"daemon": daemon_inputs(client), "target": target_inputs} if target_checks and cache_dir else None
+	return run_cached(docker_bench_path, target_checks, Path(outfolder).resolve() / "docker_bench", include, inputs, cache_dir, max_age)
+
+
+def sort_sections(sections):
+	return sorted(sections, key=lambda section: [int(part) if part.isdigit() else part for part in str(section.get("id", "")).split(".")])
+
+
+def summarize(sections):
+	# Number of results of each kind (PASS, WARN, INFO, NOTE) and the checks with a warning
+	summary = {"results": {}, "warnings": []}
+	for section in sort_sections(sections):
+		for result in section.get("results", []):
+			outcome = result.get("result", "")
+			summary["results"][outcome] = summary["results"].get(outcome, 0) + 1
+			if outcome == "WARN":
+				warning = {"id": result.get("id"), "desc": result.get("desc")}
+				if result.get("items"):
+					warning["items"] = result["items"]
+				summary["warnings"].append(warning)
+	return summary
+
+
+def write_log(sections, json_path):
+	# The sections of the host and target checks in the same layout as the docker-bench JSON log
+	sections = sort_sections(sections)
+	with open(json_path, "w") as json_file:
+		json.dump({"tests": sections, "checks": sum(len(section.get("results", [])) for section in sections)}, json_file, indent=4)
@@ -0,0 +1,348 @@
+import bisect
+import collections
+import contextlib
+import contextvars
+import functools
+import os
+import resource
+import subprocess
+import threading
+import time
+
+# Timing and resource usage of the stages, the external tools and the parsers, recorded as named spans.
+# A span measures the wall-clock time and the CPU time and disk I/O of its thread; the tools are run with
+# run(), which reaps the child process with os.wait4 and adds its resource usage to the span of the tool and
+# to the spans enclosing it. The enclosing spans are kept in a context variable, so they are also seen by
+# asyncio tasks and by the threads started with submit(). The spans go in the JSON reports and can be written
+# in the Prometheus text format; the long-running observer also uses the Histogram and Rate classes
+
+# Per-thread resource usage is Linux only, elsewhere the spans only have the usage of the child processes
+RUSAGE_THREAD = getattr(resource, "RUSAGE_THREAD", None)
+
+# ru_inblock and ru_oublock count 512 bytes blocks
+BLOCK_SIZE = 512
+
+# Buckets (seconds) of the histograms, from a quick event to a slow scan
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+PREFIX = "container_security"
+
+current_spans = contextvars.ContextVar("current_spans", default=())
+
+
+def thread_usage():
+	return resource.getrusage(RUSAGE_THREAD) if RUSAGE_THREAD is not None else None
+
+
+class Span:
+	def __init__(self, name, kind, labels, start):
+		self.name = name
+		self.kind = kind
+		self.labels = labels
+		self.start = start
+		self.duration = 0.0
+		self.cpu_user = 0.0
+		self.cpu_system = 0.0
+		self.max_rss_kb = 0
+		self.read_bytes = 0
+		self.write_bytes = 0
+		self.processes = 0
+		self.exit_code = None
+		self.lock = threading.Lock()
+
+	def add_usage(self, usage, child=False):
+		# usage is a difference of thread rusage, or the rusage of a child process
+		with self.lock:
+			self.cpu_user += usage.ru_utime
+			self.cpu_system += usage.ru_stime
+			self.read_bytes += usage.ru_inblock * BLOCK_SIZE
+			self.write_bytes += usage.ru_oublock * BLOCK_SIZE
+			if child:
+				self.processes += 1
+				self.max_rss_kb = max(self.max_rss_kb, usage.ru_maxrss)
+
+	def to_dict(self):
+		span = {
+			"name": self.name,
+			"kind": self.kind,
+			"start": round(self.start, 3),
+			"duration": round(self.duration, 3),
+			"cpu_user": round(self.cpu_user, 3),
+			"cpu_system": round(self.cpu_system, 3),
+			"max_rss_kb": self.max_rss_kb,
+			"read_bytes": self.read_bytes,
+			"write_bytes": self.write_bytes,
+			"processes": self.processes
+		}
+		if self.labels:
+			span["labels"] = self.labels
+		if self.exit_code is not None:
+			span["exit_code"] = self.exit_code
+		return span
+
+
+class UsageDelta:
+	# Difference between two thread rusage readings, with the fields used by Span.add_usage
+	def __init__(self, before, after):
+		self.ru_utime = after.ru_utime - before.ru_utime
+		self.ru_stime = after.ru_stime - before.ru_stime
+		self.ru_inblock = after.ru_inblock - before.ru_inblock
+		self.ru_oublock = after.ru_oublock - before.ru_oublock
+
+
+class Recorder:
+	# The spans of a scan. The spans are kept in the order they end, their start is relative to the recorder start
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.reset()
+
+	def reset(self):
+		with self.lock:
+			self.origin = time.perf_counter()
+			self.spans = []
+
+	@contextlib.contextmanager
+	def span(self, name, kind="stage", **labels):
+		current = Span(name, kind, labels, time.perf_counter() - self.origin)
+		before = thread_usage()
+		token = current_spans.set(current_spans.get() + (current,))
+		try:
+			yield current
+		finally:
+			current_spans.reset(token)
+			current.duration = time.perf_counter() - self.origin - current.start
+			after = thread_usage()
+			if before is not None:
+				current.add_usage(UsageDelta(before, after))
+			if not current.processes:
+				# Without child processes the peak memory is the one of this process
+				current.max_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+			with self.lock:
+				self.spans.append(current)
+
+	def report(self):
+		# The spans, and the totals of the spans with the same kind and name
+		with self.lock:
+			spans = [span.to_dict() for span in self.spans]
+		return {"spans": spans, "totals": totals(spans)}
+
+
+class MeasuredPopen(subprocess.Popen):
+	# Popen reaping the child with os.wait4, which also returns the resource usage of the child
+	rusage = None
+
+	def _try_wait(self, wait_flags):
+		if not hasattr(os, "wait4"):
+			return super()._try_wait(wait_flags)
+		try:
+			pid, status, rusage = os.wait4(self.pid, wait_flags)
+		except ChildProcessError:
+			return self.pid, 0
+		if pid == self.pid:
+			self.rusage = rusage
+		return pid, status
+
+
+recorder = Recorder()
+
+
+def reset():
+	recorder.reset()
+
+
+def span(name, kind="stage", **labels):
+	return recorder.span(name, kind, **labels)
+
+
+def report():
+	return recorder.report()
+
+
+def timed(name, kind="parser"):
+	# Decorator recording each call of the function as a span
+	def decorator(function):
+		@functools.wraps(function)
+		def wrapper(*args, **kwargs):
+			with span(name, kind):
+				return function(*args, **kwargs)
+		return wrapper
+	return decorator
+
+
+def submit(executor, function, *args):
+	# executor.submit keeping the enclosing spans, so the tools run by the thread are also counted in them.
+	# Each call gets its own copy of the context, a context can't be entered by two threads at once
+	return executor.submit(contextvars.copy_context().run, function, *args)
+
+
+def tool_name(command):
+	first = command.split()[0] if isinstance(command, str) else str(command[0])
+	return os.path.basename(first)
+
+
+def run(command, name=None, input=None, capture_output=False, timeout=None, check=False, **kwargs):
+	# subprocess.run in a "tool" span named after the command, with the resource usage of the child process
+	if capture_output:
+		kwargs["stdout"] = subprocess.PIPE
+		kwargs["stderr"] = subprocess.PIPE
+	if input is not None:
+		kwargs["stdin"] = subprocess.PIPE
+
+	with span(name or tool_name(command), "tool") as current:
+		process = MeasuredPopen(command, **kwargs)
+		try:
+			# On exit Popen waits for the process, also after it has been killed
+			with process:
+				try:
+					stdout, stderr = process.communicate(input, timeout=timeout)
+				except BaseException:
+					process.kill()
+					raise
+		finally:
+			current.exit_code = process.returncode
+			if process.rusage is not None:
+				for enclosing in current_spans.get():
+					enclosing.add_usage(process.rusage, child=True)
+	returncode = process.returncode
+
+	if check and returncode:
+		raise subprocess.CalledProcessError(returncode, process.args, stdout, stderr)
+	return subprocess.CompletedProcess(process.args, returncode, stdout, stderr)
+
+
+def totals(spans):
+	# By kind and name, a stage and a tool can have the same name (Eg. the trivy stage runs the trivy tool)
+	summary = {}
+	for span_info in spans:
+		total = summary.setdefault(span_info["kind"], {}).setdefault(span_info["name"], {"count": 0, "duration": 0, "cpu_user": 0, "cpu_system": 0,
+			"max_rss_kb": 0, "read_bytes": 0, "write_bytes": 0})
+		total["count"] += 1
+		for field in ("duration", "cpu_user", "cpu_system"):
+			total[field] = round(total[field] + span_info[field], 3)
+		for field in ("read_bytes", "write_bytes"):
+			total[field] += span_info[field]
+		total["max_rss_kb"] = max(total["max_rss_kb"], span_info["max_rss_kb"])
+	return summary
+
+
+class Histogram:
+	# Cumulative histogram in the Prometheus layout, observations are in seconds
+	def __init__(self, buckets=DEFAULT_BUCKETS):
+		self.buckets = sorted(buckets)
+		self.counts = [0] * (len(self.buckets) + 1)
+		self.sum = 0.0
+		self.count = 0
+		self.lock = threading.Lock()
+
+	def observe(self, value):
+		with self.lock:
+			self.counts[bisect.bisect_left(self.buckets, value)] += 1
+			self.sum += value
+			self.count += 1
+
+	def quantile(self, q):
+		# Upper bound of the bucket holding the q quantile, None without observations
+		with self.lock:
+			if not self.count:
+				return None
+			rank = q * self.count
+			seen = 0
+			for bound, count in zip(self.buckets, self.counts):
+				seen += count
+				if seen >= rank:
+					return bound
+			return float("inf")
+
+	def stats(self):
+		return {
+			"count": self.count,
+			"mean": round(self.sum / self.count, 3) if self.count else None,
+			"p50": self.quantile(0.5),
+			"p90": self.quantile(0.9),
+			"p99": self.quantile(0.99)
+		}
+
+	def samples(self, labels=None):
+		labels = labels or {}
+		with self.lock:
+			cumulative = 0
+			samples = []
+			for bound, count in zip(self.buckets + [float("inf")], self.counts):
+				cumulative += count
+				samples.append(("_bucket", {**labels, "le": "+Inf" if bound == float("inf") else repr(bound)}, cumulative))
+			samples += [("_sum", labels, round(self.sum, 6)), ("_count", labels, self.count)]
+		return samples
+
+
+class Rate:
+	# Events per second over the last window seconds, counted in one second slots
+	def __init__(self, window=60):
+		self.window = window
+		self.slots = collections.deque()
+
+	def mark(self, count=1):
+		now = int(time.monotonic())
+		if self.slots and self.slots[-1][0] == now:
+			self.slots[-1][1] += count
+		else:
+			self.slots.append([now, count])
+		self.expire(now)
+
+	def expire(self, now):
+		while self.slots and self.slots[0][0] <= now - self.window:
+			self.slots.popleft()
+
+	def per_second(self):
+		self.expire(int(time.monotonic()))
+		return round(sum(count for _, count in self.slots) / self.window, 3)
+
+
+def escape(value):
+	return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def metric_lines(name, kind, help_text, samples):
+	# samples is a list of (suffix, labels, value). Returns the lines of a metric in the Prometheus text format
+	lines = [f"# HELP {PREFIX}_{name} {help_text}", f"# TYPE {PREFIX}_{name} {kind}"]
+	for suffix, labels, value in samples:
+		label_text = ",".join(f'{key}="{escape(label)}"' for key, label in labels.items())
+		lines.append(f"{PREFIX}_{name}{suffix}{{{label_text}}} {value}" if label_text else f"{PREFIX}_{name}{suffix} {value}")
+	return lines
+
+
+def prometheus_text(entries):
+	# entries is a list of (labels, spans), Eg. ({"image": "nginx:latest"}, the spans of its report).
+	# The spans with the same name, kind and labels are summed
+	series = {}
+	for labels, spans in entries:
+		for span_info in spans:
+			series_labels = {**labels, **span_info.get("labels", {}), "span": span_info["name"], "kind": span_info["kind"]}
+			key = tuple(sorted(series_labels.items()))
+			total = series.setdefault(key, {"labels": series_labels, "count": 0, "duration": 0, "cpu_user": 0, "cpu_system": 0,
+				"max_rss_kb": 0, "read_bytes": 0, "write_bytes": 0})
+			total["count"] += 1
+			for field in ("duration", "cpu_user", "cpu_system", "read_bytes", "write_bytes"):
+				total[field] += span_info[field]
+			total["max_rss_kb"] = max(total["max_rss_kb"], span_info["max_rss_kb"])
+
+	series = list(series.values())
+	lines = []
+	lines += metric_lines("span_count", "gauge", "Number of spans (runs of a stage, tool or parser)",
+		[("", total["labels"], total["count"]) for total in series])
+	lines += metric_lines("span_duration_seconds", "gauge", "Wall-clock time of the spans",
+		[("", total["labels"], round(total["duration"], 3)) for total in series])
+	lines += metric_lines("span_cpu_seconds", "gauge", "CPU time of the spans, including their child processes",
+		[("", {**total["labels"], "mode": mode}, round(total[f"cpu_{mode}"], 3)) for total in series for mode in ("user", "system")])
+	lines += metric_lines("span_max_rss_bytes", "gauge", "Peak resident memory of the tools, or of the script for the spans without tools",
+		[("", total["labels"], total["max_rss_kb"] * 1024) for total in series])
+	lines += metric_lines("span_disk_bytes", "gauge", "Bytes read and written on disk by the spans",
+		[("", {**total["labels"], "direction": direction}, total[f"{direction}_bytes"]) for total in series for direction in ("read", "write")])
+	return "\n".join(lines) + "\n"
+
+
+def write_text(path, text):
+	# Written in a temporary file and renamed, so a collector never reads a partial file (Eg. node_exporter's textfile collector)
+	tmp_path = f"{path}.tmp"
+	with open(tmp_path, "w") as text_file:
+		text_file.write(text)
+	os.replace(tmp_path, path)
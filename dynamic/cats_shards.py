@@ -0,0 +1,112 @@
+import glob
+import json
+import os
+import re
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from common import metrics
+
+# CATS fuzzes the paths of the specification one after the other, so on large APIs the paths are split
+# in groups (by their first segment, Eg. /pet and /pet/{petId}) and the groups are assigned to several
+# CATS processes running at the same time against the same server, each one with --paths and its own
+# output folder. The test cases of all the shards are summed up in a single summary by path
+
+# Lines of a YAML specification: the top level paths key and the keys under it
+YAML_PATHS_KEY = re.compile(r"^paths\s*:\s*$")
+YAML_PATH = re.compile(r"^(\s+)['\"]?(/[^'\"]*?)['\"]?\s*:")
+
+
+def api_paths(apispec):
+	# Paths of an OpenAPI specification in JSON or YAML. YAML is not parsed, only the keys under paths are read
+	with open(apispec, "r") as spec_file:
+		content = spec_file.read()
+	try:
+		return list(json.loads(content).get("paths", {}))
+	except json.JSONDecodeError:
+		pass
+
+	paths = []
+	in_paths = False
+	indent = None
+	for line in content.splitlines():
+		if not line.strip() or line.lstrip().startswith("#"):
+			continue
+		if not line[0].isspace():
+			in_paths = bool(YAML_PATHS_KEY.match(line))
+			continue
+		match = YAML_PATH.match(line)
+		if in_paths and match and (indent is None or len(match.group(1)) == indent):
+			indent = len(match.group(1))
+			paths.append(match.group(2))
+	return paths
+
+
+def path_groups(paths):
+	groups = {}
+	for path in paths:
+		groups.setdefault(path.strip("/").split("/")[0], []).append(path)
+	return list(groups.values())
+
+
+def make_shards(groups, count):
+	# Groups are assigned by number of paths, the largest first, to the shard with the fewest paths
+	count = max(1, min(count, len(groups)))
+	shards = [[] for _ in range(count)]
+	for group in sorted(groups, key=len, reverse=True):
+		min(shards, key=len).extend(group)
+	return [shard for shard in shards if shard]
+
+
+def run_cats(cats_path, apispec, server, output, paths=None, log_path=None):
+	command = ["java", "-jar", f"{cats_path}/cats.jar", "--contract", apispec, "--server", server, "--output", output]
+	if paths:
+		command.append("--paths=" + ",".join(paths))
+	if log_path:
+		with open(log_path, "w") as log:
+			return metrics.run(command, "cats", stdout=log, stderr=subprocess.STDOUT).returncode
+	return metrics.run(command, "cats").returncode
+
+
+def run_shards(cats_path, apispec, server, output, shards, log_prefix):
+	# Returns the exit code of each shard, shard i writes its report in output/shard_i and its console output in {log_prefix}_i.log
+	jobs = [(paths, f"{output}/shard_{i}", f"{log_prefix}_{i}.log") for i, paths in enumerate(shards, 1)]
+	with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+		futures = [metrics.submit(executor, run_cats, cats_path, apispec, server, shard_output, paths, log_path) for paths, shard_output, log_path in jobs]
+		return [future.result() for future in futures]
+
+
+def read_test_cases(folder):
+	# Test cases of a CATS report folder, one JSON file per test case
+	test_cases = []
+	for filepath in sorted(glob.glob(f"{folder}/**/*.json", recursive=True)):
+		try:
+			with open(filepath, "r") as json_file:
+				test_case = json.load(json_file)
+		except (OSError, json.JSONDecodeError, UnicodeDecodeError):
+			continue
+		if isinstance(test_case, dict) and "result" in test_case:
+			test_case["reportFile"] = os.path.relpath(filepath, folder)
+			test_cases.append(test_case)
+	return test_cases
+
+
+@metrics.timed("merge_cats_reports")
+def merge_reports(output):
+	# Counts of the results of all the test cases in output (and its shard folders), and the failures by path.
+	# The summary is written in output/summary.json
+	summary = {"tests": 0, "results": {}, "failuresByPath": {}}
+	for test_case in read_test_cases(output):
+		result = str(test_case.get("result", "")).lower()
+		summary["tests"] += 1
+		summary["results"][result] = summary["results"].get(result, 0) + 1
+		if result not in ("success", "skipped"):
+			path = test_case.get("contractPath") or test_case.get("path") or "unknown"
+			failures = summary["failuresByPath"].setdefault(path, {})
+			failures[result] = failures.get(result, 0) + 1
+	summary["failuresByPath"] = dict(sorted(summary["failuresByPath"].items(), key=lambda item: -sum(item[1].values())))
+
+	if os.path.isdir(output):
+		with open(f"{output}/summary.json", "w") as json_file:
+			json.dump(summary, json_file, indent=4)
+	return summary
@@ -1,101 +1,255 @@
 import argparse
 import sys
-import subprocess
 import os
+import re
+import json
+import fnmatch
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+
+# The modules shared by the analysis scripts are in the common folder
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common import cache, docker_api, docker_bench, metrics
+
+import cats_shards
+
+# Fields of the container inspection read by the container runtime checks of docker-bench
+RUNTIME_FIELDS = ("Id", "Config", "HostConfig", "Mounts", "AppArmorProfile", "ProcessLabel")
+
+def container_inputs(client, container_id):
+	# The container configuration the runtime checks depend on, their cached results are used while it doesn't change
+	container_info = client.inspect_container(container_id)
+	inputs = {field: container_info.get(field) for field in RUNTIME_FIELDS}
+	inputs["Ports"] = (container_info.get("NetworkSettings") or {}).get("Ports")
+	inputs["Health"] = ((container_info.get("State") or {}).get("Health") or {}).get("Status")
+	return inputs
+
+
+def docker_bench_analysis(name, inputs, outfolder, host_bench, options):
+	# host_bench is the result of the host checks, which are run once for all the containers
+	print(f"\033[1;32m\nStarting Docker-bench-security analysis of {name}\033[0m")
+
+	cache_dir = options.cache_dir if options.cache else None
+	sections, cached = docker_bench.target_analysis(options.docker_bench_path, options.docker_bench_checks, name, inputs, outfolder,
+		cache_dir, options.cache_max_age * 3600)
+	host_sections, host_cached = host_bench
+	docker_bench.write_log(host_sections + sections, f"{outfolder}/docker_bench.json")
+
+	summary = docker_bench.summarize(host_sections + sections)
+	summary["checks"] = options.docker_bench_checks
+	summary["cached"] = [scope for scope, is_cached in (("host", host_cached), ("container", cached)) if is_cached]
+	print(f"Done: docker-bench {name}")
+	return summary
+
+
+def cats_analysis(container_ip, options, outfolder, multiple):
+	server = options.protocol + "://" + container_ip + ":" + options.port + "/" + options.prefix
+	output = f"{outfolder}/cats_report"
+
+	# The paths of the specification can be split between several CATS processes
+	shards = []
+	if options.cats_shards > 1:
+		try:
+			shards = cats_shards.make_shards(cats_shards.path_groups(cats_shards.api_paths(options.apispec)), options.cats_shards)
+		except OSError as ex:
+			print(f"\033[1;38;5;214mWarning: Cannot read the paths of {options.apispec} ({ex}), CATS runs as a single process\033[0m")
+
+	# The test cases left by a previous run would be counted in the summary
+	shutil.rmtree(output, ignore_errors=True)
+	if len(shards) > 1:
+		print(f"Running {len(shards)} CATS processes, their output is in {outfolder}/cats_<shard>.log")
+		returncodes = cats_shards.run_shards(options.cats_path, options.apispec, server, output, shards, f"{outfolder}/cats")
+	else:
+		# With several containers the output of CATS goes to a log file in the folder of the container
+		returncodes = [cats_shards.run_cats(options.cats_path, options.apispec, server, output, log_path=f"{outfolder}/cats.log" if multiple else None)]
+
+	summary = cats_shards.merge_reports(output)
+	return {"report": str(Path(output).resolve()), "exitCode": max(returncodes), "shards": max(len(shards), 1), "summary": summary}
+
+
+def container_name(container_info):
+	# The list format of the API has the names with a leading slash
+	return (container_info.get("Names") or [""])[0].lstrip("/")
+
+
+def find_containers(client, names, labels):
+	# All the running containers matching the label selectors are listed with a single API call,
+	# then filtered by name: names can be exact names, glob patterns (Eg. shop-*) or id prefixes
+	filters = {"status": ["running"]}
+	if labels:
+		filters["label"] = labels
+	containers = client.list_containers(filters=filters)
+	if names:
+		containers = [c for c in containers if any(fnmatch.fnmatchcase(container_name(c), pattern) or c["Id"].startswith(pattern) for pattern in names)]
+		for pattern in names:
+			if not any(char in pattern for char in "*?[") and not any(pattern in (container_name(c), c["Id"][:len(pattern)]) for c in containers):
+				print(f"\033[1;38;5;214mWarning: Container {pattern} is not running\033[0m")
+	return sorted(containers, key=container_name)
+
+
+def analyze_container(container_info, outfolder, client, host_bench, options, multiple):
+	name = container_name(container_info)
+	if not os.path.exists(outfolder):
+		os.makedirs(outfolder)
+	entry = {
+		"containerName": name,
+		"containerId": container_info["Id"],
+		"image": container_info.get("Image", ""),
+		"reportFolder": str(Path(outfolder).resolve())
+	}
+
+	# Docker-bench analysis
+	inputs = container_inputs(client, container_info["Id"]) if options.cache else None
+	with metrics.span("docker_bench", container=name):
+		entry["dockerBench"] = docker_bench_analysis(name, inputs, outfolder, host_bench, options)
+
+	# REST API Analysis with CATS
+	if options.apispec:
+		print(f"\033[1;32m\nStarting CATS analysis of {name}\033[0m")
+		container_ip = docker_api.container_ip(container_info)
+		with metrics.span("cats", container=name):
+			entry["cats"] = cats_analysis(container_ip, options, outfolder, multiple)
+		results = entry["cats"]["summary"]["results"]
+		print(f"Done: CATS {name}, {entry['cats']['summary']['tests']} tests: {results.get('error', 0)} errors, {results.get('warn', 0)} warnings")
+	return entry
+
+
+def generate_report(results, outfolder, metrics_file=None):
+	data = {
+		"containers": len(results),
+		"failed": len([entry for entry in results if entry["status"] == "failed"]),
+		"results": results,
+		# Time, CPU, peak memory and disk I/O of the analysis of each container and of the tools
+		"metrics": metrics.report()
+	}
+	with open(f"{outfolder}/dynamicReport.json", "w") as json_file:
+		json.dump(data, json_file, indent=4)
+	if metrics_file:
+		metrics.write_text(metrics_file, metrics.prometheus_text([({}, data["metrics"]["spans"])]))
 
-def docker_bench_analysis(name, docker_bench_path, outfolder):
-	print(f"\033[1;32m\nStarting Docker-bench-security analysis\033[0m")
-	
-	main_directory = os.getcwd()
-	os.chdir(docker_bench_path)
-	subprocess.run(f"sh docker-bench-security.sh -b -p -i {name} -c container_runtime -l {main_directory}/{outfolder}/docker_bench", 
-		shell=True, capture_output=True)
-		
-	# Remove unnecessary output file
-	subprocess.run(f"rm {main_directory}/{outfolder}/docker_bench", shell=True)
-	os.chdir(main_directory)
-	print("Done")
-	
 
 def main():
-	# Create the argument parser	
-	parser = argparse.ArgumentParser(allow_abbrev=False,  formatter_class=argparse.RawDescriptionHelpFormatter, 
+	# Create the argument parser
+	parser = argparse.ArgumentParser(allow_abbrev=False,  formatter_class=argparse.RawDescriptionHelpFormatter,
 	description="This script performs a dynamic analysis on a running container leveraging section 5 (container runtime) of Docker-bench-security. "
 	"It is necessary to specify the dockerbench path with the appropriate command line arguments or environment variables. If the application has a REST API, "
 	"and an OpenAPI (Swagger) specification is given to the script, it will run CATS to do fuzzing on the API; in order to perform this analysis "
-	"it is necessary to tell the path as done with docker-bench-security, and it is also required to point out the container port number to test, and the --https option if the application supports it")
-	
-	parser.add_argument('--name', type=str, metavar="string", help="Container name (it has to be already running)", required=True)  
+	"it is necessary to tell the path as done with docker-bench-security, and it is also required to point out the container port number to test, and the --https option if the application supports it. "
+	"Several containers can be analyzed at once by giving a list of names, glob patterns or label selectors")
+
+	parser.add_argument('--name', type=lambda names: names.split(','), metavar="name1,name2", help="Container name (it has to be already running). "
+	"It can also be a comma-separated list of names or glob patterns (Eg. shop-*,db). Required unless --label is used")
+	parser.add_argument('--label', type=str, metavar="key[=value]", action='append', help="Analyze the running containers with this label "
+	"(Eg. com.docker.compose.project=shop). It can be repeated, the containers must match all the labels and --name if it is given")
+	parser.add_argument('--workers', type=int, metavar="int", default=4, help="Number of containers analyzed at the same time (Default: 4)")
 	parser.add_argument('--outfolder', type=str, metavar="string", help="Reports will be generated in this folder (Default: reports)")
 	parser.add_argument('--docker_bench_path', type=str, metavar="string", help="Path to the folder containing 'docker-bench-security.sh'. "
 	"This path can also be set with the $DOCKERBENCH_PATH variable")
+	parser.add_argument('--docker_bench_checks', type=docker_bench.parse_checks, metavar="check1,check2", default=["container_runtime"],
+	help="Comma-separated list of the docker-bench sections (by name or number) or check ids to run (Eg. container_runtime,2,check_5_1). "
+	"The host checks (sections 1, 2, 3, 6 and 7) are run once for all the containers (Default: container_runtime)")
+	parser.add_argument('--cache', action='store_true', help="Keep the docker-bench results in a local cache: the host checks are run again only when "
+	"the daemon configuration changes, and the runtime checks of a container only when its configuration changes")
+	parser.add_argument('--cache_dir', type=str, metavar="string", default=cache.DEFAULT_CACHE_DIR, help="Cache folder. "
+	"This path can also be set with the $SCAN_CACHE_DIR variable (Default: ~/.cache/container-security)")
+	parser.add_argument('--cache_max_age', type=float, metavar="hours", default=24, help="Cached docker-bench results older than this are not used (Default: 24)")
 	parser.add_argument('--cats_path', type=str, metavar="string", help="Path to the folder containing 'cats.jar'. "
 	"This path can also be set with the $CATS_PATH variable. It is only required when cats.jar is not in the same folder as this script")
-	parser.add_argument('--apispec', type=str, metavar="string", help="CATS: Path to the OpenAPI specification (Eg. /path/to/API.yaml)")
+	parser.add_argument('--apispec', type=str, metavar="string", help="CATS: Path to the OpenAPI specification (Eg. /path/to/API.yaml). "
+	"With several containers, the API of each container is tested")
 	parser.add_argument('--port', type=str, metavar="string", help="CATS: Port number to test on the container")
 	parser.add_argument('--prefix', type=str, metavar="string", help="CATS: A path prefix that will be added in front of any path in the specification")
 	parser.add_argument('--https', action='store_true', help="CATS: Use this option if the REST API supports https")
+	parser.add_argument('--cats_shards', type=int, metavar="int", default=1, help="CATS: Split the paths of the specification between this many "
+	"CATS processes testing the same container at the same time. It also caps the number of concurrent requests to the container (Default: 1)")
+	parser.add_argument('--metrics_file', type=str, metavar="file", help="Also write the time, CPU, peak memory and disk I/O of the analysis of each container "
+	"and of the tools in this file, in the Prometheus text format (Eg. in the folder of the node_exporter textfile collector). They are always in dynamicReport.json")
 
 	# Parse the arguments
 	args = parser.parse_args()
 
-	name = args.name
-	# Check if the container is running
-	ps_out = subprocess.run(f"docker ps --filter \"name={name}\" --quiet", shell=True, capture_output=True).stdout
-	if not ps_out:
-		print(f"\nError: Container {name} is not running\n")
+	if not args.name and not args.label:
+		print("\nError: Missing argument --name or --label\n")
+		parser.print_help()
+		sys.exit(1)
+
+	# Find the running containers, the container metadata is read from the Docker API
+	client = docker_api.DockerClient()
+	try:
+		containers = find_containers(client, args.name, args.label)
+	except docker_api.DockerError as ex:
+		print(f"\nError: {ex}\n")
+		sys.exit(1)
+	except OSError as ex:
+		print(f"\nError: Docker API not reachable at {client.path}: {ex}\n")
+		sys.exit(1)
+	if not containers:
+		print(f"\nError: No running container matches the given names and labels\n")
 		parser.print_help()
 		sys.exit(1)
 
 	outfolder = "report"
 	if args.outfolder:
 		outfolder = args.outfolder.rstrip('/')
-	
-	# Create report folder    
+
+	# Create report folder
 	if not os.path.exists(outfolder):
-		os.makedirs(outfolder)  
-	
+		os.makedirs(outfolder)
+
 	docker_bench_path = "/home/kali/docker-bench-security"
 	if args.docker_bench_path:
-		docker_bench_path = args.docker_bench_path.rstrip('/')	
+		docker_bench_path = args.docker_bench_path.rstrip('/')
 	elif os.environ.get("DOCKERBENCH_PATH"):
 		docker_bench_path = os.environ.get("DOCKERBENCH_PATH").rstrip('/')
-		
+	args.docker_bench_path = docker_bench_path
+
 	cats_path = "."
 	if args.cats_path:
-		cats_path = args.cats_path.rstrip('/')	
+		cats_path = args.cats_path.rstrip('/')
 	elif os.environ.get("CATS_PATH"):
 		cats_path = os.environ.get("CATS_PATH").rstrip('/')
-	
+	args.cats_path = cats_path
+
 	if args.apispec and not args.port:
 		print("\nError: Missing argument --port\n")
 		parser.print_help()
 		sys.exit(1)
 
-	# Docker-bench analysis
-	docker_bench_analysis(name, docker_bench_path, outfolder)
-	
-	# REST API Analysis with CATS
-	apispec = args.apispec
-	if apispec:
-		
-		port = args.port
-
-		prefix = ""
-		if args.prefix:
-			prefix = args.prefix.lstrip("/")
-
-		if args.https:
-			protocol = "https"
-		else:
-			protocol = "http"
-			
-		# Get container IP
-		command = "docker inspect -f '{{range.NetworkSettings.Networks}}{{.IPAddress}}{{end}}' " + name
-		container_ip = subprocess.run(command, shell=True, capture_output=True).stdout.decode('utf-8').strip()
-		
-		server = protocol + "://" + container_ip + ":" + port + "/" + prefix
-		subprocess.run(f"java -jar {cats_path}/cats.jar --contract {apispec} --server {server} --output {outfolder}/cats_report", shell=True)
+	args.prefix = args.prefix.lstrip("/") if args.prefix else ""
+	args.protocol = "https" if args.https else "http"
+
+	# A single container keeps its reports in the output folder, with several containers each one gets its own folder
+	multiple = len(containers) > 1
+	if multiple:
+		print(f"\033[1;32m\nAnalyzing {len(containers)} containers with {args.workers} workers: {', '.join(container_name(c) for c in containers)}\033[0m")
+
+	# The host checks of docker-bench don't depend on the container, they are run once before the containers are analyzed
+	with metrics.span("docker_bench_host"):
+		host_bench = docker_bench.host_analysis(args.docker_bench_path, args.docker_bench_checks, outfolder,
+			args.cache_dir if args.cache else None, args.cache_max_age * 3600, client)
+
+	results = []
+	with ThreadPoolExecutor(max_workers=args.workers) as executor:
+		futures = {}
+		for container_info in containers:
+			container_outfolder = f"{outfolder}/" + re.sub(r"[^A-Za-z0-9_.-]", "_", container_name(container_info)) if multiple else outfolder
+			futures[executor.submit(analyze_container, container_info, container_outfolder, client, host_bench, args, multiple)] = (container_info, container_outfolder)
+		for future in as_completed(futures):
+			container_info, container_outfolder = futures[future]
+			try:
+				entry = future.result()
+				entry["status"] = "done"
+			except Exception as ex:
+				print(f"\033[1;91mFailed: {container_name(container_info)}: {ex}\033[0m")
+				entry = {"containerName": container_name(container_info), "containerId": container_info["Id"],
+					"reportFolder": str(Path(container_outfolder).resolve()), "status": "failed"}
+			results.append(entry)
+
+	generate_report(sorted(results, key=lambda entry: entry["containerName"]), outfolder, args.metrics_file)
+	print("\nReport generated at " + str(Path(f"{outfolder}/dynamicReport.json").resolve()))
+	if args.metrics_file:
+		print("Metrics written at " + str(Path(args.metrics_file).resolve()))
 
 if __name__ == "__main__":
     main()
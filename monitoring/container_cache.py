@@ -0,0 +1,124 @@
+import re
+import threading
+import time
+
+from common import docker_api
+
+# In-memory metadata of the containers (IP, name, image and labels), read from the Docker Engine API.
+# The cache is filled with a single list call and then kept up to date by following the events stream,
+# so lookups don't need any request. Containers that have been removed are kept for a while,
+# so the events of short-lived containers can still be resolved after the container is gone
+
+# Seconds a removed container is kept in the cache
+REMOVED_TTL = 600
+
+# Seconds to wait before following the events again when the stream is interrupted
+RECONNECT_DELAY = 5
+
+# Prefixes are only matched from the length of Docker's short id, so a short or empty id can't match any container
+SHORT_ID = re.compile(r"^[0-9a-f]{12,}$")
+
+
+def container_record(container_info):
+	# The list and inspect formats of the API differ in the name, image and labels fields
+	config = container_info.get("Config") or {}
+	name = container_info.get("Name") or (container_info.get("Names") or [""])[0]
+	return {
+		"id": container_info["Id"],
+		"name": name.lstrip("/"),
+		"image": config.get("Image") or container_info.get("Image", ""),
+		"image_id": container_info.get("ImageID") or container_info.get("Image", ""),
+		"labels": config.get("Labels") or container_info.get("Labels") or {},
+		"ip": docker_api.container_ip(container_info),
+		"removed": None
+	}
+
+
+class ContainerCache:
+	def __init__(self, client=None):
+		self.client = client or docker_api.DockerClient()
+		self.containers = {}
+		self.lock = threading.Lock()
+		self.thread = None
+
+	def start(self):
+		# Fill the cache and follow the events in a background thread
+		since = self.prime()
+		self.thread = threading.Thread(target=self.follow, args=(since,), daemon=True)
+		self.thread.start()
+
+	def prime(self):
+		# Returns the time of the list call: the events from that time on are applied, so nothing is lost in between
+		since = int(time.time())
+		containers = self.client.list_containers(all_containers=True)
+		with self.lock:
+			for container_info in containers:
+				record = container_record(container_info)
+				self.containers[record["id"]] = record
+		return since
+
+	def follow(self, since):
+		while True:
+			try:
+				for event in self.client.events({"type": ["container", "network"]}, since):
+					self.apply(event)
+					since = event.get("time", since)
+			except (OSError, docker_api.DockerError) as ex:
+				print(f"Docker events stream interrupted ({ex}), reconnecting")
+			time.sleep(RECONNECT_DELAY)
+			try:
+				self.prime()
+			except (OSError, docker_api.DockerError):
+				pass
+
+	def apply(self, event):
+		action = event.get("Action") or event.get("status") or ""
+		if event.get("Type") == "network":
+			# The IP changes when a container is connected to (or disconnected from) a network
+			container_id = (event.get("Actor") or {}).get("Attributes", {}).get("container")
+			if container_id and action in ("connect", "disconnect"):
+				self.refresh(container_id)
+			return
+
+		container_id = (event.get("Actor") or {}).get("ID") or event.get("id")
+		if not container_id:
+			return
+		if action in ("create", "start", "restart", "rename", "update"):
+			self.refresh(container_id)
+		elif action == "destroy":
+			with self.lock:
+				if container_id in self.containers:
+					self.containers[container_id]["removed"] = time.monotonic()
+			self.purge()
+
+	def refresh(self, container_id):
+		try:
+			record = container_record(self.client.inspect_container(container_id))
+		except (OSError, docker_api.DockerError):
+			return
+		with self.lock:
+			self.containers[record["id"]] = record
+
+	def purge(self):
+		now = time.monotonic()
+		with self.lock:
+			for container_id in [i for i, r in self.containers.items() if r["removed"] and now - r["removed"] > REMOVED_TTL]:
+				del self.containers[container_id]
+
+	def get(self, container_id):
+		# container_id can be the full id or a prefix of it of at least 12 characters (Falco reports the first 12).
+		# A container that is not in the cache yet is inspected and added
+		if not container_id:
+			return None
+		record = self.find(container_id)
+		if record is None:
+			self.refresh(container_id)
+			record = self.find(container_id)
+		return record
+
+	def find(self, container_id):
+		with self.lock:
+			record = self.containers.get(container_id)
+			if record is None and SHORT_ID.match(container_id):
+				record = next((r for i, r in self.containers.items() if i.startswith(container_id)), None)
+		return record
@@ -0,0 +1,184 @@
+import argparse
+import json
+import re
+import sqlite3
+import time
+import zlib
+from datetime import datetime, timezone
+
+# Findings of the observer's scans, one row per scanned container port in a SQLite database (WAL mode, so
+# the observer keeps appending while the database is queried). The nmap report is parsed into the TLS
+# versions, the weak ciphers and the grade; the full report is kept compressed in the same row.
+# Run this file to query the findings by container, image, port and time
+
+DEFAULT_DB = "report/findings.db"
+
+# ssl-enum-ciphers grades each cipher from A (strong) to F, those below B are reported as weak
+WEAK_STRENGTHS = ("C", "D", "E", "F")
+
+# Protocol versions reported as weak
+OLD_VERSIONS = ("SSLv2", "SSLv3", "TLSv1.0", "TLSv1.1")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS findings (
+	id INTEGER PRIMARY KEY,
+	time TEXT,
+	epoch REAL,
+	container_id TEXT,
+	container_name TEXT,
+	image_id TEXT,
+	port INTEGER,
+	state TEXT,
+	tls_versions TEXT,
+	weak_ciphers TEXT,
+	grade TEXT,
+	weak INTEGER,
+	report BLOB
+);
+CREATE INDEX IF NOT EXISTS findings_container ON findings (container_id, epoch);
+CREATE INDEX IF NOT EXISTS findings_name ON findings (container_name, epoch);
+CREATE INDEX IF NOT EXISTS findings_image ON findings (image_id, epoch);
+CREATE INDEX IF NOT EXISTS findings_port ON findings (port, epoch);
+CREATE INDEX IF NOT EXISTS findings_epoch ON findings (epoch);
+"""
+
+COLUMNS = ("time", "container_id", "container_name", "image_id", "port", "state", "tls_versions", "weak_ciphers", "grade", "weak")
+
+VERSION_LINE = re.compile(r"^\|?\s*(SSLv[23]|TLSv1(?:\.[0-3])?):")
+CIPHER_LINE = re.compile(r"\b((?:TLS|SSL)_\w+)\b.* - ([A-F])\s*$")
+GRADE_LINE = re.compile(r"least strength: ([A-F])")
+PORT_LINE = re.compile(r"^\d+/\w+\s+(\S+)")
+
+
+def parse_report(report):
+	# Structured fields of an ssl-enum-ciphers report. A port without TLS has no versions and no grade.
+	# An open port is weak if it doesn't use TLS, or allows old protocol versions or weak ciphers
+	finding = {"state": "unknown", "tls_versions": [], "weak_ciphers": [], "grade": None}
+	for line in report.splitlines():
+		if "Host seems down" in line:
+			finding["state"] = "down"
+		elif match := PORT_LINE.match(line):
+			finding["state"] = match.group(1)
+		elif match := VERSION_LINE.match(line):
+			if match.group(1) not in finding["tls_versions"]:
+				finding["tls_versions"].append(match.group(1))
+		elif match := CIPHER_LINE.search(line):
+			if match.group(2) in WEAK_STRENGTHS and match.group(1) not in finding["weak_ciphers"]:
+				finding["weak_ciphers"].append(match.group(1))
+		elif match := GRADE_LINE.search(line):
+			finding["grade"] = match.group(1)
+	finding["weak"] = finding["state"] == "open" and (not finding["tls_versions"] or bool(finding["weak_ciphers"])
+		or any(version in OLD_VERSIONS for version in finding["tls_versions"]))
+	return finding
+
+
+def to_epoch(value):
+	# Falco times have nanoseconds (Eg. 2024-05-10T10:11:12.123456789Z), dates given as queries may have no time.
+	# Times without a timezone are UTC
+	if value is None:
+		return None
+	date, _, fraction = value.rstrip("Z").partition(".")
+	date = datetime.fromisoformat(date)
+	if date.tzinfo is None:
+		date = date.replace(tzinfo=timezone.utc)
+	return date.timestamp() + (float("0." + fraction) if fraction.isdigit() else 0)
+
+
+class FindingsStore:
+	def __init__(self, path=DEFAULT_DB):
+		self.connection = sqlite3.connect(path)
+		self.connection.execute("PRAGMA journal_mode=WAL")
+		self.connection.execute("PRAGMA synchronous=NORMAL")
+		self.connection.executescript(SCHEMA)
+
+	def add(self, event_time, container_id, container_name, image_id, port, report):
+		finding = parse_report(report)
+		try:
+			epoch = to_epoch(event_time)
+		except ValueError:
+			epoch = time.time()
+		with self.connection:
+			self.connection.execute(
+				"INSERT INTO findings (time, epoch, container_id, container_name, image_id, port, state, tls_versions, weak_ciphers, grade, weak, report) "
+				"VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+				(event_time, epoch, container_id, container_name, image_id, int(port), finding["state"], ",".join(finding["tls_versions"]),
+				",".join(finding["weak_ciphers"]), finding["grade"], int(finding["weak"]), zlib.compress(report.encode()))
+			)
+		return finding
+
+	def query(self, container=None, image=None, port=None, since=None, until=None, weak_only=False, limit=None, with_report=False):
+		# container matches the id (or a prefix of it) or the name, image matches the image id (or a prefix of it).
+		# since and until are ISO times. Returns a list of dicts, the newest first
+		conditions, parameters = [], []
+		if container:
+			conditions.append("(container_id LIKE ? OR container_name = ?)")
+			parameters += [container + "%", container]
+		if image:
+			conditions.append("image_id LIKE ?")
+			parameters.append(image + "%")
+		if port is not None:
+			conditions.append("port = ?")
+			parameters.append(int(port))
+		if since:
+			conditions.append("epoch >= ?")
+			parameters.append(to_epoch(since))
+		if until:
+			conditions.append("epoch <= ?")
+			parameters.append(to_epoch(until))
+		if weak_only:
+			conditions.append("weak = 1")
+
+		columns = COLUMNS + (("report",) if with_report else ())
+		sql = f"SELECT {', '.join(columns)} FROM findings"
+		if conditions:
+			sql += " WHERE " + " AND ".join(conditions)
+		sql += " ORDER BY epoch DESC"
+		if limit:
+			sql += f" LIMIT {int(limit)}"
+
+		findings = []
+		for row in self.connection.execute(sql, parameters):
+			finding = dict(zip(columns, row))
+			finding["tls_versions"] = finding["tls_versions"].split(",") if finding["tls_versions"] else []
+			finding["weak_ciphers"] = finding["weak_ciphers"].split(",") if finding["weak_ciphers"] else []
+			finding["weak"] = bool(finding["weak"])
+			if with_report:
+				finding["report"] = zlib.decompress(finding["report"]).decode()
+			findings.append(finding)
+		return findings
+
+	def close(self):
+		self.connection.close()
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description="Query the findings of the observer's scans")
+	parser.add_argument('--db', type=str, metavar="path", default=DEFAULT_DB, help=f"Findings database (Default: {DEFAULT_DB})")
+	parser.add_argument('--container', type=str, metavar="string", help="Container name, id or id prefix")
+	parser.add_argument('--image', type=str, metavar="string", help="Image id or id prefix (Eg. sha256:3f2a)")
+	parser.add_argument('--port', type=int, metavar="int", help="Container port")
+	parser.add_argument('--since', type=str, metavar="time", help="Only findings from this time on, in ISO format UTC (Eg. 2024-05-10 or 2024-05-10T10:00:00)")
+	parser.add_argument('--until', type=str, metavar="time", help="Only findings up to this time, in ISO format UTC")
+	parser.add_argument('--weak', action='store_true', help="Only ports without TLS or with weak ciphers or old protocol versions")
+	parser.add_argument('--limit', type=int, metavar="int", help="Maximum number of findings")
+	parser.add_argument('--report', action='store_true', help="Also print the full nmap reports")
+	parser.add_argument('--json', action='store_true', help="Print the findings as JSON")
+	args = parser.parse_args()
+
+	store = FindingsStore(args.db)
+	try:
+		findings = store.query(args.container, args.image, args.port, args.since, args.until, args.weak, args.limit, args.report)
+	except ValueError as ex:
+		parser.error(str(ex))
+
+	if args.json:
+		print(json.dumps(findings, indent=4))
+	else:
+		for finding in findings:
+			print(f"{finding['time']} {finding['container_name']} ({(finding['container_id'] or '')[:12]}) {finding['image_id']} port {finding['port']} {finding['state']}: "
+				f"TLS {' '.join(finding['tls_versions']) or 'not used'}, grade {finding['grade'] or '-'}, "
+				f"weak ciphers {' '.join(finding['weak_ciphers']) or 'none'}")
+			if args.report:
+				print(finding["report"] + "\n")
+	store.close()
@@ -0,0 +1,131 @@
+import asyncio
+import time
+import xml.etree.ElementTree as ET
+
+from common import metrics
+
+# The scans requested within a short window are run together: the targets with the same ports are given
+# to a single nmap run, so nmap's startup and script loading are paid once per batch instead of once per
+# container. nmap writes XML, which is split back into a text report for each (ip, port)
+
+NMAP_ARGS = ("--script", "ssl-enum-ciphers")
+
+
+def render_port(ip, port_element):
+	# Text similar to nmap's normal output for a single port
+	state = port_element.find("state")
+	service = port_element.find("service")
+	lines = [
+		f"Nmap scan report for {ip}",
+		"PORT STATE SERVICE",
+		f"{port_element.get('portid')}/{port_element.get('protocol')} {state.get('state') if state is not None else 'unknown'} "
+		f"{service.get('name') if service is not None else 'unknown'}"
+	]
+	for script in port_element.findall("script"):
+		output = (script.get("output") or "").strip("\n").split("\n")
+		lines.append(f"| {script.get('id')}: ")
+		lines += [f"|{line}" for line in output[:-1]] + [f"|_{line}" for line in output[-1:]]
+	return "\n".join(lines)
+
+
+def parse_xml(xml_output, targets):
+	# Returns the report of each (ip, port) in targets, including those that nmap did not report (Eg. host down)
+	reports = {(ip, port): f"Nmap scan report for {ip}\nNote: Host seems down." for ip, port in targets}
+	try:
+		root = ET.fromstring(xml_output)
+	except ET.ParseError:
+		return {target: "" for target in targets}
+	for host in root.findall("host"):
+		addresses = [address.get("addr") for address in host.findall("address")]
+		for port_element in host.findall("ports/port"):
+			for ip in addresses:
+				key = (ip, port_element.get("portid"))
+				if key in reports:
+					reports[key] = render_port(ip, port_element)
+	return reports
+
+
+class NmapBatcher:
+	def __init__(self, window=0.5, max_batch=64, processes=4):
+		self.window = window
+		self.max_batch = max_batch
+		self.semaphore = asyncio.Semaphore(processes)
+		self.pending = {}
+		self.timer = None
+		# The event loop only keeps weak references to the tasks, the running batches are kept here
+		self.tasks = set()
+		self.counters = {"requests": 0, "nmap_runs": 0}
+		self.durations = metrics.Histogram()
+
+	async def scan(self, ip, port):
+		# Returns the text report for the port of the host
+		key = (ip, str(port))
+		if not key[1].isdigit():
+			raise ValueError(f"Invalid port {port!r} for {ip}")
+		self.counters["requests"] += 1
+		future = self.pending.get(key)
+		if future is None:
+			future = self.pending[key] = asyncio.get_running_loop().create_future()
+			if len(self.pending) >= self.max_batch:
+				self.flush()
+			elif self.timer is None:
+				self.timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+		return await asyncio.shield(future)
+
+	def flush(self):
+		if self.timer:
+			self.timer.cancel()
+			self.timer = None
+		batch, self.pending = self.pending, {}
+		if not batch:
+			return
+
+		# Hosts are grouped by their set of ports, nmap scans every port on every host of a run
+		ports_of = {}
+		for ip, port in batch:
+			ports_of.setdefault(ip, set()).add(port)
+		groups = {}
+		for ip, ports in ports_of.items():
+			groups.setdefault(frozenset(ports), []).append(ip)
+		for ports, ips in groups.items():
+			futures = {(ip, port): batch[(ip, port)] for ip in ips for port in ports}
+			task = asyncio.create_task(self.run(sorted(ips), sorted(ports, key=int), futures))
+			self.tasks.add(task)
+			task.add_done_callback(self.tasks.discard)
+
+	async def run(self, ips, ports, futures):
+		try:
+			async with self.semaphore:
+				self.counters["nmap_runs"] += 1
+				start = time.monotonic()
+				process = await asyncio.create_subprocess_exec("nmap", *NMAP_ARGS, "-oX", "-", "-p", ",".join(ports), *ips,
+					stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+				stdout, _ = await process.communicate()
+				self.durations.observe(time.monotonic() - start)
+			reports = parse_xml(stdout.decode("utf-8", errors="replace"), futures.keys())
+			for key, future in futures.items():
+				if not future.done():
+					future.set_result(reports[key])
+		except Exception as ex:
+			for future in futures.values():
+				if not future.done():
+					future.set_exception(ex)
+		except asyncio.CancelledError:
+			for future in futures.values():
+				future.cancel()
+			raise
+
+	async def close(self):
+		# The running batches are cancelled, and so are the scans that are still waiting
+		if self.timer:
+			self.timer.cancel()
+			self.timer = None
+		for future in self.pending.values():
+			future.cancel()
+		self.pending = {}
+		for task in self.tasks:
+			task.cancel()
+		await asyncio.gather(*self.tasks, return_exceptions=True)
+
+	def stats(self):
+		return {**self.counters, "nmap_duration": self.durations.stats()}
@@ -1,70 +1,298 @@
+import argparse
+import asyncio
+import sys
 import threading
-import time
 import json
-import subprocess
 import os
+from pathlib import Path
+
+# The modules shared by the analysis scripts are in the common folder
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common import docker_api, metrics
+
+from tailer import Tailer
+from scan_queue import ScanQueue, POLICIES
+from scan_cache import ScanCache
+from container_cache import ContainerCache
+from nmap_batch import NmapBatcher
+from findings_store import FindingsStore, DEFAULT_DB
+
+# Falco sends the events straight to the observer, either with its http_output (a JSON object per POST request)
+# or through a unix socket (a JSON object per line). The open_port events are filtered here and the scans
+# are run as asynchronous subprocesses by a limited number of workers. The openport.txt file written by
+# event_handler.sh can still be followed with --file
+
+DEFAULT_LISTEN = "127.0.0.1:2802"
+
+# Largest accepted HTTP request body (bytes)
+MAX_BODY = 1024 * 1024
+
+
+def parse_event(data):
+	# Returns the fields of the open_port event used by the scan, or None if it is not an open_port event
+	if not isinstance(data, dict) or "open_port" not in (data.get("tags") or []):
+		return None
 
-def callback(new_line):
-        
-	try:
-		data = json.loads(new_line)	
-	except json.JSONDecodeError as e:
-		print(f"Error decoding JSON: {e}")
-        
-	container_id = data.get("output_fields", {}).get("container.id")
 	container_name = data.get("output_fields", {}).get("container.name")
 	if not container_name:
 		container_name = "undefined"
-	container_port = data.get("output_fields", {}).get("fd.sport")
-	container_time = data.get("time")
-	
+	return {
+		"id": data.get("output_fields", {}).get("container.id"),
+		"name": container_name,
+		"port": data.get("output_fields", {}).get("fd.sport"),
+		"time": data.get("time")
+	}
+
+
+async def run_command(*command):
+	process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+	stdout, _ = await process.communicate()
+	return stdout.decode('utf-8').strip()
+
+
+async def container_info(container_id, containers):
+	# Image id and IP of the container, from the metadata cache if the Docker API is available.
+	# A container missing from the cache is inspected with a blocking request, so it runs in a thread
+	if containers:
+		record = await asyncio.to_thread(containers.get, container_id)
+		return (record["image_id"], record["ip"]) if record else ("", "")
+	inspect_out = (await run_command("docker", "inspect", "-f", "{{.Image}} {{range.NetworkSettings.Networks}}{{.IPAddress}}{{end}}", container_id)).split()
+	return (inspect_out[0] if inspect_out else "", inspect_out[1] if len(inspect_out) > 1 else "")
+
+
+async def callback(event, scan_cache, containers, batcher, store):
+	container_id = event["id"]
+	container_name = event["name"]
+	container_port = event["port"]
+	container_time = event["time"]
+
+	# The same container binding the same port again (Eg. worker restarts) was already scanned
+	if scan_cache.get((container_id, container_port)) is not None:
+		print(f"{container_time} {container_name} {container_port} already scanned, skipped")
+		return
+
 	print(container_time + " " + container_name + " " + str(container_port))
-	
-	# Get container IP
-	command = "docker inspect -f '{{range.NetworkSettings.Networks}}{{.IPAddress}}{{end}}' " + container_id
-	container_ip = subprocess.run(command, shell=True, capture_output=True).stdout.decode('utf-8').strip()
-	
-	# Run nmap
-	filename = "report/nmap_reports/" + container_time + "_" + container_name + "_" + str(container_port) + ".txt"
-	nmap_out = subprocess.run(f"nmap --script ssl-enum-ciphers {container_ip} -p {container_port}", shell=True, capture_output=True).stdout.decode('utf-8').strip()   
-
-	with open(filename, 'w') as file:
-		file.write(nmap_out)
-    
-    
-def monitor(file_path):
-
-	with open(file_path, 'r') as file:
-		# Move to the end of the file
-		file.seek(0, 2)
-
-		while True:
-			lines = file.readlines()  # Read all available new lines
-			if lines:
-				for line in lines:
-				    # Spawn a thread for each new line
-				    thread = threading.Thread(target=callback, args=(line.strip(),))
-				    thread.start()
-				    
-			time.sleep(0.1)  # Small delay to avoid busy waiting
+
+	# Get container IP and image
+	container_image, container_ip = await container_info(container_id, containers)
+
+	if not container_ip:
+		print(f"{container_time} {container_name} {container_port} IP address not found, skipped")
+		return
+
+	# Run nmap, unless a container of the same image was scanned on the same port: replicas share the result.
+	# The scans requested at about the same time are run together by the batcher
+	async def scan():
+		return await batcher.scan(container_ip, container_port)
+	if container_image:
+		nmap_out, reused = await scan_cache.get_or_run((container_image, container_port), scan)
+		if reused:
+			nmap_out = f"# Result of a scan of another container of the image {container_image}\n" + nmap_out
+	else:
+		nmap_out = await scan()
+	scan_cache.put((container_id, container_port), True)
+
+	# The findings are appended to the store, with the full report
+	finding = store.add(container_time, container_id, container_name, container_image, container_port, nmap_out)
+	if finding["weak"]:
+		print(f"\033[1;38;5;214m{container_name} port {container_port}: TLS {' '.join(finding['tls_versions']) or 'not used'}, "
+			f"weak ciphers {' '.join(finding['weak_ciphers']) or 'none'}\033[0m")
+
+
+class Observer:
+	def __init__(self, queue, stats, metrics_text=None):
+		# stats is a function returning the statistics served at GET /stats,
+		# metrics_text a function returning those served at GET /metrics in the Prometheus text format
+		self.queue = queue
+		self.stats = stats
+		self.metrics_text = metrics_text
+
+	def submit(self, data):
+		event = parse_event(data)
+		if event and not self.queue.put((event["id"], event["port"]), event):
+			print(f"Queue full, dropped event for {event['name']} port {event['port']}")
+
+	def submit_line(self, line):
+		try:
+			self.submit(json.loads(line))
+		except json.JSONDecodeError as e:
+			print(f"Error decoding JSON: {e}")
+
+	async def handle_http(self, reader, writer):
+		# Minimal HTTP/1.1 server for Falco's http_output: POST requests with a JSON body, on kept-alive connections
+		try:
+			while True:
+				request_line = await reader.readline()
+				if not request_line:
+					break
+				method, target = (request_line.decode(errors="replace").split() + ["", ""])[:2]
+				headers = {}
+				while True:
+					line = await reader.readline()
+					if line in (b"\r\n", b"\n", b""):
+						break
+					name, _, value = line.decode(errors="replace").partition(":")
+					headers[name.strip().lower()] = value.strip()
+
+				length = int(headers.get("content-length", "0") or 0)
+				if headers.get("transfer-encoding", "").lower() == "chunked" or length > MAX_BODY:
+					await self.respond(writer, "413 Payload Too Large", close=True)
+					break
+				# libcurl (Falco's http_output) waits about 1 s for the 100 Continue before sending a body larger than 1 KB
+				if length and headers.get("expect", "").lower() == "100-continue":
+					writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+					await writer.drain()
+				body = await reader.readexactly(length) if length else b""
+
+				if method == "POST":
+					self.submit_line(body)
+					await self.respond(writer, "200 OK")
+				elif method == "GET" and target == "/stats":
+					await self.respond(writer, "200 OK", json.dumps(self.stats(), indent=4).encode())
+				elif method == "GET" and target == "/metrics" and self.metrics_text:
+					await self.respond(writer, "200 OK", self.metrics_text().encode(), "text/plain; version=0.0.4")
+				else:
+					await self.respond(writer, "404 Not Found")
+				if headers.get("connection", "").lower() == "close":
+					break
+		except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+			pass
+		finally:
+			writer.close()
+
+	async def respond(self, writer, status, body=b"", content_type="application/json", close=False):
+		headers = f"HTTP/1.1 {status}\r\nContent-Length: {len(body)}\r\nContent-Type: {content_type}\r\n"
+		if close:
+			headers += "Connection: close\r\n"
+		writer.write(headers.encode() + b"\r\n" + body)
+		await writer.drain()
+
+	async def handle_socket(self, reader, writer):
+		# One JSON event per line
+		try:
+			while True:
+				line = await reader.readline()
+				if not line:
+					break
+				if line.strip():
+					self.submit_line(line)
+		except (ConnectionError, ValueError):
+			pass
+		finally:
+			writer.close()
+
+	def follow_file(self, file_path, state_path, loop):
+		# Runs in a thread: each line is handed to the event loop as soon as it is written
+		tailer = Tailer(file_path, state_path)
+		for line in tailer.follow():
+			loop.call_soon_threadsafe(self.submit_line, line.strip())
+
+
+def observer_metrics(queue, scan_cache, batcher):
+	# Counters, gauges and histograms of the observer in the Prometheus text format
+	stats = queue.stats()
+	cache_stats = scan_cache.stats()
+	lines = []
+	lines += metrics.metric_lines("observer_events_total", "counter", "Events received, by what happened to them",
+		[("", {"outcome": outcome}, stats[outcome]) for outcome in ("received", "coalesced", "dropped")])
+	lines += metrics.metric_lines("observer_scans_total", "counter", "Scans handled by the workers, by outcome",
+		[("", {"outcome": outcome}, stats[outcome]) for outcome in ("processed", "failed")])
+	lines += metrics.metric_lines("observer_events_per_second", "gauge", "Events received per second over the last minute",
+		[("", {}, stats["events_per_second"])])
+	lines += metrics.metric_lines("observer_queue_depth", "gauge", "Scans waiting for a worker", [("", {}, stats["queue_depth"])])
+	lines += metrics.metric_lines("observer_active_workers", "gauge", "Workers handling a scan", [("", {}, stats["active_workers"])])
+	lines += metrics.metric_lines("observer_scan_cache_total", "counter", "Lookups of the scan cache",
+		[("", {"result": "hit"}, cache_stats["hits"]), ("", {"result": "miss"}, cache_stats["misses"])])
+	lines += metrics.metric_lines("observer_nmap_runs_total", "counter", "nmap processes started", [("", {}, batcher.stats()["nmap_runs"])])
+	lines += metrics.metric_lines("observer_queue_lag_seconds", "histogram", "Time a scan waited in the queue, from its first event", queue.lag.samples())
+	lines += metrics.metric_lines("observer_scan_latency_seconds", "histogram", "Time to handle a scan, from the worker start to the stored finding",
+		queue.latency.samples())
+	lines += metrics.metric_lines("observer_nmap_duration_seconds", "histogram", "Duration of the nmap runs", batcher.durations.samples())
+	return "\n".join(lines) + "\n"
+
+
+async def write_stats(queue, scan_cache, extra_stats, stats_path, interval):
+	while True:
+		await asyncio.sleep(interval)
+		queue.write_stats(stats_path, extra_stats())
+		stats = queue.stats()
+		cache_stats = scan_cache.stats()
+		nmap_stats = extra_stats()["nmap"]
+		print(f"Events: {stats['events_per_second']}/s. Queue: {stats['queue_depth']} waiting, {stats['active_workers']} running, {stats['dropped']} dropped, "
+			f"{stats['coalesced']} coalesced, lag p90 {stats['queue_lag']['p90']}s. Scans: latency p90 {stats['scan_latency']['p90']}s. "
+			f"Cache: {cache_stats['hits']} hits, {cache_stats['misses']} scans. Nmap: {nmap_stats['nmap_runs']} runs for {nmap_stats['requests']} targets")
+
+
+async def main(args):
+	# The container metadata is read from the Docker API and kept up to date with its events,
+	# without the API each scan runs docker inspect
+	containers = ContainerCache()
+	try:
+		await asyncio.to_thread(containers.start)
+	except (OSError, docker_api.DockerError) as ex:
+		print(f"Docker API not available ({ex}), using docker inspect")
+		containers = None
+
+	# Events for the same container port waiting in the queue are coalesced
+	scan_cache = ScanCache(args.cache_ttl)
+	batcher = NmapBatcher(args.batch_window, args.batch_size, args.nmap_processes)
+	store = FindingsStore(args.db)
+	queue = ScanQueue(lambda event: callback(event, scan_cache, containers, batcher, store), args.workers, args.queue_size, args.queue_policy)
+	queue.start()
+	extra_stats = lambda: {"cache": scan_cache.stats(), "nmap": batcher.stats()}
+	observer = Observer(queue, lambda: {**queue.stats(), **extra_stats()}, lambda: observer_metrics(queue, scan_cache, batcher))
+
+	servers = []
+	if args.listen:
+		host, _, port = args.listen.rpartition(":")
+		servers.append(await asyncio.start_server(observer.handle_http, host or "127.0.0.1", int(port)))
+		print(f"Receiving Falco events at http://{host or '127.0.0.1'}:{port}")
+	if args.socket:
+		if os.path.exists(args.socket):
+			os.remove(args.socket)
+		servers.append(await asyncio.start_unix_server(observer.handle_socket, args.socket))
+		print(f"Receiving Falco events on the socket {args.socket}")
+	if args.file:
+		# The read offset is saved here, so after a restart the events written in the meantime are not lost
+		state_path = os.path.splitext(args.file)[0] + ".offset"
+		threading.Thread(target=observer.follow_file, args=(args.file, state_path, asyncio.get_running_loop()), daemon=True).start()
+		print(f"Observing file {args.file}")
+
+	try:
+		await write_stats(queue, scan_cache, extra_stats, "report/observer_stats.json", args.stats_interval)
+	finally:
+		await batcher.close()
 
 
 if __name__ == "__main__":
 
-	file_path = "report/openport.txt"
-	print(f"Observing file {file_path}")
+	parser = argparse.ArgumentParser(description="Scan with nmap the ports opened in the containers, as reported by Falco")
+	parser.add_argument('--listen', type=str, metavar="host:port", default=DEFAULT_LISTEN, help="Address where Falco's http_output sends the events. "
+	"An empty string disables it (Default: 127.0.0.1:2802)")
+	parser.add_argument('--socket', type=str, metavar="path", help="Also receive the events as JSON lines on this unix socket")
+	parser.add_argument('--file', type=str, metavar="string", help="Also follow a file where the open_port events are written by event_handler.sh (Eg. report/openport.txt)")
+	parser.add_argument('--workers', type=int, metavar="int", default=64, help="Number of events handled at the same time. The events waiting "
+	"for a scan are batched, so this also limits the size of the batches (Default: 64)")
+	parser.add_argument('--nmap_processes', type=int, metavar="int", default=4, help="Number of nmap processes running at the same time (Default: 4)")
+	parser.add_argument('--batch_window', type=float, metavar="seconds", default=0.5, help="The scans requested within this time "
+	"are run together, with a single nmap run for the hosts with the same ports (Default: 0.5)")
+	parser.add_argument('--batch_size', type=int, metavar="int", default=64, help="Maximum number of targets (host and port) of a batch (Default: 64)")
+	parser.add_argument('--queue_size', type=int, metavar="int", default=100, help="Maximum number of scans waiting in the queue (Default: 100)")
+	parser.add_argument('--queue_policy', type=str, choices=POLICIES, default="drop_new", help="What to do with a new event when the queue is full: "
+	"drop it or drop the oldest waiting scan (Default: drop_new)")
+	parser.add_argument('--cache_ttl', type=float, metavar="seconds", default=300, help="A container port, or the same port of another container "
+	"of the same image, is not scanned again for this time; 0 disables the cache (Default: 300)")
+	parser.add_argument('--db', type=str, metavar="path", default=DEFAULT_DB, help="SQLite database where the findings are stored, "
+	f"query it with findings_store.py (Default: {DEFAULT_DB})")
+	parser.add_argument('--stats_interval', type=float, metavar="seconds", default=60, help="How often the queue statistics are written "
+	"in report/observer_stats.json (Default: 60)")
+	args = parser.parse_args()
 
 	# Create report folder
-	if not os.path.exists("report/nmap_reports"):
-		os.makedirs("report/nmap_reports")
-	    
-	# Start the monitoring in a separate thread
-	monitor_thread = threading.Thread(target=monitor, args=(file_path,), daemon=True)
-	monitor_thread.start()
-
-	# Keep the main thread alive
+	if not os.path.exists("report"):
+		os.makedirs("report")
+
 	try:
-		while True:
-		    time.sleep(1)
+		asyncio.run(main(args))
 	except KeyboardInterrupt:
 		print("\nStopped observing")
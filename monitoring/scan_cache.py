@@ -0,0 +1,58 @@
+import asyncio
+import time
+
+# Results of recent scans, kept for ttl seconds. The scan for a key is run only once at a time: a task
+# asking for a key that is being scanned waits for that result instead of starting another scan.
+# The cache is used from the event loop thread only
+
+# Expired entries are purged when the cache grows beyond this size
+PURGE_SIZE = 1024
+
+
+class ScanCache:
+	def __init__(self, ttl):
+		self.ttl = ttl
+		self.entries = {}
+		self.running = {}
+		self.counters = {"hits": 0, "misses": 0}
+
+	def get(self, key):
+		# Returns the cached value or None
+		entry = self.entries.get(key)
+		if entry and time.monotonic() - entry[0] < self.ttl:
+			self.counters["hits"] += 1
+			return entry[1]
+		return None
+
+	def put(self, key, value):
+		now = time.monotonic()
+		self.entries[key] = (now, value)
+		if len(self.entries) > PURGE_SIZE:
+			for old_key in [k for k, (created, _) in self.entries.items() if now - created >= self.ttl]:
+				del self.entries[old_key]
+
+	async def get_or_run(self, key, scan):
+		# scan is a coroutine function. Returns the value for key and True if it comes from
+		# the cache or from a scan started by another task
+		while True:
+			value = self.get(key)
+			if value is not None:
+				return value, True
+			running = self.running.get(key)
+			if running is None:
+				break
+			# Another task is scanning the same key; if its scan fails, the loop starts a new one
+			await running.wait()
+
+		running = self.running[key] = asyncio.Event()
+		self.counters["misses"] += 1
+		try:
+			value = await scan()
+			self.put(key, value)
+			return value, False
+		finally:
+			del self.running[key]
+			running.set()
+
+	def stats(self):
+		return {"entries": len(self.entries), **self.counters}
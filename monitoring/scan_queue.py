@@ -0,0 +1,94 @@
+import asyncio
+import collections
+import json
+import os
+import time
+
+from common import metrics
+
+# Bounded queue of scans served by a fixed number of asyncio worker tasks. Events for a container port that
+# already has a scan waiting in the queue are coalesced with it. When the queue is full the new event
+# is dropped (policy "drop_new") or the oldest waiting scan is dropped to make room ("drop_oldest").
+# The queue lag (how long a scan waited for a worker, from its first event) and the handling time are
+# kept in histograms. All the methods must be called from the event loop thread
+
+POLICIES = ("drop_new", "drop_oldest")
+
+
+class ScanQueue:
+	def __init__(self, handler, workers=4, max_depth=100, policy="drop_new"):
+		# handler is a coroutine function called with each item
+		if policy not in POLICIES:
+			raise ValueError(f"Unknown queue policy {policy}, use one of {', '.join(POLICIES)}")
+		self.handler = handler
+		self.workers = workers
+		self.max_depth = max_depth
+		self.policy = policy
+		self.pending = collections.OrderedDict()
+		self.available = asyncio.Event()
+		self.counters = {"received": 0, "coalesced": 0, "dropped": 0, "processed": 0, "failed": 0}
+		self.active = 0
+		self.tasks = []
+		self.event_rate = metrics.Rate()
+		self.lag = metrics.Histogram()
+		self.latency = metrics.Histogram()
+
+	def start(self):
+		self.tasks = [asyncio.create_task(self.work()) for _ in range(self.workers)]
+
+	def put(self, key, item):
+		# Returns False if the item was dropped
+		self.counters["received"] += 1
+		self.event_rate.mark()
+		if key in self.pending:
+			# The waiting scan will see the same container port, the newest event is kept
+			self.pending[key] = (item, self.pending[key][1])
+			self.counters["coalesced"] += 1
+			return True
+		if len(self.pending) >= self.max_depth:
+			self.counters["dropped"] += 1
+			if self.policy == "drop_new":
+				return False
+			self.pending.popitem(last=False)
+		self.pending[key] = (item, time.monotonic())
+		self.available.set()
+		return True
+
+	async def work(self):
+		while True:
+			while not self.pending:
+				self.available.clear()
+				await self.available.wait()
+			_, (item, enqueued) = self.pending.popitem(last=False)
+			start = time.monotonic()
+			self.lag.observe(start - enqueued)
+			self.active += 1
+			try:
+				await self.handler(item)
+				outcome = "processed"
+			except Exception as ex:
+				print(f"Scan failed: {ex}")
+				outcome = "failed"
+			finally:
+				self.active -= 1
+			self.latency.observe(time.monotonic() - start)
+			self.counters[outcome] += 1
+
+	def stats(self):
+		return {
+			"queue_depth": len(self.pending),
+			"max_depth": self.max_depth,
+			"active_workers": self.active,
+			"workers": self.workers,
+			"events_per_second": self.event_rate.per_second(),
+			"queue_lag": self.lag.stats(),
+			"scan_latency": self.latency.stats(),
+			**self.counters
+		}
+
+	def write_stats(self, path, extra=None):
+		# extra: other statistics written in the same file, Eg. those of the scan cache
+		tmp_path = path + ".tmp"
+		with open(tmp_path, "w") as json_file:
+			json.dump({**self.stats(), **(extra or {})}, json_file, indent=4)
+		os.replace(tmp_path, path)
@@ -0,0 +1,199 @@
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import struct
+import time
+
+# Follows a log file written by another process (Eg. openport.txt written by Falco) and returns its new lines.
+# The tailer waits on inotify events for the file, so a line is returned as soon as it is written, and on the
+# creation of files in its folder, to follow the file again when it is created again. It falls back to polling
+# where inotify is not available. Rotation (the file is renamed or deleted and
+# created again) and truncation are detected from the inode and the size of the file. The read offset
+# is saved in a state file, so after a restart the lines written in the meantime are not lost
+
+IN_MODIFY = 0x00000002
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# The writes to the other files of the folder (Eg. the other reports) don't wake the tailer
+FILE_MASK = IN_MODIFY | IN_MOVE_SELF | IN_DELETE_SELF
+DIRECTORY_MASK = IN_CREATE | IN_MOVED_TO
+
+EVENT_HEADER = struct.Struct("iIII")
+
+# Even with inotify the file is checked at least this often (seconds), in case an event is missed
+CHECK_INTERVAL = 1.0
+
+
+class Inotify:
+	def __init__(self, path):
+		self.path = path
+		self.name = os.fsencode(os.path.basename(path))
+		self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+		self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+		self.directory_watch = self.libc.inotify_add_watch(self.fd, os.fsencode(os.path.dirname(path)), DIRECTORY_MASK)
+		if self.directory_watch < 0:
+			error = ctypes.get_errno()
+			os.close(self.fd)
+			raise OSError(error, f"inotify_add_watch failed for {os.path.dirname(path)}")
+		self.file_watch = -1
+		self.watch_file()
+
+	def watch_file(self):
+		# The watch follows the inode, so it is moved to the new file when the file is created again.
+		# The file may not exist yet, its creation is seen by the watch of the folder
+		if self.file_watch >= 0:
+			self.libc.inotify_rm_watch(self.fd, self.file_watch)
+		self.file_watch = self.libc.inotify_add_watch(self.fd, os.fsencode(self.path), FILE_MASK)
+
+	def wait(self, timeout):
+		# Returns True if there was an event for the file, False on timeout
+		readable, _, _ = select.select([self.fd], [], [], timeout)
+		if not readable:
+			return False
+		try:
+			data = os.read(self.fd, 64 * 1024)
+		except BlockingIOError:
+			return False
+		offset = 0
+		found = False
+		while offset + EVENT_HEADER.size <= len(data):
+			watch, _, _, length = EVENT_HEADER.unpack_from(data, offset)
+			event_name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0")
+			if watch == self.directory_watch and event_name == self.name:
+				self.watch_file()
+				found = True
+			elif watch == self.file_watch:
+				found = True
+			offset += EVENT_HEADER.size + length
+		return found
+
+	def close(self):
+		os.close(self.fd)
+
+
+class Poller:
+	def __init__(self, interval):
+		self.interval = interval
+
+	def wait(self, timeout):
+		time.sleep(self.interval)
+		return True
+
+	def close(self):
+		pass
+
+
+class Tailer:
+	def __init__(self, path, state_path=None, poll_interval=0.1):
+		self.path = os.path.abspath(path)
+		self.state_path = state_path
+		self.file = None
+		self.inode = None
+		self.offset = 0
+		self.mtime = None
+		self.partial = b""
+		try:
+			self.watcher = Inotify(self.path)
+		except (OSError, AttributeError) as ex:
+			# AttributeError: the C library has no inotify functions
+			print(f"inotify is not available ({ex}), polling {self.path}")
+			self.watcher = Poller(poll_interval)
+
+	def load_state(self):
+		try:
+			with open(self.state_path, "r") as json_file:
+				state = json.load(json_file)
+			return state["inode"], state["offset"]
+		except (TypeError, FileNotFoundError, KeyError, json.JSONDecodeError):
+			return None, None
+
+	def save_state(self):
+		if not self.state_path or self.inode is None:
+			return
+		tmp_path = self.state_path + ".tmp"
+		with open(tmp_path, "w") as json_file:
+			# A line without its newline yet will be read again
+			json.dump({"inode": self.inode, "offset": self.offset - len(self.partial)}, json_file)
+		os.replace(tmp_path, self.state_path)
+
+	def open(self, resume):
+		# resume: continue from the saved offset if the file is the same, otherwise start from the end.
+		# A file that replaces the one being followed is always read from the beginning
+		try:
+			self.file = open(self.path, "rb")
+		except FileNotFoundError:
+			self.file = None
+			return
+		stat = os.fstat(self.file.fileno())
+		saved_inode, saved_offset = self.load_state() if resume else (None, None)
+		if resume and saved_inode == stat.st_ino and saved_offset <= stat.st_size:
+			self.offset = saved_offset
+		elif resume and saved_inode is None:
+			self.offset = stat.st_size
+		else:
+			self.offset = 0
+		self.inode = stat.st_ino
+		self.partial = b""
+		self.file.seek(self.offset)
+
+	def read(self):
+		# Complete lines written since the last read, the last line is kept until its newline is written
+		data = self.file.read()
+		if not data:
+			return []
+		self.offset += len(data)
+		lines = (self.partial + data).split(b"\n")
+		self.partial = lines.pop()
+		return [line.decode(errors="replace") for line in lines if line.strip()]
+
+	def check(self):
+		# Returns the lines to deliver, handling truncation and rotation
+		if self.file is None:
+			self.open(resume=False)
+			return self.read() if self.file else []
+
+		previous_offset = self.offset
+		lines = self.read()
+		try:
+			stat = os.stat(self.path)
+		except FileNotFoundError:
+			# Deleted or renamed: everything written to the old file has been read, wait for the new one
+			return lines
+		if stat.st_ino != self.inode:
+			self.file.close()
+			self.open(resume=False)
+			lines += self.read()
+		# A file truncated and written again up to the same size is only recognized by the modification time
+		elif stat.st_size < self.offset or (self.offset == previous_offset and stat.st_size == self.offset and self.mtime not in (None, stat.st_mtime_ns)):
+			self.file.seek(0)
+			self.offset = 0
+			self.partial = b""
+			lines += self.read()
+		self.mtime = stat.st_mtime_ns
+		return lines
+
+	def follow(self):
+		# Generator of the new lines, the offset is saved after each group of lines has been handled
+		self.open(resume=True)
+		try:
+			lines = self.check()
+			while True:
+				for line in lines:
+					yield line
+				if lines:
+					self.save_state()
+				self.watcher.wait(CHECK_INTERVAL)
+				lines = self.check()
+		finally:
+			self.watcher.close()
+			if self.file:
+				self.file.close()
@@ -0,0 +1,23 @@
+import os
+
+# Pylint and Bandit only take the files to analyze on the command line, which Linux limits to ARG_MAX
+# bytes (arguments and environment together, usually 2 MB). Long lists of files are split in chunks
+# that stay well below it, and the tool is run once per chunk
+
+ARG_BUDGET = 512 * 1024
+
+
+def chunks(paths, budget=ARG_BUDGET):
+	# Each path costs its length plus the terminating null byte and the argv pointer
+	result = []
+	size = 0
+	for path in paths:
+		length = len(os.fsencode(str(path))) + 1 + 8
+		if result and size + length > budget:
+			yield result
+			result = []
+			size = 0
+		result.append(path)
+		size += length
+	if result:
+		yield result
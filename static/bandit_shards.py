@@ -0,0 +1,119 @@
+import json
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import arg_chunks
+
+from common import metrics
+
+# Bandit has no option to use more than one core, so the file list is split between several
+# Bandit processes writing JSON reports. The reports are merged, and the text report is
+# rendered from the merged results in the same layout as Bandit's txt format
+
+# Below this number of files a new process costs more than it saves
+MIN_FILES_PER_SHARD = 20
+
+BANDIT_OPTIONS = ("-f", "json")
+
+SEVERITY_KEYS = ("SEVERITY.UNDEFINED", "SEVERITY.LOW", "SEVERITY.MEDIUM", "SEVERITY.HIGH")
+CONFIDENCE_KEYS = ("CONFIDENCE.UNDEFINED", "CONFIDENCE.LOW", "CONFIDENCE.MEDIUM", "CONFIDENCE.HIGH")
+
+
+def make_shards(files, count):
+	# Files are assigned by size, the largest first, to the shard with the smallest total
+	count = max(1, min(count, len(files) // MIN_FILES_PER_SHARD))
+	shards = [[0, []] for _ in range(count)]
+	for size, path in sorted(((os.path.getsize(path), path) for path in files), reverse=True):
+		shard = min(shards, key=lambda shard: shard[0])
+		shard[0] += size
+		shard[1].append(path)
+	return [paths for _, paths in shards if paths]
+
+
+def run_bandit(files, report):
+	# Long lists of files are analyzed in chunks that fit in the command line, one after the other
+	reports = []
+	for index, chunk in enumerate(arg_chunks.chunks(files)):
+		chunk_report = f"{report}.{index}"
+		metrics.run(["bandit", *BANDIT_OPTIONS, "-o", chunk_report, *chunk], "bandit", capture_output=True)
+		try:
+			with open(chunk_report, "r") as json_file:
+				reports.append(json.load(json_file))
+		except (FileNotFoundError, json.JSONDecodeError):
+			return None
+	return merge_results(reports)
+
+
+def merge_results(reports):
+	# Results and errors are concatenated, the metrics of the files are joined and the totals summed
+	merged = {"errors": [], "metrics": {"_totals": {}}, "results": []}
+	totals = merged["metrics"]["_totals"]
+	for report in reports:
+		merged["errors"] += report.get("errors", [])
+		merged["results"] += report.get("results", [])
+		for filename, metrics in report.get("metrics", {}).items():
+			if filename == "_totals":
+				for name, value in metrics.items():
+					totals[name] = totals.get(name, 0) + value
+			else:
+				merged["metrics"][filename] = metrics
+	return merged
+
+
+def render_text(merged):
+	# Only the parts of the txt format that are read back (parse_bandit) or useful to a reader
+	lines = ["Test results:"]
+	if not merged["results"]:
+		lines.append("\tNo issues identified.")
+	for result in sorted(merged["results"], key=lambda result: (result.get("filename", ""), result.get("line_number", 0))):
+		lines.append(f">> Issue: [{result.get('test_id')}:{result.get('test_name')}] {result.get('issue_text')}")
+		lines.append(f"   Severity: {result.get('issue_severity', '').capitalize()}   Confidence: {result.get('issue_confidence', '').capitalize()}")
+		cwe = result.get("issue_cwe")
+		if cwe:
+			lines.append(f"   CWE: CWE-{cwe.get('id')} ({cwe.get('link')})")
+		lines.append(f"   More Info: {result.get('more_info')}")
+		lines.append(f"   Location: {result.get('filename')}:{result.get('line_number')}:{result.get('col_offset', 0)}")
+		lines += result.get("code", "").rstrip("\n").split("\n")
+		lines.append("")
+		lines.append("-" * 50)
+		lines.append("")
+
+	totals = merged["metrics"]["_totals"]
+	lines += ["", "Code scanned:", f"\tTotal lines of code: {totals.get('loc', 0)}", f"\tTotal lines skipped (#nosec): {totals.get('nosec', 0)}", ""]
+	lines += ["Run metrics:", "\tTotal issues (by severity):"]
+	lines += [f"\t\t{key.split('.')[1].capitalize()}: {totals.get(key, 0)}" for key in SEVERITY_KEYS]
+	lines.append("\tTotal issues (by confidence):")
+	lines += [f"\t\t{key.split('.')[1].capitalize()}: {totals.get(key, 0)}" for key in CONFIDENCE_KEYS]
+	lines.append(f"Files skipped ({len(merged['errors'])}):")
+	lines += [f"\t{error.get('filename')} ({error.get('reason')})" for error in merged["errors"]]
+	return "\n".join(lines) + "\n"
+
+
+def run_shards(files, workers):
+	# Returns the merged results and the files that were analyzed (the files of a failed process are not)
+	reports = []
+	shards = make_shards(files, workers) if files else []
+	if shards:
+		shard_folder = tempfile.mkdtemp(prefix="bandit-shards-")
+		try:
+			with ThreadPoolExecutor(max_workers=len(shards)) as executor:
+				futures = [metrics.submit(executor, run_bandit, shard, f"{shard_folder}/shard{index}.json") for index, shard in enumerate(shards)]
+				reports = [future.result() for future in futures]
+		finally:
+			shutil.rmtree(shard_folder, ignore_errors=True)
+
+	failed = reports.count(None)
+	if failed:
+		print(f"\033[1;38;5;214mWarning: {failed} Bandit processes failed, their files are not in the report\033[0m")
+
+	analyzed = [path for shard, report in zip(shards, reports) if report is not None for path in shard]
+	return merge_results([report for report in reports if report is not None]), analyzed
+
+
+def write_reports(merged, json_report, text_report):
+	with open(json_report, "w") as json_file:
+		json.dump(merged, json_file, indent=4)
+	with open(text_report, "w") as text_file:
+		text_file.write(render_text(merged))
@@ -0,0 +1,217 @@
+import functools
+import hashlib
+import io
+import json
+import os
+import subprocess
+import tempfile
+import xml.etree.ElementTree as ET
+import zipfile
+
+import bandit_shards
+import spotbugs_shards
+
+from common import cache
+
+# Cache of the findings of each analyzed file, keyed on the file content, the tool version and the
+# options the tool is run with. Only the files that are not in the cache are analyzed, then the findings
+# of the analyzed files are split by file and stored, and the report is rebuilt from the findings of all
+# the files. Pylint and Bandit findings are cached per .py file, Spotbugs findings per jar or class file.
+# Checks that look at more than one file (Eg. Pylint's duplicate-code) only see the files analyzed together
+
+KIND = "files"
+
+
+@functools.lru_cache(maxsize=None)
+def tool_version(command):
+	# command is a tuple, Eg. ("bandit", "--version"). The whole output is used, it also contains the Python version
+	try:
+		result = subprocess.run(command, capture_output=True, text=True)
+	except OSError:
+		return "unknown"
+	return (result.stdout + result.stderr).strip()
+
+
+def file_hash(path):
+	sha256 = hashlib.sha256()
+	with open(path, "rb") as file:
+		for chunk in iter(lambda: file.read(1024 * 1024), b""):
+			sha256.update(chunk)
+	return sha256.hexdigest()
+
+
+def lookup_files(cache_dir, tool, version, config, files, root=None):
+	# Returns the cached findings {path: data}, the files to analyze and the keys of the files to analyze.
+	# With a root, the path of the file below it is also part of the key: Pylint messages depend on the module name
+	# (Eg. two empty __init__.py files in different packages don't have the same findings)
+	cached = {}
+	missing = []
+	keys = {}
+	for path in files:
+		parts = (tool, version, config, file_hash(path))
+		if root:
+			parts += (os.path.relpath(path, root),)
+		key = cache.cache_key(*parts)
+		data = cache.load_json(cache_dir, KIND, key)
+		if data is None:
+			missing.append(path)
+			keys[path] = key
+		else:
+			cached[path] = data
+	return cached, missing, keys
+
+
+def store_files(cache_dir, keys, findings):
+	for path, key in keys.items():
+		if path in findings:
+			cache.store_json(cache_dir, KIND, key, findings[path])
+
+
+# Pylint (json2 format): the messages of each file. The score of a run can't be split by file (it depends on the
+# number of statements, which is not in the report), so a report rebuilt from the cache has no score
+
+def split_pylint(report, files):
+	try:
+		with open(report, "r") as json_file:
+			data = json.load(json_file)
+	except (FileNotFoundError, json.JSONDecodeError):
+		return {}
+
+	findings = {path: {"messages": []} for path in files}
+	for message in data.get("messages", []):
+		path = message.get("absolutePath") or message.get("path")
+		if path in findings:
+			message = {name: value for name, value in message.items() if name not in ("path", "absolutePath")}
+			findings[path]["messages"].append(message)
+	return findings
+
+
+def join_pylint(findings, output):
+	# Same layout as merge_pylint_reports
+	messages = []
+	type_count = {}
+	for path, data in sorted(findings.items()):
+		for message in data["messages"]:
+			messages.append({**message, "path": path, "absolutePath": path})
+			type_count[message.get("type")] = type_count.get(message.get("type"), 0) + 1
+
+	report = {
+		"messages": messages,
+		"statistics": {
+			"messageTypeCount": type_count,
+			"modulesLinted": len(findings),
+			"score": None
+		}
+	}
+	with open(output, "w") as json_file:
+		json.dump(report, json_file, indent=4)
+
+
+# Bandit (json format): results, metrics and errors of each file, the totals are the sum of the metrics of the files
+
+def split_bandit(merged, files):
+	findings = {path: {"results": [], "metrics": merged["metrics"].get(path, {}), "errors": []} for path in files}
+	for name in ("results", "errors"):
+		for item in merged[name]:
+			if item.get("filename") in findings:
+				findings[item["filename"]][name].append({key: value for key, value in item.items() if key != "filename"})
+	return findings
+
+
+def join_bandit(findings):
+	reports = []
+	for path, data in findings.items():
+		reports.append({
+			"results": [{**result, "filename": path} for result in data["results"]],
+			"errors": [{**error, "filename": path} for error in data["errors"]],
+			"metrics": {path: data["metrics"], "_totals": data["metrics"]}
+		})
+	return bandit_shards.merge_results(reports)
+
+
+# Spotbugs: the BugInstances of each jar or class file, assigned by the name of their primary class
+
+def class_entries(path):
+	# Paths of the classes contained in a file, one level of nested archives is also read (Eg. WEB-INF/lib in a war)
+	if path.endswith(".class"):
+		return [path]
+	entries = []
+	try:
+		with zipfile.ZipFile(path) as archive:
+			for name in archive.namelist():
+				if name.endswith(".class"):
+					entries.append(name)
+				elif name.endswith(".jar"):
+					with zipfile.ZipFile(io.BytesIO(archive.read(name))) as nested:
+						entries += [entry for entry in nested.namelist() if entry.endswith(".class")]
+	except (zipfile.BadZipFile, OSError):
+		pass
+	return entries
+
+
+def class_index(files):
+	# The package root of a class is not known, so classes are found by file name and then matched on the package path
+	index = {}
+	for path in files:
+		for entry in class_entries(path):
+			index.setdefault(os.path.basename(entry), []).append(("/" + entry, path))
+	return index
+
+
+def owner_of(bug, index):
+	primary = bug.find("Class[@primary='true']")
+	if primary is None:
+		primary = bug.find("Class")
+	if primary is None:
+		return None
+	suffix = "/" + primary.get("classname", "").replace(".", "/") + ".class"
+	for entry, path in index.get(os.path.basename(suffix), []):
+		if entry.endswith(suffix):
+			return path
+	return None
+
+
+def split_spotbugs(report, files):
+	# Returns the BugInstances of each file and those that could not be assigned to any file
+	findings = {path: [] for path in files}
+	unassigned = []
+	if not os.path.isfile(report):
+		return findings, unassigned
+	index = class_index(files)
+	depth = 0
+	root = None
+	for event, element in ET.iterparse(report, events=("start", "end")):
+		if event == "start":
+			if root is None:
+				root = element
+			depth += 1
+			continue
+		depth -= 1
+		if depth == 1:
+			if element.tag == "BugInstance":
+				owner = owner_of(element, index)
+				bug = ET.tostring(element, encoding="unicode")
+				if owner is None:
+					unassigned.append(bug)
+				else:
+					findings[owner].append(bug)
+			root.clear()
+	return findings, unassigned
+
+
+def write_spotbugs(bugs, output):
+	with open(output, "w", encoding="utf-8") as out_file:
+		out_file.write('<?xml version="1.0" encoding="UTF-8"?>\n<BugCollection>\n')
+		out_file.writelines(bugs)
+		out_file.write("</BugCollection>\n")
+
+
+def join_spotbugs(findings, unassigned, output):
+	# The BugInstances are written in a single report, then merged to remove the duplicates
+	descriptor, bugs_file = tempfile.mkstemp(suffix=".xml")
+	os.close(descriptor)
+	try:
+		write_spotbugs([bug for bugs in findings.values() for bug in bugs] + unassigned, bugs_file)
+		return spotbugs_shards.merge_reports([bugs_file], output)
+	finally:
+		os.remove(bugs_file)
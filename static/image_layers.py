@@ -0,0 +1,383 @@
+import hashlib
+import json
+import os
+import posixpath
+import shutil
+import subprocess
+import tarfile
+import threading
+import zlib
+
+from common import docker_api
+
+# Reads the layers of an image from the 'docker save' stream, read straight from the Docker API. Only the files that are needed for the
+# analysis (Eg. .py files under the workdir) are written to disk, first in a staging folder for each
+# layer and then moved to the final filesystem applying the layers in order (the order is only known
+# once manifest.json is read, which can come after the layers in the stream). Both the legacy format (<id>/layer.tar) and the OCI layout (blobs/sha256/<digest>) used by
+# recent Docker versions are supported. With the containerd image store the layers are saved as they were pulled, compressed
+# with gzip or zstd, so they are decompressed while they are read. The digest of each layer is computed on the uncompressed tar,
+# so it matches the diff_id of the image config
+
+WHITEOUT_PREFIX = ".wh."
+OPAQUE_WHITEOUT = ".wh..wh..opq"
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+CHUNK_SIZE = 1024 * 1024
+
+# Passes over the image to read the targets of the links, a link to a link needs one more pass
+MAX_LINK_PASSES = 3
+
+
+class HashingReader:
+	# File-like wrapper that computes the sha256 of everything that is read through it.
+	# The bytes already consumed to detect the file type are given back first
+	def __init__(self, stream, prefix=b""):
+		self.stream = stream
+		self.prefix = prefix
+		self.sha256 = hashlib.sha256(prefix)
+
+	def read(self, size=-1):
+		data = b""
+		if self.prefix:
+			if size is None or size < 0:
+				data, self.prefix = self.prefix, b""
+			else:
+				data, self.prefix = self.prefix[:size], self.prefix[size:]
+				size -= len(data)
+				if size == 0:
+					return data
+		chunk = self.stream.read(size)
+		self.sha256.update(chunk)
+		return data + chunk
+
+	def drain(self):
+		while self.read(1024 * 1024):
+			pass
+		return "sha256:" + self.sha256.hexdigest()
+
+
+class DecompressingReader:
+	# File-like wrapper that decompresses a gzip or zstd stream while it is read. new_decompressor is called
+	# again for each following frame (Eg. zstd:chunked layers are made of many frames)
+	def __init__(self, stream, prefix, new_decompressor):
+		self.stream = stream
+		self.pending = prefix
+		self.new_decompressor = new_decompressor
+		self.decompressor = new_decompressor()
+		self.buffer = b""
+		self.offset = 0
+
+	def refill(self):
+		while True:
+			data, self.pending = self.pending or self.stream.read(CHUNK_SIZE), b""
+			if not data:
+				return False
+			if self.decompressor.eof:
+				self.decompressor = self.new_decompressor()
+			self.buffer = self.decompressor.decompress(data)
+			self.offset = 0
+			if self.decompressor.eof and self.decompressor.unused_data:
+				self.pending = self.decompressor.unused_data
+			if self.buffer:
+				return True
+
+	def read(self, size=-1):
+		parts = []
+		while size != 0:
+			if self.offset == len(self.buffer) and not self.refill():
+				break
+			end = len(self.buffer) if size is None or size < 0 else min(len(self.buffer), self.offset + size)
+			parts.append(self.buffer[self.offset:end])
+			if size is not None and size >= 0:
+				size -= end - self.offset
+			self.offset = end
+		return b"".join(parts)
+
+	def close(self):
+		pass
+
+
+class ProcessReader:
+	# File-like wrapper that decompresses a stream with an external command (Eg. zstd -d), fed by a thread
+	def __init__(self, stream, prefix, command):
+		self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+		self.feeder = threading.Thread(target=self.feed, args=(stream, prefix), daemon=True)
+		self.feeder.start()
+
+	def feed(self, stream, prefix):
+		try:
+			self.process.stdin.write(prefix)
+			while chunk := stream.read(CHUNK_SIZE):
+				self.process.stdin.write(chunk)
+		except (BrokenPipeError, ValueError):
+			pass
+		finally:
+			try:
+				self.process.stdin.close()
+			except BrokenPipeError:
+				pass
+
+	def read(self, size=-1):
+		data = self.process.stdout.read(size)
+		if not data and size != 0:
+			self.feeder.join()
+			if self.process.wait() != 0:
+				raise ValueError(f"{self.process.args[0]} could not decompress the layer")
+		return data
+
+	def close(self):
+		self.process.kill()
+		self.feeder.join()
+		self.process.wait()
+
+
+def gzip_decompressor():
+	return zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+
+
+def zstd_reader(content, prefix):
+	# The zstd module is in the standard library since Python 3.14, with older versions the zstd command is used
+	try:
+		from compression import zstd
+	except ImportError:
+		if shutil.which("zstd"):
+			return ProcessReader(content, prefix, ["zstd", "-d", "-c", "-q"])
+		raise ValueError("the image has zstd compressed layers, which need Python 3.14 or the zstd command")
+	return DecompressingReader(content, prefix, zstd.ZstdDecompressor)
+
+
+def is_tar_header(block):
+	# An empty layer is a tar made only of the end of archive blocks
+	return len(block) >= 262 and block[257:262] == b"ustar" or len(block) == 512 and not block.strip(b"\0")
+
+
+def open_layer(content):
+	# Returns a reader of the uncompressed layer, or None if the file is not a layer (Eg. the image config in the OCI layout)
+	block = content.read(512)
+	if block.startswith(GZIP_MAGIC):
+		content = DecompressingReader(content, block, gzip_decompressor)
+	elif block.startswith(ZSTD_MAGIC):
+		content = zstd_reader(content, block)
+	else:
+		return HashingReader(content, block) if is_tar_header(block) else None
+	block = content.read(512)
+	if is_tar_header(block):
+		return HashingReader(content, block)
+	content.close()
+	return None
+
+
+def normalize(name):
+	# Paths inside the layers are relative ("./usr/bin" or "usr/bin"), they are returned as absolute.
+	# Targets of symbolic links can also be absolute
+	return posixpath.normpath("/" + name.lstrip("/"))
+
+
+def link_target(path, member):
+	# Absolute path of the target of a link. Hard links name the target from the root of the layer,
+	# symbolic links can be relative to the folder of the link
+	if member.islnk():
+		return normalize(member.linkname)
+	return normalize(posixpath.join(posixpath.dirname(path), member.linkname))
+
+
+def extract_member(layer_tar, member, destination):
+	# Returns False for the links whose content could not be staged
+	if member.isreg():
+		os.makedirs(os.path.dirname(destination), exist_ok=True)
+		with open(destination, "wb") as out_file:
+			shutil.copyfileobj(layer_tar.extractfile(member), out_file)
+	elif member.islnk():
+		# Hard links can't be read in stream mode, but the target is in the same layer
+		# and it has already been extracted if it was accepted
+		target = destination[:len(destination) - len(normalize(member.name))] + normalize(member.linkname)
+		if not os.path.isfile(target):
+			return False
+		os.makedirs(os.path.dirname(destination), exist_ok=True)
+		shutil.copyfile(target, destination)
+	elif member.issym():
+		return False
+	return True
+
+
+def read_layer(reader, extract=None, staging=None):
+	# List the content of a single layer tar, separating the files from the whiteouts.
+	# The files accepted by extract (a function of the absolute path) are written in the staging folder.
+	# The accepted links without content (symbolic links, hard links to files that were not accepted) are listed
+	# with their target in links
+	layer = {"files": [], "whiteouts": [], "opaque": [], "links": [], "staging": staging}
+	with tarfile.open(fileobj=reader, mode="r|") as layer_tar:
+		for member in layer_tar:
+			path = normalize(member.name)
+			directory, base = posixpath.split(path)
+			if base == OPAQUE_WHITEOUT:
+				layer["opaque"].append(directory)
+			elif base.startswith(WHITEOUT_PREFIX):
+				layer["whiteouts"].append(posixpath.join(directory, base[len(WHITEOUT_PREFIX):]))
+			elif not member.isdir():
+				layer["files"].append(path)
+				if extract and extract(path) and not extract_member(layer_tar, member, staging + path):
+					layer["links"].append((path, link_target(path, member)))
+	layer["digest"] = reader.drain()
+	return layer
+
+
+def read_layers_from_stream(stream, extract=None, staging=None):
+	# Returns the layers of the image in order (the base layer first)
+	manifest = None
+	layers = {}
+	aliases = {}
+	with tarfile.open(fileobj=stream, mode="r|") as archive:
+		for member in archive:
+			if member.issym() or member.islnk():
+				# Recent Docker versions keep the legacy paths as links to the blobs
+				target = member.linkname if member.islnk() else posixpath.normpath(posixpath.join(posixpath.dirname(member.name), member.linkname))
+				aliases[member.name] = target
+				continue
+			if not member.isfile():
+				continue
+
+			content = archive.extractfile(member)
+			if member.name == "manifest.json":
+				manifest = json.load(content)
+				continue
+
+			# Layers are recognized from the content, since in the OCI layout blobs have no extension
+			reader = open_layer(content)
+			if reader is not None:
+				layer_staging = f"{staging}/{len(layers)}" if staging else None
+				layers[member.name] = read_layer(reader, extract, layer_staging)
+
+	if not manifest:
+		raise ValueError("manifest.json not found in the image archive")
+
+	ordered = []
+	for name in manifest[0]["Layers"]:
+		if aliases.get(name, name) not in layers:
+			raise ValueError(f"layer {name} of manifest.json is missing or it is not a tar archive")
+		ordered.append(layers[aliases.get(name, name)])
+	return ordered
+
+
+def read_layers(image, extract=None, staging=None, client=None):
+	with (client or docker_api.DockerClient()).save_image(image) as stream:
+		return read_layers_from_stream(stream, extract, staging)
+
+
+def remove(path):
+	if os.path.isdir(path) and not os.path.islink(path):
+		shutil.rmtree(path, ignore_errors=True)
+	elif os.path.lexists(path):
+		os.remove(path)
+
+
+def compose(layers, root, skip=None):
+	# Build the final filesystem in root from the staging folders of the layers, in order.
+	# The files contained in skip (Eg. a PathIndex) are left in the staging folders, which are then deleted
+	try:
+		compose_layers(layers, root, skip)
+	finally:
+		for layer in layers:
+			if layer["staging"]:
+				shutil.rmtree(layer["staging"], ignore_errors=True)
+
+
+def compose_layers(layers, root, skip):
+	for layer in layers:
+		for opaque in layer["opaque"]:
+			if os.path.isdir(root + opaque):
+				shutil.rmtree(root + opaque, ignore_errors=True)
+		for removed in layer["whiteouts"]:
+			remove(root + removed)
+		
+		staging = layer["staging"]
+		if not staging or not os.path.isdir(staging):
+			continue
+		for directory, _, files in os.walk(staging):
+			for name in files:
+				source = os.path.join(directory, name)
+				path = source[len(staging):]
+				if skip is not None and path in skip:
+					continue
+				destination = root + path
+				if os.path.isdir(destination) and not os.path.islink(destination):
+					shutil.rmtree(destination, ignore_errors=True)
+				os.makedirs(os.path.dirname(destination), exist_ok=True)
+				os.replace(source, destination)
+
+
+def stage_image(image, root, extract, client=None):
+	# Stream the image layers and write in the staging folders only the files accepted by extract.
+	# Returns the layers, as read_layers does; compose is then used to build the filesystem in root
+	staging = root.rstrip("/") + "-layers"
+	os.makedirs(root, exist_ok=True)
+	try:
+		layers = read_layers(image, extract, staging, client)
+		stage_links(image, layers, staging, client)
+		return layers
+	except Exception:
+		shutil.rmtree(staging, ignore_errors=True)
+		raise
+
+
+def stage_links(image, layers, staging, client=None):
+	# The targets of the links listed by read_layer (Eg. a versioned jar, or a file outside the workdir) are read
+	# in another pass over the image and composed in a separate folder. Their content is then copied in the staging
+	# folder of the layer of the link, so the link is composed like a regular file, and listed in the linked files
+	# of the layer. The links that could not be resolved (Eg. links to folders, or broken links) are left in the links
+	# of their layer
+	pending = [(layer, path, target) for layer in layers if layer["staging"] for path, target in layer["links"]]
+	for layer in layers:
+		layer["links"] = []
+		layer["linked"] = []
+	links_root = f"{staging}/links"
+	for _ in range(MAX_LINK_PASSES):
+		if not pending:
+			break
+		targets = {target for _, _, target in pending}
+		try:
+			link_layers = read_layers(image, lambda path: path in targets, links_root + "-layers", client)
+			# The targets that are links themselves are followed in the next pass
+			next_targets = {path: target for link_layer in link_layers for path, target in link_layer["links"]}
+			compose(link_layers, links_root)
+			unresolved = []
+			for layer, path, target in pending:
+				source = links_root + target
+				if os.path.isfile(source):
+					os.makedirs(os.path.dirname(layer["staging"] + path), exist_ok=True)
+					shutil.copyfile(source, layer["staging"] + path)
+					layer["linked"].append(path)
+				elif target in next_targets:
+					unresolved.append((layer, path, next_targets[target]))
+				else:
+					layer["links"].append((path, target))
+			pending = unresolved
+		finally:
+			shutil.rmtree(links_root, ignore_errors=True)
+			shutil.rmtree(links_root + "-layers", ignore_errors=True)
+	for layer, path, target in pending:
+		layer["links"].append((path, target))
+
+
+def is_under(path, directory):
+	return directory == "/" or path == directory or path.startswith(directory.rstrip("/") + "/")
+
+
+def file_owners(layers, directory, accept):
+	# Map each file under directory that is accepted by the filter to the digest of the
+	# topmost layer that provides it, applying the whiteouts of the upper layers
+	owners = {}
+	for layer in layers:
+		for opaque in layer["opaque"]:
+			if is_under(directory, opaque) or is_under(opaque, directory):
+				for path in [p for p in owners if is_under(p, opaque) and p != opaque]:
+					del owners[path]
+		for removed in layer["whiteouts"]:
+			if is_under(directory, removed) or is_under(removed, directory):
+				for path in [p for p in owners if is_under(p, removed)]:
+					del owners[path]
+		for path in layer["files"]:
+			if is_under(path, directory) and accept(path):
+				owners[path] = layer["digest"]
+	return owners
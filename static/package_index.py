@@ -0,0 +1,125 @@
+import os
+import posixpath
+import sqlite3
+import struct
+
+import image_layers
+
+# Lists the files installed with a package manager by parsing the package databases found in the
+# staged image layers, without starting a container. Supported databases: dpkg (Debian/Ubuntu),
+# apk (Alpine) and the sqlite rpmdb (Red Hat based images from RHEL 9 / Fedora 33). The older
+# BerkeleyDB rpmdb can't be parsed here, so for those images the files are listed with rpm inside a container
+
+DPKG_INFO = "/var/lib/dpkg/info"
+APK_DB = "/lib/apk/db/installed"
+RPM_SQLITE = ("/var/lib/rpm/rpmdb.sqlite", "/usr/lib/sysimage/rpm/rpmdb.sqlite")
+RPM_BDB = ("/var/lib/rpm/Packages", "/usr/lib/sysimage/rpm/Packages")
+
+# rpm header tags and types
+RPMTAG_DIRINDEXES = 1116
+RPMTAG_BASENAMES = 1117
+RPMTAG_DIRNAMES = 1118
+RPM_INT32_TYPE = 4
+RPM_STRING_ARRAY_TYPE = 8
+
+
+def is_package_db(path):
+	return (posixpath.dirname(path) == DPKG_INFO and path.endswith(".list")) or path == APK_DB or path in RPM_SQLITE or path in RPM_BDB
+
+
+def contains_package_db(folder):
+	# An opaque or removed folder replaces the package databases below it (Eg. /var/lib/rpm or /lib/apk/db)
+	return any(image_layers.is_under(path, folder) for path in (DPKG_INFO, APK_DB, *RPM_SQLITE, *RPM_BDB))
+
+
+def package_db_layers(layers):
+	# Digests of the layers up to the topmost one that changes a package database: the installed files
+	# only depend on these layers, so they identify the base image for the cache
+	top = -1
+	for index, layer in enumerate(layers):
+		if any(is_package_db(path) for path in layer["files"] + layer["whiteouts"]) or any(contains_package_db(path) for path in layer["opaque"] + layer["whiteouts"]):
+			top = index
+	return [layer["digest"] for layer in layers[:top + 1]]
+
+
+def staged_files(layers, directory, accept):
+	# Staged location of the final version of the files under directory accepted by the filter
+	staging = {layer["digest"]: layer["staging"] for layer in layers}
+	owners = image_layers.file_owners(layers, directory, accept)
+	return {path: staging[digest] + path for path, digest in owners.items() if os.path.isfile(staging[digest] + path)}
+
+
+def read_dpkg(list_files):
+	installed = []
+	for list_file in list_files:
+		with open(list_file, "r", errors="replace") as file:
+			installed += [line.rstrip("\n") for line in file if line.strip()]
+	return installed
+
+
+def read_apk(db_file):
+	# Each package has F: lines for the folders, followed by R: lines for the files in that folder
+	installed = []
+	folder = ""
+	with open(db_file, "r", errors="replace") as file:
+		for line in file:
+			if line.startswith("F:"):
+				folder = line[2:].strip()
+			elif line.startswith("R:"):
+				installed.append("/" + posixpath.join(folder, line[2:].strip()))
+			elif not line.strip():
+				folder = ""
+	return installed
+
+
+def parse_rpm_header(blob):
+	# Header blob: index count and data length, then the index entries (tag, type, offset, count) and the data
+	index_count, data_length = struct.unpack(">II", blob[:8])
+	data_start = 8 + index_count * 16
+	data = blob[data_start:data_start + data_length]
+	tags = {}
+	for i in range(index_count):
+		tag, tag_type, offset, count = struct.unpack(">IIiI", blob[8 + i * 16:8 + (i + 1) * 16])
+		if tag_type == RPM_INT32_TYPE:
+			tags[tag] = list(struct.unpack(f">{count}i", data[offset:offset + count * 4]))
+		elif tag_type == RPM_STRING_ARRAY_TYPE:
+			strings = data[offset:].split(b"\0", count)[:count]
+			tags[tag] = [string.decode(errors="replace") for string in strings]
+	return tags
+
+
+def read_rpm_sqlite(db_file):
+	installed = []
+	connection = sqlite3.connect(f"file:{db_file}?mode=ro&immutable=1", uri=True)
+	try:
+		for (blob,) in connection.execute("SELECT blob FROM Packages"):
+			tags = parse_rpm_header(blob)
+			dirnames = tags.get(RPMTAG_DIRNAMES, [])
+			for basename, dirindex in zip(tags.get(RPMTAG_BASENAMES, []), tags.get(RPMTAG_DIRINDEXES, [])):
+				installed.append(dirnames[dirindex] + basename)
+	finally:
+		connection.close()
+	return installed
+
+
+def read_installed_files(layers):
+	# Returns the package manager ("dpkg", "apk", "rpm" or None if no database was found) and the installed files.
+	# The files are None if the database exists but can't be parsed
+	dpkg_lists = staged_files(layers, DPKG_INFO, lambda path: path.endswith(".list"))
+	if dpkg_lists:
+		return "dpkg", read_dpkg(dpkg_lists.values())
+
+	apk_db = staged_files(layers, APK_DB, lambda path: path == APK_DB)
+	if apk_db:
+		return "apk", read_apk(apk_db[APK_DB])
+
+	rpm_sqlite = staged_files(layers, "/", lambda path: path in RPM_SQLITE)
+	if rpm_sqlite:
+		try:
+			return "rpm", read_rpm_sqlite(next(iter(rpm_sqlite.values())))
+		except (sqlite3.Error, struct.error, IndexError):
+			return "rpm", None
+
+	if staged_files(layers, "/", lambda path: path in RPM_BDB):
+		return "rpm", None
+	return None, None
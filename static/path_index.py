@@ -0,0 +1,49 @@
+# In-memory index of absolute paths inside the image, used to skip files (Eg. the ones installed
+# with a package manager, or the folders given with --exclude) without touching the filesystem. Single
+# files are kept in a set, while folders are kept in a prefix trie so that everything below them is matched too
+
+TERMINAL = ""
+
+
+class PathIndex:
+	def __init__(self, files=(), folders=()):
+		self.files = set()
+		self.trie = {}
+		self.folders = 0
+		for path in files:
+			self.add_file(path)
+		for path in folders:
+			self.add_folder(path)
+
+	@staticmethod
+	def normalize(path):
+		return "/" + path.strip().strip("/")
+
+	def add_file(self, path):
+		self.files.add(self.normalize(path))
+
+	def add_folder(self, path):
+		node = self.trie
+		for part in self.normalize(path).split("/")[1:]:
+			node = node.setdefault(part, {})
+		if TERMINAL not in node:
+			node[TERMINAL] = True
+			self.folders += 1
+
+	def __contains__(self, path):
+		path = self.normalize(path)
+		if path in self.files:
+			return True
+		node = self.trie
+		if TERMINAL in node:
+			return True
+		for part in path.split("/")[1:]:
+			node = node.get(part)
+			if node is None:
+				return False
+			if TERMINAL in node:
+				return True
+		return False
+
+	def __len__(self):
+		return len(self.files) + self.folders
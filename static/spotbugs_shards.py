@@ -0,0 +1,187 @@
+import os
+import struct
+import xml.etree.ElementTree as ET
+from pathlib import Path
+from xml.sax.saxutils import quoteattr
+
+from common import metrics
+
+# Helpers to split a Spotbugs analysis in shards that run in separate JVMs, and to merge their XML reports
+
+ARCHIVE_EXTENSIONS = (".jar", ".ear", ".war", ".zip")
+
+CLASS_MAGIC = b"\xca\xfe\xba\xbe"
+
+# Size of the constant pool entries after the tag byte, by tag (UTF8 entries have a variable size)
+CONSTANT_SIZES = {3: 4, 4: 4, 5: 8, 6: 8, 7: 2, 8: 2, 9: 4, 10: 4, 11: 4, 12: 4, 15: 3, 16: 2, 17: 4, 18: 4, 19: 2, 20: 2}
+
+# Top-level elements that are merged by key instead of being taken from the first report only
+MERGE_KEYS = {
+	"BugCategory": "category",
+	"BugPattern": "type",
+	"BugCode": "abbrev",
+}
+
+
+def discover_units(targets):
+	# The unit of work is an archive, or the .class files below a top-level folder of a target
+	# (classes of the same package tree must stay together). Returns (size, [paths]) tuples
+	units = []
+	for target in targets:
+		target = Path(target)
+		if target.is_file():
+			units.append((target.stat().st_size, [str(target)]))
+			continue
+		groups = {}
+		for directory, _, files in os.walk(target):
+			relative = Path(directory).relative_to(target).parts
+			group = relative[0] if relative else ""
+			for name in files:
+				path = os.path.join(directory, name)
+				if name.endswith(ARCHIVE_EXTENSIONS):
+					units.append((os.path.getsize(path), [path]))
+				elif name.endswith(".class"):
+					entry = groups.setdefault(group, [0, []])
+					entry[0] += os.path.getsize(path)
+					entry[1].append(path)
+		units += [(size, paths) for size, paths in groups.values()]
+	return units
+
+
+def make_shards(units, count):
+	# Largest units first, each one in the shard with the smallest total size
+	shards = [[0, []] for _ in range(max(1, count))]
+	for size, paths in sorted(units, key=lambda unit: unit[0], reverse=True):
+		shard = min(shards, key=lambda shard: shard[0])
+		shard[0] += size
+		shard[1] += paths
+	return [paths for _, paths in shards if paths]
+
+
+def class_name(path):
+	# Name of the class defined by a class file (Eg. com/example/Main), read from its constant pool
+	try:
+		with open(path, "rb") as class_file:
+			data = class_file.read()
+		if not data.startswith(CLASS_MAGIC):
+			return None
+		count = struct.unpack_from(">H", data, 8)[0]
+		offset = 10
+		strings = {}
+		classes = {}
+		index = 1
+		while index < count:
+			tag = data[offset]
+			if tag == 1:
+				length = struct.unpack_from(">H", data, offset + 1)[0]
+				strings[index] = data[offset + 3:offset + 3 + length].decode("utf-8", "replace")
+				offset += 3 + length
+			elif tag in CONSTANT_SIZES:
+				if tag == 7:
+					classes[index] = struct.unpack_from(">H", data, offset + 1)[0]
+				offset += 1 + CONSTANT_SIZES[tag]
+				# Long and double entries take two slots of the pool
+				if tag in (5, 6):
+					index += 1
+			else:
+				return None
+			index += 1
+		this_class = struct.unpack_from(">H", data, offset + 2)[0]
+		return strings.get(classes.get(this_class))
+	except (OSError, struct.error, IndexError):
+		return None
+
+
+def classpath_entries(paths):
+	# Classpath giving access to the classes in paths: the archives themselves and, for the class files,
+	# the root of their package tree, found from the class name of one class file of each folder
+	entries = {}
+	folders = set()
+	for path in map(str, paths):
+		if not path.endswith(".class"):
+			entries[path] = True
+			continue
+		folder = os.path.dirname(path)
+		if folder in folders:
+			continue
+		folders.add(folder)
+		name = class_name(path)
+		if name and path.endswith("/" + name + ".class"):
+			entries[path[:-len(name + ".class")].rstrip("/") or "/"] = True
+	return list(entries)
+
+
+def bug_key(element):
+	return element.get("instanceHash") or ET.tostring(element)
+
+
+@metrics.timed("merge_spotbugs_reports")
+def merge_reports(filepaths, output):
+	# BugInstances are streamed to the output and deduplicated by instanceHash, the Jar elements of the
+	# projects are joined and the class features are deduplicated by class name. The other top-level
+	# elements (Eg. FindBugsSummary) are taken from the first report
+	seen_bugs = set()
+	seen_classes = set()
+	keyed = {}
+	first = {}
+	root_attributes = None
+	project = None
+	class_features = None
+
+	with open(output, "w", encoding="utf-8") as out_file:
+		for filepath in filepaths:
+			if not Path(filepath).is_file():
+				continue
+			depth = 0
+			root = None
+			try:
+				for event, element in ET.iterparse(filepath, events=("start", "end")):
+					if event == "start":
+						if root is None:
+							root = element
+							if root_attributes is None:
+								root_attributes = dict(root.attrib)
+								attributes = "".join(f" {name}={quoteattr(value)}" for name, value in root_attributes.items())
+								out_file.write(f'<?xml version="1.0" encoding="UTF-8"?>\n<{root.tag}{attributes}>\n')
+						depth += 1
+						continue
+
+					depth -= 1
+					if depth != 1:
+						continue
+
+					if element.tag == "BugInstance":
+						key = bug_key(element)
+						if key not in seen_bugs:
+							seen_bugs.add(key)
+							out_file.write(ET.tostring(element, encoding="unicode"))
+					elif element.tag == "Project":
+						if project is None:
+							project = element
+						else:
+							jars = {jar.text for jar in project.findall("Jar")}
+							for jar in element.findall("Jar"):
+								if jar.text not in jars:
+									project.append(jar)
+					elif element.tag == "ClassFeatures":
+						if class_features is None:
+							class_features = ET.Element("ClassFeatures")
+						for feature_set in element.findall("ClassFeatureSet"):
+							if feature_set.get("class") not in seen_classes:
+								seen_classes.add(feature_set.get("class"))
+								class_features.append(feature_set)
+					elif element.tag in MERGE_KEYS:
+						keyed.setdefault((element.tag, element.get(MERGE_KEYS[element.tag])), element)
+					else:
+						first.setdefault(element.tag, element)
+					root.clear()
+			except ET.ParseError as ex:
+				print(f"\033[1;91mInvalid Spotbugs report {filepath}: {ex}\033[0m")
+
+		if root_attributes is None:
+			return False
+		for element in [project, *keyed.values(), *first.values(), class_features]:
+			if element is not None:
+				out_file.write(ET.tostring(element, encoding="unicode"))
+		out_file.write("</BugCollection>\n")
+	return True
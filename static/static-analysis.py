@@ -4,29 +4,70 @@ import subprocess
 import re
 import os
 import json
+import time
+import ast
+import functools
+import shutil
+import tempfile
+import tarfile
+import zlib
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
 
-def docker_bench_analysis(image, docker_bench_path, outfolder):
+# The modules shared by the analysis scripts are in the common folder
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from common import cache, docker_api, docker_bench, metrics
+
+import arg_chunks
+import image_layers
+import trivy_results
+import trivy_server
+import package_index
+import bandit_shards
+import spotbugs_shards
+import findings_cache
+from path_index import PathIndex
+
+# File extensions analyzed for each language
+LANG_EXTENSIONS = {
+	"python": ("py",),
+	"java": ("jar", "ear", "war", "zip", "class")
+}
+
+# Folders always excluded from the Python analysis
+PYTHON_EXCLUDED = ("env", "venv", ".env", ".venv")
+
+# Options of the analyzers, they are also part of the key of the findings cache
+PYLINT_OPTIONS = ("-j", "0", "-f", "json2")
+SPOTBUGS_OPTIONS = ("-textui", "-progress", "-low", "-quiet")
+
+def docker_bench_analysis(image, image_id, outfolder, options):
 	print(f"\033[1;32m\nStarting Docker-bench-security analysis\033[0m")
 	
 	# Remove tag from the image because docker-bench doesn't want it	
 	stripped_image = image.split(':')[0]
 	
-	main_directory = os.getcwd()
-	os.chdir(docker_bench_path)
-	subprocess.run(f"sh docker-bench-security.sh -b -p -i {stripped_image} -c container_images -l {main_directory}/{outfolder}/docker_bench", 
-		shell=True, capture_output=True)
-	# Remove unnecessary output file
-	subprocess.run(f"rm {main_directory}/{outfolder}/docker_bench", shell=True)
-	os.chdir(main_directory)
+	# With the cache, the host checks are reused until the daemon configuration changes
+	# and the image checks are reused for the same image id
+	cache_dir = options.cache_dir if options.cache else None
+	max_age = options.cache_max_age * 3600
+	host_sections, host_cached = docker_bench.host_analysis(options.docker_bench_path, options.docker_bench_checks, outfolder, cache_dir, max_age)
+	image_sections, image_cached = docker_bench.target_analysis(options.docker_bench_path, options.docker_bench_checks, stripped_image, image_id,
+		outfolder, cache_dir, max_age)
+	docker_bench.write_log(host_sections + image_sections, f"{outfolder}/docker_bench.json")
+	
+	summary = docker_bench.summarize(host_sections + image_sections)
+	summary["checks"] = options.docker_bench_checks
+	summary["cached"] = [scope for scope, cached in (("host", host_cached), ("image", image_cached)) if cached]
 	print("Done")
+	return summary
 	
 
-def generate_report(image, lang, trivy_out, trivy_mode, lang_out, outfolder, workdir, excluded_paths):
+def generate_report(image, lang, trivy_out, trivy_mode, lang_out, docker_bench_out, outfolder, workdir, excluded_paths, timings):
 	print("\033[1;32m\nGenerating final report\033[0m")
 
-	# Check if the language analysis was skipped
+	# Check if the language analysis was skipped (no workdir) or failed (the filesystem could not be extracted)
 	code_section = {
 		"workdir": workdir,
 		"excluded_paths": excluded_paths,
@@ -36,7 +77,7 @@ def generate_report(image, lang, trivy_out, trivy_mode, lang_out, outfolder, wor
         	"medium": lang_out[1],
         	"high": lang_out[2]
 		}
-	} if lang_out else "skipped" 
+	} if lang_out else "failed" if lang_out is None else "skipped" 
 
 	summary_section = {
     	"low": lang_out[0] + trivy_out[0] + trivy_out[3],
@@ -47,7 +88,7 @@ def generate_report(image, lang, trivy_out, trivy_mode, lang_out, outfolder, wor
 			"low": trivy_out[0] + trivy_out[3],
 			"medium": trivy_out[1] + trivy_out[4],
 			"high": trivy_out[2] + trivy_out[5],
-			"size": "skipped"
+			"size": code_section
 		} 
 	
 	# Build the JSON structure dynamically
@@ -69,11 +110,17 @@ def generate_report(image, lang, trivy_out, trivy_mode, lang_out, outfolder, wor
 					"low": trivy_out[3],
 					"medium": trivy_out[4],
 					"high": trivy_out[5]
-				}	
+				},
+				"targets": trivy_out[8]
 		    },
+		    "dockerBench": docker_bench_out,
 		    "code": code_section, 
 		    "summary": summary_section
-		}
+		},
+		# Wall-clock time of each analysis stage, in seconds from the start of the pipeline
+		"timings": timings,
+		# Time, CPU, peak memory and disk I/O of the stages, tools and parsers
+		"metrics": metrics.report()
 	}
 
 	# Save to JSON file
@@ -81,6 +128,7 @@ def generate_report(image, lang, trivy_out, trivy_mode, lang_out, outfolder, wor
 		json.dump(data, json_file, indent=4)
 
 
+@metrics.timed("parse_bandit")
 def parse_bandit(filepath):
 	with open(filepath, "r") as file:
 		content = file.read()
@@ -105,53 +153,88 @@ def parse_bandit(filepath):
 	return results
 
 
+@metrics.timed("parse_spotbugs")
 def parse_spotbugs(filepath):
-	# Parse the XML file
-	tree = ET.parse(filepath)
-	root = tree.getroot()
+	# The XML file is parsed in a single streaming pass: every element directly below the root 
+	# is cleared once it has been read, so memory does not grow with the size of the report
 
 	# Count the number of issues with priority 1, 2 and 3 (1 being HIGH)
 	# belonging to the SECURITY category
 	counts = {priority: 0 for priority in ['1', '2', '3']}
-	for bug in root.findall('BugInstance'):
-		if bug.get('category') == 'SECURITY':  
-		    priority = bug.get('priority')
-		    if priority in counts:  
-		        counts[priority] += 1
 	
 	# Count the number of unique classes analyzed 
 	# This is used as a Java project size metric
 	analyzed_classes = set()
-	for class_element in root.findall(".//Class"):
-		class_name = class_element.get('classname') 
-		if class_name:
-		    analyzed_classes.add(class_name)
+	
+	depth = 0
+	root = None
+	for event, element in ET.iterparse(filepath, events=("start", "end")):
+		if event == "start":
+			if root is None:
+				root = element
+			depth += 1
+			continue
+		
+		depth -= 1
+		if element.tag == 'Class':
+			class_name = element.get('classname') 
+			if class_name:
+			    analyzed_classes.add(class_name)
+		elif element.tag == 'BugInstance' and depth == 1:
+			if element.get('category') == 'SECURITY':  
+			    priority = element.get('priority')
+			    if priority in counts:  
+			        counts[priority] += 1
+		
+		if depth == 1:
+			root.clear()
 	
 	return [counts["3"], counts["2"], counts["1"], len(analyzed_classes)]
 
 
 
-def pull_image(image):
+def pull_image(image, client):
     print("\033[1;32m\nPulling Docker Image\033[0m")
     
-    result = subprocess.run(
-        ['docker', 'pull', image],
-        stderr=subprocess.PIPE,
-        text=True
-    )
-    if result.returncode != 0:
-        print(f"Error pulling image '{image}'\n{result.stderr}")
-        sys.exit(result.returncode)
+    # The pull progress is streamed by the API, only the status messages are printed (Eg. Pull complete), not the download progress
+    error = None
+    try:
+        for message in client.pull_image(image):
+            if message.get("status") and not message.get("progress"):
+                print(f"{message['id']}: {message['status']}" if message.get("id") else message["status"])
+    except OSError as ex:
+        print(f"Error pulling image '{image}'\nDocker API not reachable at {client.path}: {ex}")
+        sys.exit(1)
+    except docker_api.DockerError as ex:
+        error = str(ex)
+    
+    if error:
+        # The registry credentials are known by the docker CLI (Eg. credential helpers), not by the daemon
+        if not any(word in error.lower() for word in ("unauthorized", "denied", "authentication required")):
+            print(f"Error pulling image '{image}'\n{error}")
+            sys.exit(1)
+        result = metrics.run(
+            ['docker', 'pull', image], "docker_pull",
+            stderr=subprocess.PIPE,
+            text=True
+        )
+        if result.returncode != 0:
+            print(f"Error pulling image '{image}'\n{result.stderr}")
+            sys.exit(result.returncode)
         
     print(f"Successfully pulled image '{image}'.")
 
 
-def trivy_analysis(image, outfolder, trivy_mode):
+def trivy_analysis(image, outfolder, trivy_mode, trivy_table=False, trivy_server_url=None, trivy_cache_dir=None):
 	print("\033[1;32m\nStarting Trivy analysis\033[0m")
-	print("\033[1;38;5;214mIt could take some time to download the vulnerability database\033[0m")
 	
-	trivy_command = ["trivy","image", "--format=table", f"--output={outfolder}/trivyReport.txt", "--parallel=0", f"--detection-priority={trivy_mode}", image]
-	result = subprocess.run(trivy_command, capture_output=True, text=True)	
+	# Client mode if a Trivy server is available, otherwise standalone mode with the (shared) cache folder
+	mode_args, db_download = trivy_server.scan_args(trivy_server_url, trivy_cache_dir)
+	if db_download:
+		print("\033[1;38;5;214mIt could take some time to download the vulnerability database\033[0m")
+	
+	trivy_command = ["trivy","image", "--format=json", f"--output={outfolder}/trivyReport.json", "--parallel=0", f"--detection-priority={trivy_mode}"] + mode_args + [image]
+	result = metrics.run(trivy_command, "trivy", capture_output=True, text=True)	
 
 	# Note: The normal Trivy console output is actually stderr.
 	# stdout is used when the command has a wrong format in order to show the --help 
@@ -165,13 +248,30 @@ def trivy_analysis(image, outfolder, trivy_mode):
 		print(result.stdout)
 		print(console_output)
 		sys.exit(1)
-
-	# Check for supported OS
-	detected_os_pattern = r"Detected OS\s+(.+)"
+	
+	# Count the vulnerabilities (CRITICAL vulns are included into HIGH) reading the JSON report one record at a time.
+	# OS packages and language dependencies are told apart by the class of each target
 	detected_os = "Not supported"
-	match = re.search(detected_os_pattern, console_output)
-	if match:
-		detected_os = match.group(1)
+	os_counts = {severity: 0 for severity in trivy_results.SEVERITIES}
+	dep_counts = {severity: 0 for severity in trivy_results.SEVERITIES}
+	targets = []
+	table_records = []
+	with metrics.span("parse_trivy", "parser"), open(f"{outfolder}/trivyReport.json", "r") as json_file:
+		for record in trivy_results.read_report(json_file):
+			if trivy_table:
+				table_records.append(record)
+			if isinstance(record, trivy_results.TrivyMetadata) and record.os_family:
+				detected_os = f"{record.os_family} {record.os_name}".strip()
+			elif isinstance(record, trivy_results.TrivyTarget):
+				targets.append(record)
+	
+	for target in targets:
+		counts = os_counts if target.target_class == "os-pkgs" else dep_counts
+		for severity in counts:
+			counts[severity] += target.counts[severity]
+	
+	# Check for supported OS
+	if detected_os != "Not supported":
 		print("Trivy Image: Supported OS found - " + detected_os)	
 	else:
 		print("Trivy Image: OS not supported")
@@ -179,7 +279,7 @@ def trivy_analysis(image, outfolder, trivy_mode):
 	# Check for language-specific files
 	language_files_pattern = r"Number of language-specific files\s+num=(\d+)"
 	match = re.search(language_files_pattern, console_output)
-	files_count = match.group(1)
+	files_count = match.group(1) if match else str(len([t for t in targets if t.target_class == "lang-pkgs"]))
 	if files_count == "0":
 		print("Trivy Image: No language-specific files have been found\n")	
 	elif files_count == "1":
@@ -187,83 +287,45 @@ def trivy_analysis(image, outfolder, trivy_mode):
 	else:
 		print("Trivy Image: Found " + files_count + " language-specific files\n")
 	
-	# Count the vulnerabilities (CRITICAL vulns are included into HIGH)
-	os_low = 0
-	os_medium = 0
-	os_high = 0
-	dep_low = 0
-	dep_medium = 0
-	dep_high = 0
-	
-	# The first match is the OS line, the remaining are dependencies
-	first_match = True
-	with open(f'{outfolder}/trivyReport.txt', 'r') as file:
-		for line in file:
-			match = re.search(r'LOW: (\d+), MEDIUM: (\d+), HIGH: (\d+), CRITICAL: (\d+)', line)
-			if match:
-			
-				if first_match:
-					first_match = False
-					os_low = int(match.group(1))
-					os_medium = int(match.group(2))
-					os_high = int(match.group(3)) + int(match.group(4))
-				else:
-					dep_low += int(match.group(1))
-					dep_medium += int(match.group(2))
-					dep_high += int(match.group(3)) + int(match.group(4))
+	# The table report is only rendered if requested
+	if trivy_table:
+		with open(f"{outfolder}/trivyReport.txt", "w") as table_file:
+			table_file.write(trivy_results.render_table(table_records))
 	
-	return [os_low, os_medium, os_high, dep_low, dep_medium, dep_high, detected_os, files_count]
-
-
-def get_installed_files(image, os, lang):
-
-	# Define which file extensions will be considered 
-	if lang == "python":
-		lang_extensions = "py"
-	elif lang == "java":
-		lang_extensions = "jar|ear|war|zip|class"
-		
-	# Create empty out file (used for the files to exclude)
-	if Path("tmpout.txt").exists():
-		subprocess.run("rm tmpout.txt", shell=True)
-	subprocess.run("touch tmpout.txt", shell=True)
-		
-	# Differentiate among OS
-	if os in ["debian", "ubuntu"]:
-		inside_command = rf"dpkg --get-selections | grep -w 'install' | cut -f1 | xargs dpkg -L | grep -E '\.({lang_extensions})$' >> /tmpout.txt"
-		command = f"docker run --rm -v ./tmpout.txt:/tmpout.txt --entrypoint bash {image} -c \"{inside_command}\""
-	
-	elif os == "redhat":
-		inside_command = rf"rpm -qa --qf '%{{NAME}}\n' | xargs -I {{}} rpm -ql {{}} | grep -E '\.({lang_extensions})$' >> /tmpout.txt"
-		command = f"docker run --rm -v ./tmpout.txt:/tmpout.txt --entrypoint bash {image} -c \"{inside_command}\""
-		
-	elif os == "alpine":	
-		# Write a temporary entrypoint to be mounted into the container
-		# This is the only working solution I found for Alpine because using sh -c gives a lot of problems
-		alpine_sh_script = rf"""
-#!/bin/sh
-apk update > /dev/null
-apk info | while read -r package; do
-	apk info -L "$package" | grep -E '\.({lang_extensions})$' >> /tmpout.txt
-done
-"""
-		with open("./tmp_alpine_entrypoint.sh", "w") as script_file:
-			script_file.write(alpine_sh_script)
-		
-		command = f"docker run --rm -v ./tmpout.txt:/tmpout.txt -v ./tmp_alpine_entrypoint.sh:/tmp_alpine_entrypoint.sh --entrypoint sh {image} /tmp_alpine_entrypoint.sh"
-
+	target_summary = [{
+		"target": target.target,
+		"class": target.target_class,
+		"type": target.target_type,
+		"low": target.counts["LOW"],
+		"medium": target.counts["MEDIUM"],
+		"high": target.counts["HIGH"] + target.counts["CRITICAL"]
+	} for target in targets]
+	
+	return [os_counts["LOW"], os_counts["MEDIUM"], os_counts["HIGH"] + os_counts["CRITICAL"], 
+		dep_counts["LOW"], dep_counts["MEDIUM"], dep_counts["HIGH"] + dep_counts["CRITICAL"], detected_os, files_count, target_summary]
 
-	# Finally run the command
-	result = subprocess.run(command, shell=True, capture_output=True, text=True)
 
+def get_installed_files(image, lang, scratch):
+	# Only used for the images with a BerkeleyDB rpm database, which can't be read from the layers:
+	# the installed files are listed by rpm inside a container and written to a file mounted in it
+	lang_extensions = "|".join(LANG_EXTENSIONS[lang])
+	
+	# Create empty out file (used for the files to exclude) in the scratch folder of this scan
+	tmpout = Path(scratch).resolve() / "tmpout.txt"
+	tmpout.unlink(missing_ok=True)
+	tmpout.touch()
+	
+	inside_command = rf"rpm -qa --qf '%{{NAME}}\n' | xargs -I {{}} rpm -ql {{}} | grep -E '\.({lang_extensions})$' >> /tmpout.txt"
+	command = ["docker", "run", "--rm", "-v", f"{tmpout}:/tmpout.txt", "--entrypoint", "bash", image, "-c", inside_command]
+	try:
+		metrics.run(command, "docker_run_packages", capture_output=True, text=True)
+	except OSError:
+		# Without the docker CLI the out file stays empty
+		pass
+	
 	# Read the results
-	with open('tmpout.txt', 'r') as file:
-		files_to_exclude = file.read()
-		
-	# Cleanup tmp files
-	subprocess.run("rm ./tmpout.txt", shell=True)
-	if os == "alpine":
-		subprocess.run("rm ./tmp_alpine_entrypoint.sh", shell=True)	
+	files_to_exclude = tmpout.read_text()
+	tmpout.unlink()
 	
 	# The returncode will be different from 0 in case of errors or even if no files are found.
 	# Either way, this means that no installed files will be skipped
@@ -276,145 +338,759 @@ done
 	else:
 		return [1, ""]	
 
-def lang_analysis(image, detected_os, include_pkg, lang, given_workdir, spotbugs_path, outfolder, excluded_paths):
-	print(f"\033[1;32mStarting Language-Specific Analysis: {lang}\033[0m")
-	
+def inspect_image(image, client):
+	return client.inspect_image(image)
+
+
+def image_digest(image_info):
+	# The manifest digest is only known for pulled images, local builds are identified by the config digest
+	if image_info.get("RepoDigests"):
+		return image_info["RepoDigests"][0].split("@")[1]
+	return image_info["Id"]
+
+
+def get_workdir(image_info, given_workdir):
 	# If the workdir is given then that one is used, otherwise we try to fetch it from the image
-	workdir = ""
 	if given_workdir:
-		workdir = given_workdir
-	else: 
-		# Extract the WorkingDir
-		result = subprocess.run(
-		    ['docker', 'inspect', image],
-		    stdout=subprocess.PIPE,
-		    text=True
-		)    
+		return given_workdir
 		
-		image_info = json.loads(result.stdout)
-		workdir = image_info[0]["Config"].get("WorkingDir", "")
-		if not workdir:
-			print("\033[1;91mWorkingDir not detected, skipping analysis\033[0m")
-			return "",""
-	
-	# The absolute workdir is required, otherwise the excluded paths for Bandit and Pylint won't work
-	abs_workdir = Path("image-tmp" + workdir).resolve()
+	# Extract the WorkingDir
+	return image_info["Config"].get("WorkingDir", "")
+
+
+def stage_filesystem(image, lang, workdir, excluded_paths, include_pkg, scratch, client):
+	print(f"\033[1;32m\nStarting Language-Specific Analysis: {lang}\033[0m")
 			
-	# Extract image filesystem with Crane in a tmp folder 
-	# (apparently Crane doesn't allow to only extract the specific workdir)
-	if not os.path.exists("image-tmp"):
-		os.makedirs("image-tmp")
+	# The layers of the image are streamed from docker save and only the files under the workdir
+	# with the language extensions are staged. The excluded paths are skipped too: this is also how
+	# they are excluded from Spotbugs, which works with package/class names rather than directories.
+	# The package databases are staged too, unless --include_pkg is used
+	workdir = "/" + workdir.strip("/")
+	
+	def extract(path):
+		if not include_pkg and package_index.is_package_db(path):
+			return True
+		return image_layers.is_under(path, workdir) and path.rsplit(".", 1)[-1] in LANG_EXTENSIONS[lang] and not is_excluded(path, lang, excluded_paths)
+	
+	# Returns None if the filesystem could not be extracted: the code analysis is then reported as failed
 	print("\033[1;37mExtracting image filesystem\033[0m")
-	subprocess.run(f"docker save {image} | crane export - image-tmp/filesystem.tar", capture_output=True, shell=True)	
-	subprocess.run("tar xf image-tmp/filesystem.tar -C image-tmp", capture_output=True, shell=True)
-	subprocess.run(["rm", "image-tmp/filesystem.tar"], capture_output=True)
+	try:
+		layers = image_layers.stage_image(image, scratch, extract, client)
+	except (tarfile.TarError, zlib.error, EOFError, ValueError, KeyError, OSError, docker_api.DockerError) as ex:
+		print(f"\033[1;91mError during the extraction of the image filesystem: {ex}\033[0m")
+		return None
+	
+	unresolved = [path for layer in layers for path, _ in layer["links"]]
+	if unresolved:
+		print(f"\033[1;38;5;214mWarning: {len(unresolved)} links could not be resolved and are not analyzed: {', '.join(unresolved[:10])}\033[0m")
+	return layers
 
 
-	# Extract the list of system files to exclude
+def get_exclusion_index(image, include_pkg, lang, layers, scratch, options):
+	# Extract the list of system files to exclude. They are loaded in an index that is used
+	# when the filesystem is composed, so these files are never moved in the analyzed folder
 	if include_pkg:
 		print("\033[1;38;5;214mSystem files will be included in the analysis\033[0m")
-	else:
-		if detected_os != "Not supported":
-			detected_os = detected_os.lower() 
-			if "debian" in detected_os:
-				image_os = "debian"
-			elif "ubuntu" in detected_os:
-				image_os = "ubuntu"
-			elif "redhat" in detected_os:
-				image_os = "redhat"
-			elif "alpine" in detected_os:
-				image_os = "alpine"
-			else:
-				image_os = ""
-		
-			if image_os:
-				return_code, installed_files = get_installed_files(image, image_os, lang)
-				
+		return None
+	
+	# The installed files only depend on the layers up to the last one that changes the package database,
+	# so images built on the same base image share the same cache entry
+	base_layers = package_index.package_db_layers(layers)
+	key = cache.cache_key("packages", base_layers, lang)
+	installed_files = None
+	if options.cache and base_layers:
+		installed_files = cache.load_json(options.cache_dir, "packages", key)
+	
+	if installed_files is None:
+		manager, installed_files = package_index.read_installed_files(layers)
+		if manager and installed_files is None:
+			# The database could not be parsed (Eg. BerkeleyDB rpmdb), so rpm is run inside the container
+			return_code, installed_files = get_installed_files(image, lang, scratch)
 			if return_code == 1:
-				print("\033[1;38;5;214mWarning: the script was not able to exclude system files from the analysis\033[0m")
+				installed_files = None
+		elif installed_files is not None:
+			installed_files = [path for path in installed_files if path.rsplit(".", 1)[-1] in LANG_EXTENSIONS[lang]]
+		
+		if installed_files is not None and options.cache:
+			cache.store_json(options.cache_dir, "packages", key, installed_files)
+	
+	if not installed_files:
+		print("\033[1;38;5;214mWarning: the script was not able to exclude system files from the analysis\033[0m")
+		return None
+	
+	# dpkg and rpm list absolute paths while apk lists relative paths, the index handles both
+	return PathIndex(files=installed_files)
+
+
+def spotbugs_analysis(spotbugs_path, report, targets, shards=1, heap=None, cache_dir=None, classpath=None, classpath_key=None):
+	# targets is a list of folders and/or files to analyze. With a cache folder only the jars and class
+	# files that are not in the findings cache are analyzed. classpath lists the files whose types are resolved
+	# (by default the targets), and classpath_key identifies their content in the keys of the cached findings
+	print("\033[1;37mStarting Spotbugs analysis\033[0m")
+	
+	if not cache_dir:
+		if run_spotbugs_shards(spotbugs_path, report, targets, shards, heap) is None:
+			print("\033[1;91m\nFATAL Error during Spotbugs execution\033[0m")
+			return [0, 0, 0, 0]
+		return parse_spotbugs(report)
+	
+	files = [path for _, paths in spotbugs_shards.discover_units(targets) for path in paths]
+	version = spotbugs_version(spotbugs_path)
+	config = SPOTBUGS_OPTIONS if classpath_key is None else [*SPOTBUGS_OPTIONS, classpath_key]
+	cached, missing, keys = findings_cache.lookup_files(cache_dir, "spotbugs", version, config, files)
+	
+	findings, unassigned = {}, []
+	if missing:
+		# The cached files are on the auxiliary classpath, so the types they define are still resolved
+		analyzed = run_spotbugs_shards(spotbugs_path, report, missing, shards, heap, classpath or files)
+		if analyzed is None:
+			print("\033[1;91m\nFATAL Error during Spotbugs execution\033[0m")
+		else:
+			findings, unassigned = findings_cache.split_spotbugs(report, analyzed)
+			
+			# If some bugs can't be assigned to a file (Eg. classes in nested archives) the files are not cached,
+			# otherwise those bugs would be missing from the next reports
+			if unassigned:
+				print(f"\033[1;38;5;214mWarning: {len(unassigned)} Spotbugs bugs could not be assigned to a file, the findings are not cached\033[0m")
 			else:
-				# Prefix the absolute path to image-tmp to each file to exclude
-				installed_files = [str(Path("image-tmp").resolve()) + "/" + path for path in installed_files]
-				
-				# Delete the files
-				starting_path = Path("./image-tmp").resolve()
-				for path in installed_files:
-					if path.startswith(str(starting_path)) and path != starting_path:
-						subprocess.run(f"rm {path}", capture_output=True, shell=True)
+				findings_cache.store_files(cache_dir, keys, findings)
+	
+	findings_cache.join_spotbugs({**cached, **findings}, unassigned, report)
+	return parse_spotbugs(report)
+
+
+def spotbugs_version(spotbugs_path):
+	return findings_cache.tool_version(("java", "-jar", f"{spotbugs_path}/spotbugs.jar", "-version"))
+
+
+def analyzers_config(lang, options):
+	# Versions and options of the analyzers of a language, the cached results of a layer are only used with the same ones.
+	# The Spotbugs shards are included because a shard only has the classes of the other shards on its auxiliary
+	# classpath, so the interprocedural detectors don't look into them
+	if lang == "java":
+		return [spotbugs_version(options.spotbugs_path), SPOTBUGS_OPTIONS, options.spotbugs_shards]
+	return [findings_cache.tool_version(("pylint", "--version")), PYLINT_OPTIONS,
+		findings_cache.tool_version(("bandit", "--version")), bandit_shards.BANDIT_OPTIONS]
+
+
+def run_spotbugs_shards(spotbugs_path, report, targets, shards, heap, classpath=None):
+	# With more than one shard the jars and the class folders found in the targets are split by size between
+	# several Spotbugs JVMs running concurrently. Each JVM has the files of the other shards (and the files of classpath
+	# that are not analyzed) on its auxiliary classpath, so the types defined in other jars are resolved as in a single run.
+	# Returns the analyzed targets, or None if Spotbugs failed
+	groups = spotbugs_shards.make_shards(spotbugs_shards.discover_units(targets), shards) if shards > 1 else []
+	if len(groups) <= 1:
+		analyzed = set(map(str, targets))
+		aux = [path for path in classpath or [] if str(path) not in analyzed]
+		return targets if run_spotbugs(spotbugs_path, report, targets, heap or 6, aux) else None
+	
+	# Without a classpath, the files of all the shards are on it
+	if classpath is None:
+		classpath = [path for group in groups for path in group]
+	
+	print(f"Running Spotbugs in {len(groups)} shards")
+	shard_folder = tempfile.mkdtemp(prefix="spotbugs-shards-")
+	try:
+		shard_reports = [f"{shard_folder}/shard{index}.xml" for index in range(len(groups))]
+		with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+			futures = []
+			for index, group in enumerate(groups):
+				in_group = set(group)
+				aux = [path for path in classpath if path not in in_group]
+				futures.append(metrics.submit(executor, run_spotbugs, spotbugs_path, shard_reports[index], group, heap or 2, aux))
+			succeeded = [future.result() for future in futures]
+		
+		if not any(succeeded) or not spotbugs_shards.merge_reports([r for r, ok in zip(shard_reports, succeeded) if ok], report):
+			return None
+		if not all(succeeded):
+			print(f"\033[1;38;5;214mWarning: {succeeded.count(False)} Spotbugs shards failed, their files are not in the report\033[0m")
+	finally:
+		shutil.rmtree(shard_folder, ignore_errors=True)
+	
+	return [path for group, ok in zip(groups, succeeded) if ok for path in group]
+
+
+def run_spotbugs(spotbugs_path, report, targets, heap, aux=None):
+	# heap is the maximum heap size of the JVM in GB. The targets are always given in a list file next to the report,
+	# since with the cache every class file is a target and they can be too many for the command line.
+	# aux is a list of files whose classes are only used to resolve types, they are given as classpath entries
+	list_file = f"{report}.targets"
+	aux_file = f"{report}.aux"
+	with open(list_file, "w") as targets_file:
+		targets_file.write("".join(f"{target}\n" for target in targets))
+	command = ["java", f"-Xmx{heap}G", "-jar", f"{spotbugs_path}/spotbugs.jar", *SPOTBUGS_OPTIONS, f"-xml={report}"]
+	if aux:
+		with open(aux_file, "w") as classpath_file:
+			classpath_file.write("".join(f"{entry}\n" for entry in spotbugs_shards.classpath_entries(aux)))
+		command += ["-auxclasspathFromFile", aux_file]
+	try:
+		metrics.run([*command, "-analyzeFromFile", list_file], "spotbugs", check=True)
+	
+	# An exception is raised if Spotbugs did not find any java files to analyze (or java is not installed)
+	except (subprocess.CalledProcessError, OSError):
+		return False
+	finally:
+		for filepath in (list_file, aux_file):
+			if os.path.exists(filepath):
+				os.remove(filepath)
+	return True
+
+
+def python_files(directory, scratch, excluded_paths):
+	# The workdir is walked once and the excluded folders are pruned during the walk, 
+	# the resulting list of .py files is given to both Pylint and Bandit
+	abs_scratch = str(Path(scratch).resolve())
+	files = []
+	for folder, subfolders, names in os.walk(directory):
+		subfolders[:] = [name for name in subfolders if not is_excluded(os.path.join(folder, name)[len(abs_scratch):], "python", excluded_paths)]
+		for name in names:
+			path = os.path.join(folder, name)
+			if name.endswith(".py") and not is_excluded(path[len(abs_scratch):], "python", excluded_paths):
+				files.append(path)
+	return sorted(files)
+
+
+def pylint_analysis(report, files, cache_dir=None, root=None):
+	print("\033[1;37mStarting Pylint analysis\033[0m")
+	
+	# With a cache folder only the files that are not in the findings cache are analyzed. The findings are
+	# cached for the path of the file below root (the extracted filesystem), since the messages name its module
+	cached, missing, keys = {}, files, {}
+	if cache_dir:
+		version = findings_cache.tool_version(("pylint", "--version"))
+		cached, missing, keys = findings_cache.lookup_files(cache_dir, "pylint", version, PYLINT_OPTIONS, files, root)
+	
+	# The excluded paths have already been removed from the list of files.
+	# Long lists of files are analyzed in chunks that fit in the command line, and their reports merged
+	if missing:
+		chunk_reports = []
+		for index, chunk in enumerate(arg_chunks.chunks(missing)):
+			chunk_reports.append(f"{report}.{index}")
+			metrics.run(["pylint", *PYLINT_OPTIONS, "--output", chunk_reports[-1], *chunk], "pylint", capture_output=True)
+		merge_pylint_reports(chunk_reports, report)
+		for chunk_report in chunk_reports:
+			Path(chunk_report).unlink(missing_ok=True)
+	elif not cache_dir:
+		merge_pylint_reports([], report)
+	
+	if cache_dir:
+		analyzed = findings_cache.split_pylint(report, missing) if missing else {}
+		findings_cache.store_files(cache_dir, keys, analyzed)
+		# When no file came from the cache the report of the run is kept, with its score
+		if cached or not missing:
+			findings_cache.join_pylint({**cached, **analyzed}, report)
+
+
+def bandit_analysis(report, files, workers, cache_dir=None):
+	# The files are split between several Bandit processes, their JSON reports are merged in bandit.json
+	# and rendered as text in report
+	print("\033[1;37mStarting Bandit analysis\033[0m")
+	
+	cached, missing, keys = {}, files, {}
+	if cache_dir:
+		version = findings_cache.tool_version(("bandit", "--version"))
+		cached, missing, keys = findings_cache.lookup_files(cache_dir, "bandit", version, bandit_shards.BANDIT_OPTIONS, files)
 	
+	merged, analyzed = bandit_shards.run_shards(missing, workers)
+	if cache_dir:
+		findings = findings_cache.split_bandit(merged, analyzed)
+		findings_cache.store_files(cache_dir, keys, findings)
+		merged = findings_cache.join_bandit({**cached, **findings})
+	
+	bandit_shards.write_reports(merged, str(Path(report).with_suffix(".json")), report)
+	return parse_bandit(report)
+
+
+def python_analysis(reports, files, workers, cache_dir=None, root=None):
+	# Pylint and Bandit are run at the same time on the same list of files
+	with ThreadPoolExecutor(max_workers=2) as executor:
+		pylint_future = metrics.submit(executor, pylint_analysis, f"{reports}/pylint.json", files, cache_dir, root)
+		bandit_future = metrics.submit(executor, bandit_analysis, f"{reports}/bandit.txt", files, workers, cache_dir)
+		pylint_future.result()
+		return bandit_future.result()
+
+
+@functools.lru_cache(maxsize=None)
+def exclusion_index(excluded_paths):
+	# The folders given with --exclude, indexed once for all the files that are checked
+	return PathIndex(folders=excluded_paths)
 
-    # Java workflow
+
+def is_excluded(path, lang, excluded_paths):
+	# path is an absolute path inside the container
+	if lang == "python" and any(part in PYTHON_EXCLUDED for part in Path(path).parts):
+		return True
+	return bool(excluded_paths) and path in exclusion_index(tuple(excluded_paths))
+
+
+def layered_lang_analysis(lang, workdir, layers, scratch, outfolder, options):
+	# The files under the workdir are grouped by the layer that provides them, and each group is analyzed separately.
+	# A group is identified by the layer digest and by the list of files, which also reflects the excluded files,
+	# so a rebuilt image only needs the analysis of the files belonging to the new layers. The results don't expire,
+	# but they are not used after an upgrade of the analyzers or a change of their options.
+	# Spotbugs resolves the types of a layer with the files of all the layers on its classpath, so for java
+	# the files of the whole image (each one with the layer providing it) are also part of the key
+	owners = image_layers.file_owners(layers, "/" + workdir.strip("/"),
+		lambda path: path.rsplit(".", 1)[-1] in LANG_EXTENSIONS[lang] and not is_excluded(path, lang, options.exclude))
+	
+	groups = {}
+	for path, digest in owners.items():
+		# Package files have already been removed from the extracted filesystem
+		if os.path.isfile(scratch + path):
+			groups.setdefault(digest, []).append(path)
+	
+	config = analyzers_config(lang, options)
+	abs_scratch = str(Path(scratch).resolve())
+	classpath, classpath_key = None, None
 	if lang == "java":
-		print("\033[1;37mStarting Spotbugs analysis\033[0m")
+		classpath = [abs_scratch + path for paths in groups.values() for path in sorted(paths)]
+		classpath_key = cache.cache_key("classpath", sorted((path, digest) for digest, paths in groups.items() for path in paths))
+	lang_out = [0, 0, 0, 0]
+	layer_reports = []
+	for layer in layers:
+		paths = sorted(groups.get(layer["digest"], []))
+		if not paths:
+			continue
 		
-		# Spotbugs works with package/class names rather than directories, so in order to exclude paths
-		# from the analysis these will be deleted from the image-tmp folder
-		# The checks are there to make sure we don't delete folders outside image-tmp if, as an example, .. is used 
-		# This is actually a second check because the first one is in the main
-		if excluded_paths:
-			starting_path = Path("./image-tmp").resolve()
-			for path in excluded_paths:
-				complete_path = "image-tmp" + "/" + path
-				abs_path = Path(complete_path).resolve()
-				if str(abs_path).startswith(str(starting_path)) and abs_path != starting_path:
-					subprocess.run(f"rm -rf {abs_path}", capture_output=True, shell=True)
+		# The content of the links comes from other layers, so it is part of the key
+		linked = [findings_cache.file_hash(abs_scratch + path) for path in paths if path in layer.get("linked", ())]
+		key = cache.cache_key("layer", layer["digest"], lang, paths, config, classpath_key, linked)
+		entry = cache.lookup(options.cache_dir, "layers", key)
+		if entry is None:
+			print(f"Analyzing {len(paths)} files from layer {layer['digest'][:19]}")
+			reports = tempfile.mkdtemp(prefix="layer-reports-")
+			try:
+				targets = [abs_scratch + path for path in paths]
+				if lang == "java":
+					out = spotbugs_analysis(options.spotbugs_path, f"{reports}/spotbugs.xml", targets, options.spotbugs_shards, options.spotbugs_heap, options.cache_dir,
+						classpath, classpath_key)
 				else:
-					print(f"\033[1;91mInvalid excluded path: {path}\033[0m")
+					out = python_analysis(reports, targets, options.bandit_workers, options.cache_dir, abs_scratch)
+				with open(f"{reports}/lang_out.json", "w") as json_file:
+					json.dump(out if len(out) == 4 else [0, 0, 0, 0], json_file)
+				entry = cache.store(options.cache_dir, "layers", key, {name: f"{reports}/{name}" for name in os.listdir(reports)})
+			finally:
+				shutil.rmtree(reports, ignore_errors=True)
+		else:
+			print(f"Using cached results for layer {layer['digest'][:19]}")
 		
+		with open(entry / "lang_out.json", "r") as json_file:
+			lang_out = [total + value for total, value in zip(lang_out, json.load(json_file))]
+		layer_reports.append((layer["digest"], entry))
+	
+	# Merge the reports of the layers into the report folder
+	if lang == "java":
+		spotbugs_shards.merge_reports([entry / "spotbugs.xml" for _, entry in layer_reports], f"{outfolder}/spotbugs.xml")
+	else:
+		merge_pylint_reports([entry / "pylint.json" for _, entry in layer_reports], f"{outfolder}/pylint.json")
+		bandit_reports = []
+		for _, entry in layer_reports:
+			if (entry / "bandit.json").is_file():
+				with open(entry / "bandit.json", "r") as json_file:
+					bandit_reports.append(json.load(json_file))
+		merged = bandit_shards.merge_results(bandit_reports)
+		with open(f"{outfolder}/bandit.json", "w") as json_file:
+			json.dump(merged, json_file, indent=4)
+		with open(f"{outfolder}/bandit.txt", "w") as bandit_file:
+			bandit_file.write(bandit_shards.render_text(merged))
+	return lang_out
+
+
+def merge_pylint_reports(filepaths, output):
+	# Merge json2 reports: messages are concatenated and statistics summed, the score is the average of the scores
+	# weighted by the number of modules (reports rebuilt from the findings cache have no score and are left out of it)
+	messages = []
+	type_count = {}
+	modules = 0
+	scored_modules = 0
+	weighted_score = 0
+	for filepath in filepaths:
 		try:
-			subprocess.run(f"java -Xmx6G -jar {spotbugs_path}/spotbugs.jar -textui -progress -low -xml={outfolder}/spotbugs.xml -quiet {abs_workdir}", 
-				shell=True, check=True)
-		
-		# An exception is raised if Spotbugs did not find any java files to analyze
-		except subprocess.CalledProcessError as ex:
-			print("\033[1;91m\nFATAL Error during Spotbugs execution\033[0m")
-			lang_out = [0, 0, 0, 0]
+			with open(filepath, "r") as json_file:
+				report = json.load(json_file)
+		except (FileNotFoundError, json.JSONDecodeError):
+			continue
+		messages += report.get("messages", [])
+		statistics = report.get("statistics", {})
+		for message_type, count in statistics.get("messageTypeCount", {}).items():
+			type_count[message_type] = type_count.get(message_type, 0) + count
+		modules += statistics.get("modulesLinted", 0)
+		if statistics.get("score") is not None:
+			scored_modules += statistics.get("modulesLinted", 0)
+			weighted_score += statistics["score"] * statistics.get("modulesLinted", 0)
+	
+	data = {
+		"messages": messages,
+		"statistics": {
+			"messageTypeCount": type_count,
+			"modulesLinted": modules,
+			"score": round(weighted_score / scored_modules, 2) if scored_modules else None
+		}
+	}
+	with open(output, "w") as json_file:
+		json.dump(data, json_file, indent=4)
+
+
+def restore_cached_report(entry, image, outfolder):
+	print("\033[1;32m\nImage already analyzed, using the cached reports\033[0m")
+	with metrics.span("restore_cache"):
+		for cached_file in entry.iterdir():
+			if cached_file.is_file() and not cached_file.name.startswith("."):
+				shutil.copyfile(cached_file, f"{outfolder}/{cached_file.name}")
+	
+	# The general report is updated with the current image name and folder, and the metrics
+	# are those of this run (the pull and the cache lookup), not of the run that was cached
+	with open(f"{outfolder}/generalReport.json", "r") as json_file:
+		data = json.load(json_file)
+	data["imageName"] = image
+	data["reportFolder"] = str(Path(outfolder).resolve())
+	data["cached"] = True
+	data["metrics"] = metrics.report()
+	with open(f"{outfolder}/generalReport.json", "w") as json_file:
+		json.dump(data, json_file, indent=4)
+	print("Reports generated at " + str(Path(outfolder).resolve()))
+
+
+def if_extracted(function):
+	# Wraps the function of a stage that needs the extracted filesystem, it is not run if the extraction failed
+	return lambda inputs: None if inputs["extract"] is None else function(inputs)
+
+
+def run_stages(stages):
+	# Small DAG scheduler: each stage is a (name, function, dependencies) tuple and it is started
+	# as soon as all the stages it depends on are done. The function receives a dict with the results 
+	# of its dependencies. Returns the results and the timings (in seconds) of every stage
+	pipeline_start = time.perf_counter()
+	pending = {name: (function, dependencies) for name, function, dependencies in stages}
+	running = {}
+	results = {}
+	timings = {}
+	
+	def timed(name, function, inputs):
+		start = time.perf_counter()
+		with metrics.span(name):
+			result = function(inputs)
+		end = time.perf_counter()
+		timings[name] = {
+			"start": round(start - pipeline_start, 3),
+			"duration": round(end - start, 3)
+		}
+		return result
+	
+	with ThreadPoolExecutor(max_workers=len(stages)) as executor:
+		while pending or running:
+			ready = [name for name, (_, dependencies) in pending.items() if all(d in results for d in dependencies)]
+			for name in ready:
+				function, dependencies = pending.pop(name)
+				inputs = {d: results[d] for d in dependencies}
+				running[executor.submit(timed, name, function, inputs)] = name
+			
+			if not running:
+				raise ValueError(f"Unsatisfiable stage dependencies: {', '.join(pending)}")
+			
+			done, _ = wait(running, return_when=FIRST_COMPLETED)
+			for future in done:
+				name = running.pop(future)
+				# Errors (including sys.exit) are raised again in the main thread
+				results[name] = future.result()
+	
+	timings["total"] = round(time.perf_counter() - pipeline_start, 3)
+	return results, timings
+
+def check_local_image(image, client):
+    # The image is looked up by its reference, without listing all the local images
+    try:
+        client.inspect_image(image)
+    except docker_api.DockerError:
+        print(f"\033[1;91mImage '{image}' does not exist locally\033[0m")
+        sys.exit(1)
+    except OSError as ex:
+        print(f"\033[1;91mDocker API not reachable at {client.path}: {ex}\033[0m")
+        sys.exit(1)
+
+
+def normalize_image(image):
+	if ":" not in image:
+		print("\033[1;37m\nImage Tag not specified, using 'latest'\033[0m")
+		image = image + ":latest"
+	return image
+
+
+def scan_image(image, lang, given_workdir, outfolder, scratch, options):
+	# Complete analysis of a single image. Every temporary file is written in the scratch folder, 
+	# so different scans can run at the same time as long as they use different scratch folders
+
+	# The metrics of a previous scan run by the same batch worker are not part of this report
+	metrics.reset()
+
+	# The Docker API connection is reused by all the requests of the scan
+	client = docker_api.DockerClient()
+	
+	# Pull Docker image
+	with metrics.span("pull"):
+		if not options.local:
+			pull_image(image, client)
 		else:
-			lang_out = parse_spotbugs(f"{outfolder}/spotbugs.xml")
-	
-	# Python workflow    
-	elif lang == "python":
-	
-		# Manage excluded paths. Pylint manages differently the excluded folder/package names (--ignore) and paths (--ignore-paths)
-		base_excluded = "env,venv,.env,.venv"
-		user_excluded = ""
-		if_user_excluded = ""
-		if excluded_paths:
-			if_user_excluded = "--ignore-paths"
-			for path in excluded_paths:
-				complete_path = "image-tmp" + "/" + path
-				complete_abs_path = Path(complete_path).resolve()
-				user_excluded += str(complete_abs_path) + ","
-		user_excluded = user_excluded.rstrip(",")	
+			check_local_image(image, client)
 		
-		# Bandit has what i believe to be a bug: when a folder such as env is in the same directory where the program is executed,
-		# using -x env will not work for some reason, while the same option will work if env is in some subdirectory. Instead, 
-		# using -x /env appears to be working whatever the location of the env folder may be
-		bandit_excluded = "/env,/venv,/.env,/.venv"
-		if user_excluded != "":
-			bandit_excluded += "," + user_excluded
+	# Create report folder    
+	if not os.path.exists(outfolder):
+		os.makedirs(outfolder)   
+	if not os.path.exists(scratch):
+		os.makedirs(scratch)
+
+	# Fetch the workdir first, it decides whether the code analysis stages are needed
+	image_info = inspect_image(image, client)
+	workdir = get_workdir(image_info, given_workdir)
+	if not workdir:
+		print("\033[1;91mWorkingDir not detected, skipping code analysis\033[0m")
+	
+	# An image that was already analyzed with the same options is taken from the cache
+	if options.cache:
+		# The tool versions are part of the key, so an upgrade doesn't keep returning the reports of the old versions
+		analyzers = analyzers_config(lang, options) + [options.spotbugs_heap] if workdir else None
+		report_key = cache.cache_key("report", image_digest(image_info), lang, workdir, options.exclude, options.trivy_mode, options.include_pkg,
+			options.docker_bench_checks, options.trivy_table, findings_cache.tool_version(("trivy", "--version")), analyzers)
+		entry = cache.lookup(options.cache_dir, "reports", report_key, options.cache_max_age * 3600)
+		if entry is not None:
+			restore_cached_report(entry, image, outfolder)
+			cleanup_image(image, client, options)
+			return f"{outfolder}/generalReport.json"
+	
+	# docker-bench, Trivy and the filesystem extraction only need the image, so they are started together.
+	# The code analyzers start as soon as the filesystem has been extracted and, unless --include_pkg is used, 
+	# the package files have been listed
+	stages = [
+		("docker_bench", lambda inputs: docker_bench_analysis(image, image_info["Id"], outfolder, options), []),
+		("trivy", lambda inputs: trivy_analysis(image, outfolder, options.trivy_mode, options.trivy_table, options.trivy_server, options.trivy_cache_dir), []),
+	]
+	if workdir:
+		abs_workdir = Path(scratch + workdir).resolve()
 		
-		print("\033[1;37mStarting Pylint analysis\033[0m")
-		subprocess.run(f"pylint -j 0 -f json2 --output {outfolder}/pylint.json --recursive y --ignore {base_excluded} {if_user_excluded} {user_excluded} {abs_workdir}", capture_output=True, shell=True)	
+		# The package files are listed from the databases found in the staged layers, 
+		# then the filesystem is composed without them, so nothing has to be deleted afterwards
+		# If the extraction failed the following stages are skipped and return None
+		stages += [
+			("extract", lambda inputs: stage_filesystem(image, lang, workdir, options.exclude, options.include_pkg, scratch, client), []),
+			("exclude", if_extracted(lambda inputs: get_exclusion_index(image, options.include_pkg, lang, inputs["extract"], scratch, options)), ["extract"]),
+			("compose", if_extracted(lambda inputs: image_layers.compose(inputs["extract"], scratch, inputs["exclude"])), ["extract", "exclude"]),
+		]
+		if options.cache:
+			# The files are analyzed layer by layer, so that only the layers that are not in the cache are analyzed
+			stages.append(("code", if_extracted(lambda inputs: layered_lang_analysis(lang, workdir, inputs["extract"], scratch, outfolder, options)), ["extract", "compose"]))
+		elif lang == "java":
+			stages.append(("code", if_extracted(lambda inputs: spotbugs_analysis(options.spotbugs_path, f"{outfolder}/spotbugs.xml", [abs_workdir], options.spotbugs_shards,
+				options.spotbugs_heap)), ["extract", "compose"]))
+		elif lang == "python":
+			# The workdir is walked once, then Pylint and Bandit analyze the same files at the same time
+			stages += [
+				("files", if_extracted(lambda inputs: python_files(abs_workdir, scratch, options.exclude)), ["extract", "compose"]),
+				("pylint", if_extracted(lambda inputs: pylint_analysis(f"{outfolder}/pylint.json", inputs["files"])), ["extract", "files"]),
+				("code", if_extracted(lambda inputs: bandit_analysis(f"{outfolder}/bandit.txt", inputs["files"], options.bandit_workers)), ["extract", "files"]),
+			]
+	
+	try:
+		results, timings = run_stages(stages)
+	finally:
+		# Cleanup the extracted filesystem
+		subprocess.run(["rm", "-rf", scratch, scratch.rstrip("/") + "-layers"])
+	
+	trivy_out = results["trivy"]
+	lang_out = ""
+	if workdir:
+		lang_out = results["code"]
+
+	# Generate final report
+	generate_report(image, lang, trivy_out, options.trivy_mode, lang_out, results["docker_bench"], outfolder, workdir, options.exclude, timings)
+	print("Reports generated at " + str(Path(outfolder).resolve()))
+	
+	# A scan whose code analysis failed is not cached, so the next one tries again
+	if options.cache and lang_out is not None:
+		reports = {f.name: f for f in Path(outfolder).iterdir() if f.is_file() and f.name != "scan.log"}
+		cache.store(options.cache_dir, "reports", report_key, reports)
+		cache.evict(options.cache_dir, options.cache_size * 1024 ** 3)
+
+	cleanup_image(image, client, options)
+	return f"{outfolder}/generalReport.json"
+
+
+def cleanup_image(image, client, options):
+	# Delete the pulled image, local builds are never deleted
+	if options.cleanup and not options.local:
+		print(f"\033[1;32m\nDeleting Docker image: \033[0m{image}")
+		try:
+			client.remove_image(image)
+			print("Done")
+		except (OSError, docker_api.DockerError) as ex:
+			print(f"\033[1;38;5;214mWarning: the image was not deleted: {ex}\033[0m")
+
+
+def read_batch_file(filepath):
+	# Each line is an (image, lang) or (image, lang, workdir) tuple, as in misc/imagesList.txt
+	entries = []
+	with open(filepath, "r") as file:
+		for line in file:
+			line = line.strip().rstrip(",")
+			if not line or line.startswith("#"):
+				continue
+			entry = ast.literal_eval(line)
+			if len(entry) not in [2, 3] or entry[1] not in ["java", "python"]:
+				print(f"\033[1;91mInvalid batch entry: {line}\033[0m")
+				sys.exit(1)
+			entries.append(entry)
+	return entries
+
+
+def batch_worker(image, lang, given_workdir, outfolder, scratch_root, trivy_root, options):
+	# Runs in a worker process. Each scan gets its own report folder and scratch folder,
+	# and its console output is redirected to a log file in the report folder
+	if not os.path.exists(outfolder):
+		os.makedirs(outfolder)
+	scratch = tempfile.mkdtemp(prefix="image-tmp-", dir=scratch_root)
+	
+	# Without a Trivy server, the worker runs Trivy in standalone mode with its own copy of the cache folder
+	if not (options.trivy_server and trivy_server.server_healthy(options.trivy_server)):
+		options.trivy_server = None
+		options.trivy_cache_dir = trivy_server.worker_cache_dir(options.trivy_cache_dir, trivy_root)
+	
+	sys.stdout.flush()
+	sys.stderr.flush()
+	saved_stdout, saved_stderr = os.dup(1), os.dup(2)
+	with open(f"{outfolder}/scan.log", "w") as log:
+		os.dup2(log.fileno(), 1)
+		os.dup2(log.fileno(), 2)
+		try:
+			return scan_image(image, lang, given_workdir, outfolder, scratch, options)
+		finally:
+			sys.stdout.flush()
+			sys.stderr.flush()
+			os.dup2(saved_stdout, 1)
+			os.dup2(saved_stderr, 2)
+			os.close(saved_stdout)
+			os.close(saved_stderr)
+			subprocess.run(["rm", "-rf", scratch])
+
+
+def batch_folders(entries, outfolder):
+	# Identical entries (Eg. bench and bench:latest) are analyzed once, and each entry gets its own report folder:
+	# the folder is named after the image, with the language and then a counter added when the image is listed again
+	# (Eg. with another workdir). Returns (image, lang, workdir, folder) tuples
+	planned = []
+	seen = set()
+	folders = set()
+	for image, lang, *workdir in entries:
+		entry = (normalize_image(image), lang, workdir[0] if workdir else None)
+		if entry in seen:
+			print(f"\033[1;38;5;214mSkipping duplicate entry: {entry[0]} ({lang})\033[0m")
+			continue
+		seen.add(entry)
 		
-		print("\033[1;37mStarting Bandit analysis\033[0m")
-		subprocess.run(f"bandit -r -x {bandit_excluded} -f txt --output {outfolder}/bandit.txt {abs_workdir}", capture_output=True, shell=True)
-		lang_out = parse_bandit(f"{outfolder}/bandit.txt")
-	
-	# Cleanup and return
-	subprocess.run(["rm", "-rf", "image-tmp"])
-	return lang_out, workdir
-
-def check_local_image(image):
-    # Run the 'docker images' command with formatting
-    result = subprocess.run(['docker', 'images', '--format', '{{.Repository}}:{{.Tag}}'],
-                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-
-    # Check if the full image name with tag is in the output
-    images = result.stdout.splitlines()
-    if image not in images:
-        print(f"\033[1;91mImage '{image}' does not exist locally\033[0m")
-        sys.exit(1)
+		base = re.sub(r"[^A-Za-z0-9_.-]", "_", entry[0])
+		name = base if base not in folders else f"{base}_{lang}"
+		count = 2
+		while name in folders:
+			name = f"{base}_{lang}_{count}"
+			count += 1
+		folders.add(name)
+		planned.append((*entry, f"{outfolder}/{name}"))
+	return planned
+
+
+def run_batch(batch_file, outfolder, options):
+	entries = batch_folders(read_batch_file(batch_file), outfolder)
+	print(f"\033[1;32m\nStarting batch analysis of {len(entries)} images with {options.workers} workers\033[0m")
+	
+	if not os.path.exists(outfolder):
+		os.makedirs(outfolder)
+	scratch_root = os.getcwd()
+	trivy_root = tempfile.mkdtemp(prefix="trivy-workers-", dir=scratch_root)
+	min_free = options.min_free_disk * 1024 ** 3
+	
+	fleet = []
+	queue = list(entries)
+	running = {}
+	try:
+		with ProcessPoolExecutor(max_workers=options.workers) as executor:
+			while queue or running:
+				# Back-pressure: a new scan is only started if there is enough free disk space for its scratch folder,
+				# otherwise we wait for one of the running scans to finish and release its space
+				while queue and len(running) < options.workers:
+					if running and shutil.disk_usage(scratch_root).free < min_free:
+						print("\033[1;38;5;214mLow disk space, waiting for running scans to finish\033[0m")
+						break
+					image, lang, workdir, image_outfolder = queue.pop(0)
+					future = executor.submit(batch_worker, image, lang, workdir, image_outfolder, scratch_root, trivy_root, options)
+					running[future] = (image, lang, workdir, image_outfolder)
+					print(f"Started: {image}")
+				
+				done, _ = wait(running, return_when=FIRST_COMPLETED)
+				for future in done:
+					image, lang, workdir, image_outfolder = running.pop(future)
+					entry = {"imageName": image, "language": lang, "reportFolder": str(Path(image_outfolder).resolve())}
+					if workdir:
+						entry["workdir"] = workdir
+					try:
+						with open(future.result(), "r") as json_file:
+							report = json.load(json_file)
+					# sys.exit is used for errors during the analysis (Eg. pull failures)
+					except (Exception, SystemExit):
+						entry["status"] = "failed"
+						print(f"\033[1;91mFailed: {image}\033[0m (see {image_outfolder}/scan.log)")
+					else:
+						entry["status"] = "done"
+						entry["summary"] = report["analysis"]["summary"]
+						entry["duration"] = report["timings"]["total"]
+						print(f"Done: {image}")
+					fleet.append(entry)
+	finally:
+		# The copies of the Trivy cache folder made by the workers
+		shutil.rmtree(trivy_root, ignore_errors=True)
+	
+	generate_fleet_report(fleet, outfolder)
+	print("Fleet report generated at " + str(Path(f"{outfolder}/fleetReport.json").resolve()))
+	
+	if options.metrics_file:
+		write_metrics_file(options.metrics_file, [(metrics_labels(entry["imageName"], entry["language"], entry.get("workdir")), f"{entry['reportFolder']}/generalReport.json")
+			for entry in fleet if entry["status"] == "done"])
+
+
+def generate_fleet_report(fleet, outfolder):
+	# Sum the vulnerabilities of all the images that were analyzed successfully
+	summary = {"low": 0, "medium": 0, "high": 0}
+	for entry in fleet:
+		if entry["status"] == "done":
+			for severity in summary:
+				summary[severity] += entry["summary"][severity]
+	
+	data = {
+		"images": len(fleet),
+		"failed": len([entry for entry in fleet if entry["status"] == "failed"]),
+		"summary": summary,
+		"results": fleet
+	}
+	with open(f"{outfolder}/fleetReport.json", "w") as json_file:
+		json.dump(data, json_file, indent=4)
+
+
+def metrics_labels(image, lang, workdir=None):
+	# The same image can be analyzed with another language or workdir, the labels tell the scans apart
+	labels = {"image": image, "lang": lang}
+	if workdir:
+		labels["workdir"] = workdir
+	return labels
+
+
+def write_metrics_file(filepath, reports):
+	# reports is a list of (labels, path of its generalReport.json): the metrics of each scan are labelled with its image
+	entries = []
+	for labels, report_path in reports:
+		try:
+			with open(report_path, "r") as json_file:
+				entries.append((labels, json.load(json_file).get("metrics", {}).get("spans", [])))
+		except (OSError, json.JSONDecodeError):
+			continue
+	metrics.write_text(filepath, metrics.prometheus_text(entries))
+	print("Metrics written at " + str(Path(filepath).resolve()))
 
 
 def main():
@@ -426,8 +1102,8 @@ def main():
 	"while docker-bench-security and Spotbugs are .sh and .jar, so the path to the folders containing these files needs to be specified via "
 	"$DOCKERBENCH_PATH and $SPOTBUGS_PATH environment variables; these two paths can also be given to the script with command line arguments.")
 	
-	parser.add_argument('--image', type=str, metavar="string", help="Complete name of the image (Eg. nginx:latest)", required=True)  
-	parser.add_argument('--lang', type=str, metavar="string", help="Application language (python or java)", required=True)
+	parser.add_argument('--image', type=str, metavar="string", help="Complete name of the image (Eg. nginx:latest). Required unless --batch is used")  
+	parser.add_argument('--lang', type=str, metavar="string", help="Application language (python or java). Required unless --batch is used")
 	parser.add_argument('--workdir', type=str, metavar="string", help="The project source directory inside the container. If the Dockerfile contains the WORKDIR " 
 	"instruction this is fetched automatically. If neither this argument or the Dockerfile instruction are used the code analysis will be skipped")
 	parser.add_argument('--outfolder', type=str, metavar="string", help="Reports will be generated in this folder (Default: reports)")
@@ -435,31 +1111,65 @@ def main():
 	"The values should be absolute paths within the container")
 	parser.add_argument('--trivy_mode', type=str, metavar="string", help="Tell Trivy to work in precise or comprehensive mode (Default: precise). "
 	"The comprehensive mode will try to find more vulnerabilities but could generate more false positives")
+	parser.add_argument('--trivy_table', action='store_true', help="Also write the Trivy results as a table in trivyReport.txt (the JSON report is always written)")
+	parser.add_argument('--trivy_server', type=str, metavar="url", help="Use Trivy in client mode with the server at this address (Eg. http://127.0.0.1:4954). "
+	"If the server is not reachable, Trivy is run in standalone mode")
+	parser.add_argument('--trivy_start_server', action='store_true', help="Start a Trivy server (at the --trivy_server address or http://127.0.0.1:4954) if it is not already running. "
+	"The server keeps running after the analysis, so the vulnerability database is loaded once for all the following scans on this machine. "
+	"This is the default in batch mode, unless --trivy_server is given")
+	parser.add_argument('--trivy_cache_dir', type=str, metavar="string", help="Trivy cache folder shared by all the scans. "
+	"The vulnerability database is not updated while it is still fresh (Default: Trivy's default cache folder)")
 	parser.add_argument('--spotbugs_path', type=str, metavar="string", help="Path to the folder containing 'spotbugs.jar'. "
 	"This path can also be set with the $SPOTBUGS_PATH variable")
+	parser.add_argument('--spotbugs_shards', type=int, metavar="int", default=1, help="Split the jars and class folders between this many Spotbugs "
+	"processes running at the same time, their reports are merged (Default: 1)")
+	parser.add_argument('--spotbugs_heap', type=int, metavar="GB", help="Maximum heap size of each Spotbugs process (Default: 6 with a single process, 2 with shards)")
+	parser.add_argument('--bandit_workers', type=int, metavar="int", default=os.cpu_count(), help="Number of Bandit processes "
+	"analyzing the Python files at the same time (Default: number of CPUs)")
 	parser.add_argument('--docker_bench_path', type=str, metavar="string", help="Path to the folder containing 'docker-bench-security.sh'. "
 	"This path can also be set with the $DOCKERBENCH_PATH variable")
+	parser.add_argument('--docker_bench_checks', type=docker_bench.parse_checks, metavar="check1,check2", default=["container_images"],
+	help="Comma-separated list of the docker-bench sections (by name or number) or check ids to run (Eg. container_images,2,check_3_1). "
+	"With --cache the host checks (sections 1, 2, 3, 6 and 7) are run once per host and daemon configuration (Default: container_images)")
 	parser.add_argument('--local', action='store_true', help="Use if the image only exists locally and not in DockerHub. This will skip the image pulling step of the script")
 	parser.add_argument('--cleanup', action='store_true', help="Using this option will delete the pulled Docker image once the analysis is done"
 	"If the --local option is used then this flag will not work to prevent accidentally deleting the local image")
 	parser.add_argument('--include_pkg', action='store_true', help="By default the script tries to locate and exclude from the code analysis all the files "
 	"installed in the container with a package manager. Use this option if you want to include them in the analysis")
+	parser.add_argument('--cache', action='store_true', help="Keep the results in a local cache: an image with the same digest analyzed with the same options "
+	"is not analyzed again, and the code analysis is only run on the image layers that were not analyzed before")
+	parser.add_argument('--cache_dir', type=str, metavar="string", default=cache.DEFAULT_CACHE_DIR, help="Cache folder. "
+	"This path can also be set with the $SCAN_CACHE_DIR variable (Default: ~/.cache/container-security)")
+	parser.add_argument('--cache_size', type=float, metavar="GB", default=20, help="Maximum size of the cache, the least recently used entries are deleted (Default: 20)")
+	parser.add_argument('--cache_max_age', type=float, metavar="hours", default=24, help="Cached reports older than this are not used, "
+	"so that Trivy can find newly published vulnerabilities. The code analysis of the layers does not expire, but it is run again when the analyzers or their options change (Default: 24)")
+	parser.add_argument('--batch', type=str, metavar="file", help="Analyze all the images listed in the file, one (image, lang) or (image, lang, workdir) tuple per line "
+	"(Eg. misc/imagesList.txt). Each image gets its own folder inside --outfolder, and a fleetReport.json summarizes the results")
+	parser.add_argument('--workers', type=int, metavar="int", default=4, help="Batch mode: number of images analyzed at the same time (Default: 4)")
+	parser.add_argument('--metrics_file', type=str, metavar="file", help="Also write the time, CPU, peak memory and disk I/O of the stages, tools and parsers "
+	"of the scans in this file, in the Prometheus text format (Eg. in the folder of the node_exporter textfile collector). They are always in generalReport.json")
+	parser.add_argument('--min_free_disk', type=float, metavar="GB", default=10, help="Batch mode: new scans are not started while the free disk space "
+	"is below this value, unless no scan is running (Default: 10)")
 	
 
 	# Parse the arguments
 	args = parser.parse_args()
 
-	image = args.image
-	if ":" not in image:
-		print("\033[1;37m\nImage Tag not specified, using 'latest'\033[0m")
-		image = image + ":latest"
+	if args.batch:
+		if args.image or args.workdir:
+			print("\nError: --image and --workdir cannot be used together with --batch\n")
+			parser.print_help()
+			sys.exit(1)
+	elif not args.image or not args.lang:
+		print("\nError: the --image and --lang arguments are required (unless --batch is used)\n")
+		parser.print_help()
+		sys.exit(1)
 
 	outfolder = "reports"
 	if args.outfolder:
 		outfolder = args.outfolder.rstrip('/')
 		
-	lang = args.lang
-	if lang not in ["java", "python"]:
+	if args.lang and args.lang not in ["java", "python"]:
 		print("\nError: The -lang argument must be 'java' or 'python'.\n")
 		parser.print_help()
 		sys.exit(1)
@@ -471,56 +1181,51 @@ def main():
 				print("\nError: the excluded path cannot contain '..'")
 				sys.exit(1)
 	
-	trivy_mode = args.trivy_mode
-	if trivy_mode:
-		if trivy_mode not in ["precise", "comprehensive"]:
+	if args.trivy_mode:
+		if args.trivy_mode not in ["precise", "comprehensive"]:
 			print("\nError: The --trivy_mode argument must be 'precise' or 'comprehensive'.\n")
 			parser.print_help()
 			sys.exit(1)
 	else:
-		trivy_mode = "precise"
+		args.trivy_mode = "precise"
 	
 	spotbugs_path = "spotbugs-4.8.6/lib" 
 	if args.spotbugs_path:
 		spotbugs_path = args.spotbugs_path.rstrip('/')
 	elif os.environ.get("SPOTBUGS_PATH"):
 		spotbugs_path = os.environ.get("SPOTBUGS_PATH").rstrip('/')
+	args.spotbugs_path = spotbugs_path
 
 	docker_bench_path = "docker-bench-security"
 	if args.docker_bench_path:
 		docker_bench_path = args.docker_bench_path.rstrip('/')	
 	elif os.environ.get("DOCKERBENCH_PATH"):
 		docker_bench_path = os.environ.get("DOCKERBENCH_PATH").rstrip('/')
+	args.docker_bench_path = docker_bench_path
 
-	# Pull Docker image
-	if not args.local:
-		pull_image(image)
-	else:
-		check_local_image(image)
-		
-	# Create report folder    
-	if not os.path.exists(outfolder):
-		os.makedirs(outfolder)   
-
-	# Docker-bench analysis
-	docker_bench_analysis(image, docker_bench_path, outfolder)
-
-	# Trivy analysis
-	trivy_out = trivy_analysis(image, outfolder, trivy_mode)
-	detected_os = trivy_out[6]
-
-	# Language specific analysis
-	lang_out, workdir = lang_analysis(image, detected_os, args.include_pkg, lang, args.workdir, spotbugs_path, outfolder, excluded_paths)
+	# The Trivy vulnerability database is a fixed cost for each scan, so it is loaded once: either by a Trivy server 
+	# that is shared by all the scans, or by updating the shared cache folder before the scans start.
+	# In batch mode the server is started by default, since standalone Trivy processes lock the cache folder
+	if args.trivy_start_server or (args.batch and not args.trivy_server):
+		args.trivy_server = args.trivy_server or trivy_server.DEFAULT_SERVER
+		if not trivy_server.server_healthy(args.trivy_server):
+			print(f"\033[1;32m\nStarting Trivy server at {args.trivy_server}\033[0m")
+			if not trivy_server.start_server(args.trivy_server, args.trivy_cache_dir):
+				print("\033[1;38;5;214mThe Trivy server did not start, using standalone mode\033[0m")
+	
+	# Without a server, each batch worker copies the database of the shared cache folder, which is updated first
+	if args.batch and not trivy_server.server_healthy(args.trivy_server) and not trivy_server.db_is_fresh(args.trivy_cache_dir):
+		print("\033[1;32m\nDownloading the Trivy vulnerability database\033[0m")
+		trivy_server.download_db(args.trivy_cache_dir)
 
-	# Generate final report
-	generate_report(image, lang, trivy_out, trivy_mode, lang_out, outfolder, workdir, excluded_paths)
-	print("Reports generated at " + str(Path(outfolder).resolve()))
+	if args.batch:
+		run_batch(args.batch, outfolder, args)
+	else:
+		image = normalize_image(args.image)
+		report_path = scan_image(image, args.lang, args.workdir, outfolder, "image-tmp", args)
+		if args.metrics_file:
+			write_metrics_file(args.metrics_file, [(metrics_labels(image, args.lang, args.workdir), report_path)])
 
-	# Cleanup Docker image
-	if args.cleanup and not args.local:
-		print(f"\033[1;32m\nDeleting Docker image: \033[0m{image}")
-		subprocess.run(f"docker image rm {image}", shell=True, capture_output=True)
-		print("Done")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,171 @@
+import json
+from dataclasses import dataclass, field
+
+# Incremental reader for the Trivy JSON report (--format json). The report is read in chunks
+# and only one vulnerability at a time is decoded, so memory does not grow with the number of CVEs.
+# The content is returned as typed records: TrivyMetadata, TrivyTarget and TrivyVulnerability
+
+CHUNK_SIZE = 64 * 1024
+SEVERITIES = ("LOW", "MEDIUM", "HIGH", "CRITICAL")
+
+
+@dataclass
+class TrivyMetadata:
+	os_family: str = ""
+	os_name: str = ""
+	eosl: bool = False
+
+
+@dataclass
+class TrivyTarget:
+	target: str
+	target_class: str
+	target_type: str
+	counts: dict = field(default_factory=lambda: {severity: 0 for severity in SEVERITIES})
+
+
+@dataclass
+class TrivyVulnerability:
+	target: str
+	target_class: str
+	package: str
+	installed_version: str
+	fixed_version: str
+	vulnerability_id: str
+	severity: str
+	title: str
+
+
+class JsonStream:
+	# Minimal pull parser: containers are entered one token at a time, while values are decoded
+	# with raw_decode as soon as they are complete in the buffer
+	def __init__(self, stream):
+		self.stream = stream
+		self.buffer = ""
+		self.position = 0
+		self.eof = False
+		self.decoder = json.JSONDecoder()
+
+	def fill(self):
+		chunk = self.stream.read(CHUNK_SIZE)
+		if not chunk:
+			self.eof = True
+			return False
+		self.buffer = self.buffer[self.position:] + chunk
+		self.position = 0
+		return True
+
+	def peek(self):
+		# Next non whitespace character
+		while True:
+			while self.position < len(self.buffer) and self.buffer[self.position] in " \t\r\n":
+				self.position += 1
+			if self.position < len(self.buffer):
+				return self.buffer[self.position]
+			if not self.fill():
+				raise ValueError("Unexpected end of the Trivy report")
+
+	def expect(self, char):
+		if self.peek() != char:
+			raise ValueError(f"Expected '{char}' at offset {self.position} of the Trivy report")
+		self.position += 1
+
+	def value(self):
+		self.peek()
+		while True:
+			try:
+				value, end = self.decoder.raw_decode(self.buffer, self.position)
+			except json.JSONDecodeError:
+				if not self.fill():
+					raise
+				continue
+			# A number at the end of the buffer could continue in the next chunk
+			if end == len(self.buffer) and not self.eof and self.fill():
+				continue
+			self.position = end
+			return value
+
+	def items(self):
+		# Iterate the keys of an object, the caller must consume each value
+		self.expect("{")
+		first = True
+		while self.peek() != "}":
+			if not first:
+				self.expect(",")
+			first = False
+			key = self.value()
+			self.expect(":")
+			yield key
+		self.position += 1
+
+	def elements(self):
+		# Iterate the elements of an array, the caller must consume each element
+		self.expect("[")
+		first = True
+		while self.peek() != "]":
+			if not first:
+				self.expect(",")
+			first = False
+			yield
+		self.position += 1
+
+
+def read_result(parser):
+	# A single entry of Results: target information first, then the vulnerabilities one by one.
+	# Trivy writes Target, Class and Type before Vulnerabilities
+	target = TrivyTarget("", "", "")
+	announced = False
+	for key in parser.items():
+		if key == "Vulnerabilities" and parser.peek() == "[":
+			if not announced:
+				announced = True
+				yield target
+			for _ in parser.elements():
+				vulnerability = parser.value()
+				severity = vulnerability.get("Severity", "UNKNOWN")
+				if severity in target.counts:
+					target.counts[severity] += 1
+				yield TrivyVulnerability(target.target, target.target_class, vulnerability.get("PkgName", ""),
+					vulnerability.get("InstalledVersion", ""), vulnerability.get("FixedVersion", ""),
+					vulnerability.get("VulnerabilityID", ""), severity, vulnerability.get("Title", ""))
+		else:
+			value = parser.value()
+			if key == "Target":
+				target.target = value
+			elif key == "Class":
+				target.target_class = value
+			elif key == "Type":
+				target.target_type = value
+	if not announced:
+		yield target
+
+
+def read_report(stream):
+	# Generator of the records contained in the report. The counts of each TrivyTarget
+	# are complete once all its vulnerabilities have been returned
+	parser = JsonStream(stream)
+	for key in parser.items():
+		if key == "Metadata":
+			metadata = parser.value()
+			os_info = metadata.get("OS") or {}
+			yield TrivyMetadata(os_info.get("Family", ""), os_info.get("Name", ""), os_info.get("EOSL", False))
+		elif key == "Results" and parser.peek() == "[":
+			for _ in parser.elements():
+				yield from read_result(parser)
+		else:
+			parser.value()
+
+
+def render_table(records):
+	# Text report similar to Trivy's table format, built from the records
+	lines = []
+	for record in records:
+		if isinstance(record, TrivyTarget):
+			total = sum(record.counts.values())
+			counts = ", ".join(f"{severity}: {record.counts[severity]}" for severity in SEVERITIES)
+			lines += ["", f"{record.target} ({record.target_type})", "", f"Total: {total} ({counts})", ""]
+			if total:
+				lines.append(f"{'Library':<30} {'Vulnerability':<20} {'Severity':<10} {'Installed Version':<20} {'Fixed Version':<20} Title")
+		elif isinstance(record, TrivyVulnerability):
+			lines.append(f"{record.package:<30} {record.vulnerability_id:<20} {record.severity:<10} {record.installed_version:<20} {record.fixed_version:<20} {record.title}")
+	return "\n".join(lines) + "\n"
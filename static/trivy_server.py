@@ -0,0 +1,117 @@
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from pathlib import Path
+
+from common import metrics
+
+# Helpers to pay the Trivy vulnerability database cost once per node: either a long-lived
+# Trivy server used in client mode, or a shared cache folder whose database is updated once
+# and then used with --skip-db-update while it is fresh
+
+DEFAULT_SERVER = "http://127.0.0.1:4954"
+DEFAULT_CACHE_DIR = str(Path.home() / ".cache" / "trivy")
+
+
+def server_healthy(url, timeout=2):
+	try:
+		with urllib.request.urlopen(url.rstrip("/") + "/healthz", timeout=timeout) as response:
+			return response.status == 200
+	except (urllib.error.URLError, OSError, ValueError):
+		return False
+
+
+def start_server(url, cache_dir=None, timeout=600):
+	# The server is started in its own session so that it keeps running after the script ends
+	# and the next scans on this node can use it. Returns True when it answers the health check
+	address = urllib.parse.urlparse(url)
+	command = ["trivy", "server", "--listen", f"{address.hostname}:{address.port or 4954}"]
+	if cache_dir:
+		command += ["--cache-dir", cache_dir]
+
+	log_folder = Path(cache_dir or DEFAULT_CACHE_DIR)
+	log_folder.mkdir(parents=True, exist_ok=True)
+	with open(log_folder / "server.log", "a") as log:
+		try:
+			process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, start_new_session=True)
+		except OSError:
+			return False
+
+	# The first start downloads the database, so it can take a while. If the server exits (Eg. the port is taken) it's not waited for
+	deadline = time.time() + timeout
+	while time.time() < deadline:
+		if server_healthy(url):
+			return True
+		if process.poll() is not None:
+			return False
+		time.sleep(1)
+	return False
+
+
+def db_is_fresh(cache_dir=None, name="db"):
+	# The database metadata tells when the next update is available. name is "db" for the vulnerability
+	# database, or "java-db" for the database of the jar files
+	metadata_path = Path(cache_dir or DEFAULT_CACHE_DIR) / name / "metadata.json"
+	try:
+		with open(metadata_path, "r") as json_file:
+			next_update = json.load(json_file)["NextUpdate"]
+	except (FileNotFoundError, KeyError, json.JSONDecodeError):
+		return False
+
+	# Eg. 2024-05-01T06:29:13.437396566Z, fractions of seconds are not needed
+	next_update = datetime.datetime.strptime(next_update[:19], "%Y-%m-%dT%H:%M:%S").replace(tzinfo=datetime.timezone.utc)
+	return datetime.datetime.now(datetime.timezone.utc) < next_update
+
+
+def download_db(cache_dir=None):
+	command = ["trivy", "image", "--download-db-only"]
+	if cache_dir:
+		command += ["--cache-dir", cache_dir]
+	return metrics.run(command, "trivy_db_download", capture_output=True, text=True).returncode == 0
+
+
+def link_or_copy(source, destination):
+	# Hard links can't cross file systems
+	try:
+		os.link(source, destination)
+	except OSError:
+		shutil.copy2(source, destination)
+
+
+def worker_cache_dir(cache_dir, root):
+	# Standalone Trivy processes running at the same time can't share a cache folder, it is locked by the first one.
+	# Each process of a batch gets its own folder in root at its first scan, with hard links to the databases of the
+	# shared cache folder. Only fresh databases are linked: they are used with --skip-db-update (or --skip-java-db-update)
+	# so they are never written, otherwise the worker downloads its own. root is deleted at the end of the batch
+	folder = Path(root) / str(os.getpid())
+	if not folder.is_dir():
+		staging = Path(tempfile.mkdtemp(dir=root))
+		for name in ("db", "java-db"):
+			source = Path(cache_dir or DEFAULT_CACHE_DIR) / name
+			if source.is_dir() and db_is_fresh(cache_dir, name):
+				shutil.copytree(source, staging / name, copy_function=link_or_copy)
+		staging.rename(folder)
+	return str(folder)
+
+
+def scan_args(server=None, cache_dir=None):
+	# Extra arguments for 'trivy image': client mode if the server is up, otherwise standalone mode
+	# using the shared cache folder. The second value tells if the database may need to be downloaded
+	if server:
+		if server_healthy(server):
+			return ["--server", server], False
+		print(f"\033[1;38;5;214mTrivy server {server} is not reachable, using standalone mode\033[0m")
+
+	args = ["--cache-dir", cache_dir] if cache_dir else []
+	if db_is_fresh(cache_dir, "java-db"):
+		args += ["--skip-java-db-update"]
+	if db_is_fresh(cache_dir):
+		return args + ["--skip-db-update"], False
+	return args, True